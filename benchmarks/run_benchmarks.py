@@ -0,0 +1,242 @@
+# Benchmarks of the import time, folder scanning, stack reading, projection and BDV writing
+# on synthetic Ultramicroscope acquisitions.
+#
+# Usage:
+#   python benchmarks/run_benchmarks.py --output results-<commit>.json
+#   python benchmarks/run_benchmarks.py --compare results-old.json results-new.json
+#
+# Each benchmark runs in a fresh process, so that the peak RSS that is
+# reported belongs to that benchmark alone. The results are written as JSON
+# together with the git commit and the dataset size, so that runs on
+# different commits can be compared.
+#
+# License BSD-3
+# Volker
+# .Hilsenstein @ monash
+# .edu
+
+import os
+import sys
+import json
+import time
+import pathlib
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+import multiprocessing
+import traceback
+
+import numpy as np
+
+REPO = pathlib.Path(__file__).resolve().parents[1]
+# benchmark the checked out tree rather than an installed um2bs
+sys.path.insert(0, str(REPO))
+
+from synthetic_data import REGEXES, make_dataset
+
+
+def _stacks(folder):
+    from um2bs.process_um_folder import um_mosaic_folder
+
+    mosaic = um_mosaic_folder(folder, REGEXES, use_cache=False)
+    return mosaic, [group["pathname"].values for _, group in mosaic.df.groupby("first_Z")]
+
+
+# modules imported at startup by the command line tool; the GUI imports the
+# same modules of um2bs (plus PyQt5)
+IMPORT_MODULES = ("um2bs.cli",)
+
+
+def bench_import(folder, outfolder):
+    """Starts a fresh interpreter that imports um2bs, i.e. the startup time of the tools"""
+    code = "; ".join(f"import {module}" for module in IMPORT_MODULES)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(REPO), os.environ.get("PYTHONPATH", "")]))
+    subprocess.run([sys.executable, "-c", code], env=env, check=True, stdout=subprocess.DEVNULL)
+
+
+def bench_scan(folder, outfolder):
+    from um2bs.process_um_folder import um_mosaic_folder
+
+    um_mosaic_folder(folder, REGEXES, use_cache=False)
+
+
+def bench_readstack(folder, outfolder, stacks):
+    from um2bs.process_um_folder import readstack
+
+    for files in stacks:
+        readstack(files)
+
+
+def bench_projection(folder, outfolder, stacks):
+    from um2bs.process_um_folder import project_stack
+
+    for files in stacks:
+        project_stack(files, np.max)
+
+
+def bench_write_projected(folder, outfolder, mosaic):
+    mosaic.generate_big_stitcher(outfolder, projected=True, volume=False)
+
+
+def bench_write_volume(folder, outfolder, mosaic):
+    mosaic.generate_big_stitcher(outfolder, projected=False, volume=True)
+
+
+BENCHMARKS = {
+    "import": bench_import,
+    "scan": bench_scan,
+    "readstack": bench_readstack,
+    "projection": bench_projection,
+    "write_projected": bench_write_projected,
+    "write_volume": bench_write_volume,
+}
+
+# benchmarks that do not read the dataset, so no throughput is reported
+WITHOUT_THROUGHPUT = ("import",)
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss / 1e6 if sys.platform == "darwin" else maxrss / 1e3
+
+
+def _run_benchmark(name, folder, repeat, queue):
+    """Runs a benchmark in a child process and puts the result into queue"""
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            func = BENCHMARKS[name]
+            args = ()
+            if name in ("readstack", "projection"):
+                args = (_stacks(folder)[1],)
+            elif name.startswith("write"):
+                args = (_stacks(folder)[0],)
+            times = []
+            for _ in range(repeat):
+                with tempfile.TemporaryDirectory() as outfolder:
+                    t0 = time.perf_counter()
+                    func(folder, outfolder, *args)
+                    times.append(time.perf_counter() - t0)
+        queue.put(dict(seconds=min(times), all_seconds=times, peak_rss_mb=_peak_rss_mb()))
+    except Exception:
+        queue.put(dict(error=traceback.format_exc()))
+
+
+def run_benchmarks(folder, names, repeat=3) -> dict:
+    files = [f for f in os.scandir(folder) if f.name.endswith(".tif")]
+    nbytes = sum(f.stat().st_size for f in files)
+    ctx = multiprocessing.get_context("spawn")
+    results = {}
+    for name in names:
+        queue = ctx.Queue()
+        p = ctx.Process(target=_run_benchmark, args=(name, folder, repeat, queue))
+        p.start()
+        result = queue.get()
+        p.join()
+        if "seconds" in result and name in WITHOUT_THROUGHPUT:
+            print(
+                f"{name:16s} {result['seconds']:8.3f} s {'':33s} "
+                f"peak RSS {result['peak_rss_mb']} MB"
+            )
+        elif "seconds" in result:
+            result["mb_per_s"] = nbytes / 1e6 / result["seconds"]
+            result["files_per_s"] = len(files) / result["seconds"]
+            print(
+                f"{name:16s} {result['seconds']:8.3f} s {result['mb_per_s']:9.1f} MB/s "
+                f"{result['files_per_s']:9.1f} files/s  peak RSS {result['peak_rss_mb']} MB"
+            )
+        else:
+            print(f"{name:16s} failed:\n{result['error']}")
+        results[name] = result
+    return dict(nfiles=len(files), nbytes=nbytes, benchmarks=results)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_file, new_file):
+    """Prints the speedup of every benchmark between two result files"""
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    if old["dataset"] != new["dataset"]:
+        print("Warning: the results were obtained with different datasets")
+    print(f"{'benchmark':16s} {str(old['commit']):>10s} {str(new['commit']):>10s}  speedup")
+    for name, result in new["benchmarks"].items():
+        previous = old["benchmarks"].get(name, {})
+        if "seconds" not in result or "seconds" not in previous:
+            print(f"{name:16s} {'-':>10s} {'-':>10s}")
+            continue
+        print(
+            f"{name:16s} {previous['seconds']:9.3f}s {result['seconds']:9.3f}s "
+            f"{previous['seconds'] / result['seconds']:8.2f}x"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark um2bs on a synthetic dataset.")
+    parser.add_argument("--output", help="JSON file for the results")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    parser.add_argument("--dataset", help="dataset folder, generated if it does not exist")
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--ntiles-x", type=int, default=2)
+    parser.add_argument("--ntiles-y", type=int, default=2)
+    parser.add_argument("--nz", type=int, default=64)
+    parser.add_argument("--ny", type=int, default=512)
+    parser.add_argument("--nx", type=int, default=512)
+    parser.add_argument("--nchannels", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    dataset = dict(
+        ntiles_x=args.ntiles_x,
+        ntiles_y=args.ntiles_y,
+        nz=args.nz,
+        ny=args.ny,
+        nx=args.nx,
+        nchannels=args.nchannels,
+    )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        folder = args.dataset or os.path.join(tmpdir, "dataset")
+        if not os.path.exists(folder):
+            print(f"Generating dataset {dataset} in {folder}")
+            make_dataset(folder, **dataset)
+        results = run_benchmarks(folder, args.benchmarks, args.repeat)
+
+    results.update(
+        commit=_git_commit(),
+        date=time.strftime("%Y-%m-%d %H:%M:%S"),
+        dataset=dataset,
+        python=platform.python_version(),
+        numpy=np.__version__,
+        platform=platform.platform(),
+        cpu_count=os.cpu_count(),
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
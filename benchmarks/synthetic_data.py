@@ -0,0 +1,113 @@
+# Generates synthetic Ultramicroscope acquisitions for benchmarking
+#
+# License BSD-3
+# Volker
+# .Hilsenstein @ monash
+# .edu
+
+import argparse
+import pathlib
+import numpy as np
+import tifffile
+
+# regular expressions matching the generated file names (the defaults of the GUI)
+REGEXES = {
+    "filewhitelist": ".*tif",
+    "Z": r"(?<=_C)\d+",
+    "ch": r"(?<=channel)\d+",
+    "illu": r"(?<=_Ill)[\da-zA-Z]+",
+}
+
+
+def slice_filename(tx: int, ty: int, illumination: str, channel: int, z: int) -> str:
+    """File name of a Z slice, following the naming of the Ultramicroscope software"""
+    return f"10-00-00_UltraII[{tx:02d} x {ty:02d}]_Ill{illumination}_channel{channel}_C{z:04d}.ome.tif"
+
+
+def make_dataset(
+    folder: str,
+    ntiles_x: int = 2,
+    ntiles_y: int = 2,
+    nz: int = 64,
+    ny: int = 512,
+    nx: int = 512,
+    nchannels: int = 1,
+    illuminations=("Left", "Right"),
+    overlap: float = 0.1,
+    seed: int = 0,
+) -> pathlib.Path:
+    """Writes a synthetic acquisition (TIFF slices and tiles.txt) into folder
+
+    The slices are uint16 images of smooth blobs on a noisy background, so
+    that they compress similarly to real data. Stage positions in tiles.txt
+    are in um for a pixel spacing of 1 um and place neighbouring tiles with
+    the given overlap.
+
+    Parameters
+    ----------
+    folder : str
+        output folder, created if it does not exist
+    ntiles_x, ntiles_y : int, optional
+        number of tiles in x and y, by default 2
+    nz, ny, nx : int, optional
+        stack size of each tile, by default 64, 512, 512
+    nchannels : int, optional
+        number of channels, by default 1
+    illuminations : Sequence[str], optional
+        illumination directions, by default ("Left", "Right")
+    overlap : float, optional
+        overlap of neighbouring tiles, by default 0.1
+    seed : int, optional
+        random seed, by default 0
+
+    Returns
+    -------
+    pathlib.Path
+        the dataset folder
+    """
+    folder = pathlib.Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:ny, 0:nx].astype(np.float32)
+    lines = ["[tiles]"]
+    for tx in range(ntiles_x):
+        for ty in range(ntiles_y):
+            # a few blobs per tile whose brightness peaks in the middle of the stack
+            blobs = np.zeros((ny, nx), dtype=np.float32)
+            for cy, cx in rng.uniform(0, 1, (8, 2)) * (ny, nx):
+                blobs += 2000 * np.exp(-((yy - cy) ** 2 + (xx - cx) ** 2) / (0.02 * ny * nx))
+            for ch in range(nchannels):
+                for illumination in illuminations:
+                    for z in range(nz):
+                        profile = np.exp(-(((z - nz / 2) / (nz / 3)) ** 2))
+                        image = blobs * profile + rng.normal(100, 10, (ny, nx))
+                        filename = slice_filename(tx, ty, illumination, ch, z)
+                        tifffile.imwrite(folder / filename, image.astype(np.uint16))
+                        x = tx * nx * (1 - overlap)
+                        y = ty * ny * (1 - overlap)
+                        lines.append(f"{filename};0;({x:.1f}, {y:.1f}, {z:.1f})")
+    (folder / "tiles.txt").write_text("\n".join(lines) + "\n")
+    return folder
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic Ultramicroscope acquisition.")
+    parser.add_argument("folder")
+    parser.add_argument("--ntiles-x", type=int, default=2)
+    parser.add_argument("--ntiles-y", type=int, default=2)
+    parser.add_argument("--nz", type=int, default=64)
+    parser.add_argument("--ny", type=int, default=512)
+    parser.add_argument("--nx", type=int, default=512)
+    parser.add_argument("--nchannels", type=int, default=1)
+    parser.add_argument("--illuminations", nargs="+", default=["Left", "Right"])
+    args = parser.parse_args()
+    make_dataset(
+        args.folder,
+        args.ntiles_x,
+        args.ntiles_y,
+        args.nz,
+        args.ny,
+        args.nx,
+        args.nchannels,
+        args.illuminations,
+    )
@@ -17,10 +17,8 @@ setuptools.setup(
     zip_safe=False,
     install_requires=[
         "numpy",
-        "scikit-image",
         "pandas",
         "pyqt5",
-        "npy2bdv",
         "tifffile",
         "h5py",
         "xmltodict",
@@ -28,6 +26,7 @@ setuptools.setup(
     entry_points="""
             [console_scripts]
             um2bs_gui=um2bs.um2bs_gui:run
+            um2bs=um2bs.cli:main
       """,
     classifiers=[
         "Programming Language :: Python :: 3",
@@ -0,0 +1,88 @@
+# Shared fixtures: small synthetic Ultramicroscope acquisitions
+#
+# License BSD-3
+# Volker
+# .Hilsenstein @ monash
+# .edu
+
+import json
+import pathlib
+import sys
+
+import numpy as np
+import pytest
+import tifffile
+
+REPO = pathlib.Path(__file__).resolve().parents[1]
+# test the checked out tree rather than an installed um2bs
+sys.path.insert(0, str(REPO))
+sys.path.insert(0, str(REPO / "benchmarks"))
+
+from synthetic_data import REGEXES, make_dataset, slice_filename  # noqa: E402
+
+# regexes for time-lapse acquisitions written by write_acquisition
+TIMELAPSE_REGEXES = dict(REGEXES, T=r"(?<=_T)\d+")
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    """A 2x1 mosaic with two illuminations, 8 slices of 64x64 pixels"""
+    return make_dataset(tmp_path / "dataset", 2, 1, 8, 64, 64)
+
+
+@pytest.fixture
+def write_acquisition(tmp_path):
+    """Returns a function that writes {(time, tile_x): (z,y,x) uint16 stack}
+    as a time-lapse acquisition (file names and tiles.txt) and returns its folder"""
+
+    def _write(stacks):
+        folder = tmp_path / "timelapse"
+        folder.mkdir()
+        lines = ["[tiles]"]
+        for (time, tile_x), stack in stacks.items():
+            for z, image in enumerate(stack):
+                name = slice_filename(tile_x, 0, "Left", 0, z).replace("_Ill", f"_T{time:04d}_Ill")
+                tifffile.imwrite(folder / name, image)
+                x = tile_x * stack.shape[2]
+                lines.append(f"{name};0;({x:.1f}, 0.0, {z:.1f})")
+        (folder / "tiles.txt").write_text("\n".join(lines) + "\n")
+        return folder
+
+    return _write
+
+
+def noise_stack(nz, ny, nx, seed=0, bright=()):
+    """uint16 background noise, with the slices in bright set to a high value"""
+    stack = np.random.default_rng(seed).normal(100, 10, (nz, ny, nx)).astype(np.uint16)
+    stack[list(bright)] = 5000
+    return stack
+
+
+def read_bdv_levels(filename):
+    """Returns {(time, setup, level): uint16 array} of all views in a BDV HDF5 file or N5 container"""
+    import h5py
+    from um2bs.n5_writer import _read_block
+
+    filename = pathlib.Path(filename)
+    levels = {}
+    if filename.suffix == ".h5":
+        with h5py.File(filename, "r") as f:
+            for tkey in (k for k in f if k.startswith("t")):
+                for skey, setup in f[tkey].items():
+                    for lkey, level in setup.items():
+                        key = (int(tkey[1:]), int(skey[1:]), int(lkey))
+                        levels[key] = level["cells"][()].view(np.uint16)
+        return levels
+    for attributes in filename.glob("setup*/timepoint*/s*/attributes.json"):
+        level = attributes.parent
+        meta = json.loads(attributes.read_text())
+        shape, block = meta["dimensions"][::-1], meta["blockSize"][::-1]
+        data = np.zeros(shape, np.uint16)
+        for blockfile in level.glob("*/*/*"):
+            bx, by, bz = (int(p) for p in blockfile.relative_to(level).parts)
+            values = _read_block(str(blockfile), meta["compression"])
+            z, y, x = bz * block[0], by * block[1], bx * block[2]
+            data[z : z + values.shape[0], y : y + values.shape[1], x : x + values.shape[2]] = values
+        key = (int(level.parent.name[9:]), int(level.parent.parent.name[5:]), int(level.name[1:]))
+        levels[key] = data
+    return levels
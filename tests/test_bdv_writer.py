@@ -0,0 +1,166 @@
+import xml.etree.ElementTree as ET
+
+import h5py
+import numpy as np
+import pytest
+
+from um2bs.bdv_writer import BdvWriter, downsample_mean, merge_bdv_files
+from um2bs.process_um_folder import VOLUME_BLOCKDIM, VOLUME_SUBSAMP
+
+
+def _stack(shape, seed=0):
+    return np.random.default_rng(seed).integers(0, 65535, shape, dtype=np.uint16)
+
+
+def _cells(f, time, isetup, ilevel=0):
+    return f[f"t{time:05d}/s{isetup:02d}/{ilevel}/cells"][()].view(np.uint16)
+
+
+def _registrations(xmlfile):
+    root = ET.parse(xmlfile).getroot()
+    sizes = {int(vs.find("id").text): vs.find("size").text for vs in root.iter("ViewSetup")}
+    affines = {}
+    for vreg in root.iter("ViewRegistration"):
+        key = (int(vreg.get("timepoint")), int(vreg.get("setup")))
+        affines[key] = {
+            vt.find("Name").text: [float(v) for v in vt.find("affine").text.split()]
+            for vt in vreg.iter("ViewTransform")
+        }
+    return sizes, affines
+
+
+@pytest.mark.parametrize("compression", [None, "gzip", "lzf"])
+@pytest.mark.parametrize("slab_depth", [None, 64, 12])
+def test_round_trip(tmp_path, compression, slab_depth):
+    # not a multiple of the chunks or the subsampling in any dimension
+    stack = _stack((150, 70, 45))
+    writer = BdvWriter(
+        str(tmp_path / "test.h5"),
+        subsamp=VOLUME_SUBSAMP,
+        blockdim=VOLUME_BLOCKDIM,
+        compression=compression,
+    )
+    if slab_depth is None:
+        writer.append_view(stack)
+    else:
+        writer.new_view(stack.shape)
+        for z in range(0, len(stack), slab_depth):
+            writer.append_slab(stack[z : z + slab_depth], z)
+    writer.write_xml_file()
+    writer.close()
+
+    with h5py.File(tmp_path / "test.h5", "r") as f:
+        np.testing.assert_array_equal(f["s00/resolutions"][()], np.flip(VOLUME_SUBSAMP, 1))
+        np.testing.assert_array_equal(f["s00/subdivisions"][()], np.flip(VOLUME_BLOCKDIM, 1))
+        for ilevel, factors in enumerate(VOLUME_SUBSAMP):
+            expected = downsample_mean(stack, factors).astype(np.uint16)
+            np.testing.assert_array_equal(_cells(f, 0, 0, ilevel), expected)
+
+
+def test_xml_setups_and_timepoints(tmp_path):
+    writer = BdvWriter(str(tmp_path / "test.h5"), nchannels=2, ntiles=2)
+    for time in range(2):
+        for channel in range(2):
+            for tile in range(2):
+                shape = (4 + tile, 8, 16 + 8 * channel)
+                affine = np.eye(4)[:3]
+                affine[:, 3] = (100 * tile, 10 * channel, time)
+                writer.new_view(
+                    shape,
+                    time=time,
+                    channel=channel,
+                    tile=tile,
+                    m_affine=affine,
+                    calibration=(1, 1, 2 + time),
+                )
+                writer.append_slab(_stack(shape), 0, time=time, channel=channel, tile=tile)
+    writer.write_xml_file(ntimes=2)
+    writer.close()
+
+    sizes, affines = _registrations(tmp_path / "test.xml")
+    # setup id = (channel * ntiles + tile)
+    assert sizes == {0: "16 8 4", 1: "16 8 5", 2: "24 8 4", 3: "24 8 5"}
+    assert set(affines) == {(t, s) for t in range(2) for s in range(4)}
+    for (time, isetup), transforms in affines.items():
+        channel, tile = divmod(isetup, 2)
+        translation = transforms["manually defined"][3::4]
+        assert translation == [100 * tile, 10 * channel, time]
+        assert transforms["calibration"][10] == 2 + time
+
+
+def test_xml_rejects_setups_with_different_shapes(tmp_path):
+    writer = BdvWriter(str(tmp_path / "test.h5"))
+    writer.new_view((4, 8, 8), time=0)
+    writer.new_view((5, 8, 8), time=1)
+    with pytest.raises(ValueError):
+        writer.write_xml_file(ntimes=2)
+    writer.close()
+
+
+@pytest.mark.parametrize("link", [True, False])
+def test_merge_shards(tmp_path, link):
+    stacks = {
+        (time, tile): _stack((6, 8, 8), seed=2 * time + tile) for time in range(2) for tile in range(2)
+    }
+    shard_files = []
+    for shard in range(2):
+        h5name = str(tmp_path / f"shard{shard}.h5")
+        writer = BdvWriter(h5name, ntiles=2, subsamp=((1, 1, 1), (1, 2, 2)))
+        # each shard holds one tile at both timepoints
+        for time in range(2):
+            affine = np.eye(4)[:3]
+            affine[0, 3] = 8 * shard
+            writer.append_view(stacks[(time, shard)], time=time, tile=shard, m_affine=affine)
+        writer.write_xml_file(ntimes=2)
+        writer.close()
+        shard_files.append(h5name)
+    merge_bdv_files(shard_files, str(tmp_path / "dataset.h5"), link=link)
+
+    with h5py.File(tmp_path / "dataset.h5", "r") as f:
+        for (time, tile), stack in stacks.items():
+            np.testing.assert_array_equal(_cells(f, time, tile), stack)
+            np.testing.assert_array_equal(
+                _cells(f, time, tile, 1), downsample_mean(stack, (1, 2, 2)).astype(np.uint16)
+            )
+    root = ET.parse(tmp_path / "dataset.xml").getroot()
+    assert root.find("SequenceDescription/ImageLoader/hdf5").text == "dataset.h5"
+    assert root.find("SequenceDescription/MissingViews") is None
+    sizes, affines = _registrations(tmp_path / "dataset.xml")
+    assert sizes == {0: "8 8 6", 1: "8 8 6"}
+    assert {key: t["manually defined"][3] for key, t in affines.items()} == {
+        (0, 0): 0.0,
+        (0, 1): 8.0,
+        (1, 0): 0.0,
+        (1, 1): 8.0,
+    }
+
+
+def test_direct_chunks_match_deflate_filter(tmp_path):
+    # random noise does not compress, the zeros and the sparse block do
+    stack = _stack((64, 80, 96))
+    stack[:, 64:] = 0
+    stack[:, :32, 32:] &= 0x000F
+    writer = BdvWriter(str(tmp_path / "test.h5"), blockdim=((64, 64, 64),), compression="gzip")
+    writer.append_view(stack)
+    writer.close()
+
+    with h5py.File(tmp_path / "test.h5", "r") as f, h5py.File(tmp_path / "ref.h5", "w") as ref:
+        written = f["t00000/s00/0/cells"]
+        expected = ref.create_dataset(
+            "cells", data=stack.view(np.int16), chunks=(64, 64, 64), compression="gzip"
+        )
+        np.testing.assert_array_equal(written[()].view(np.uint16), stack)
+        for offset in [(0, 0, 0), (0, 0, 64), (0, 64, 0), (0, 64, 64)]:
+            assert written.id.read_direct_chunk(offset) == expected.id.read_direct_chunk(offset)
+
+
+def test_merge_rejects_shards_with_different_sizes(tmp_path):
+    for shard, nz in enumerate((6, 4)):
+        writer = BdvWriter(str(tmp_path / f"shard{shard}.h5"))
+        writer.append_view(_stack((nz, 8, 8)), time=shard)
+        writer.write_xml_file(ntimes=2)
+        writer.close()
+    with pytest.raises(ValueError, match="one size per setup"):
+        merge_bdv_files(
+            [str(tmp_path / "shard0.h5"), str(tmp_path / "shard1.h5")], str(tmp_path / "dataset.h5")
+        )
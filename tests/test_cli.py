@@ -0,0 +1,70 @@
+import json
+
+from conftest import REGEXES, TIMELAPSE_REGEXES, noise_stack
+from um2bs.cli import estimate_memory, first_stack_shape, fit_slab_depth, read_job_file, run_jobs
+from um2bs.process_um_folder import um_mosaic_folder
+
+
+def _job_file(tmp_path, dataset, **job):
+    jobfile = tmp_path / "jobs.json"
+    job = dict(
+        input=str(dataset), output=str(tmp_path / "out"), regexes=REGEXES, use_cache=False, **job
+    )
+    jobfile.write_text(json.dumps({"jobs": [job]}))
+    return read_job_file(str(jobfile))
+
+
+def test_job_volume_defaults_to_off(dataset, tmp_path):
+    jobs = _job_file(tmp_path, dataset, shards=2)
+    assert run_jobs(jobs) == 0
+    assert (tmp_path / "out" / "projected" / "dataset.xml").exists()
+    assert not (tmp_path / "out" / "volume").exists()
+
+
+def test_job_volume_shards_are_merged(dataset, tmp_path):
+    jobs = _job_file(tmp_path, dataset, shards=2, volume=True)
+    assert run_jobs(jobs) == 0
+    for projtype in ("projected", "volume"):
+        xml = (tmp_path / "out" / projtype / "dataset.xml").read_text()
+        assert xml.count("<ViewRegistration ") == 4
+
+
+def test_job_shards_share_content_threshold(write_acquisition, tmp_path):
+    empty = noise_stack(16, 32, 32, seed=0)
+    bright = noise_stack(16, 32, 32, seed=1, bright=range(16))
+    folder = write_acquisition({(0, 0): empty, (0, 1): bright})
+    jobfile = tmp_path / "jobs.json"
+    job = dict(
+        input=str(folder),
+        output=str(tmp_path / "out"),
+        regexes=TIMELAPSE_REGEXES,
+        use_cache=False,
+        shards=2,
+        skip_empty_tiles=True,
+    )
+    jobfile.write_text(json.dumps({"jobs": [job]}))
+    assert run_jobs(read_job_file(str(jobfile))) == 0
+    xml = (tmp_path / "out" / "projected" / "dataset.xml").read_text()
+    assert xml.count("<ViewRegistration ") == 1
+
+
+def test_slab_depth_fits_memory_budget(dataset):
+    mosaic = um_mosaic_folder(str(dataset), REGEXES, use_cache=False)
+    assert first_stack_shape(mosaic) == (8, 64, 64)
+    shape = (512, 256, 256)
+    options = {"volume": True, "prefetch_depth": 1}
+    whole = estimate_memory(mosaic, shape, options)
+    fitted = fit_slab_depth(mosaic, shape, options, whole // 4)
+    assert fitted["slab_depth"] == 128
+    assert estimate_memory(mosaic, shape, fitted) <= whole // 4
+
+
+def test_whole_stacks_are_not_read_ahead_by_default(dataset):
+    mosaic = um_mosaic_folder(str(dataset), REGEXES, use_cache=False)
+    shape = (512, 256, 256)
+    stack_bytes = 512 * 256 * 256 * 2
+    # one stack being written, one being read and one for the pyramid
+    assert estimate_memory(mosaic, shape, {"volume": True}) == 3 * stack_bytes
+    assert estimate_memory(mosaic, shape, {"volume": True, "prefetch_depth": 1}) == 4 * stack_bytes
+    slabs = estimate_memory(mosaic, shape, {"volume": True, "slab_depth": 128})
+    assert slabs == 4 * stack_bytes // 4
@@ -0,0 +1,126 @@
+import xml.etree.ElementTree as ET
+
+import h5py
+import numpy as np
+import pytest
+import tifffile
+
+from conftest import REGEXES, TIMELAPSE_REGEXES, make_dataset, noise_stack
+from um2bs.process_um_folder import um_mosaic_folder
+
+
+def _registrations(xmlfile):
+    root = ET.parse(xmlfile).getroot()
+    sizes = {
+        int(vs.find("id").text): vs.find("size").text for vs in root.iter("ViewSetup")
+    }
+    affines = {
+        (int(vr.get("timepoint")), int(vr.get("setup"))): [
+            float(v) for v in vr.find("ViewTransform/affine").text.split()
+        ]
+        for vr in root.iter("ViewRegistration")
+    }
+    return sizes, affines
+
+
+def test_trim_z_timelapse(write_acquisition, tmp_path):
+    # content in slices 8..19 at t0 and 14..27 at t1, the union with a
+    # margin of 2 slices is 6..30
+    t0 = noise_stack(32, 32, 32, seed=0, bright=range(8, 20))
+    t1 = noise_stack(32, 32, 32, seed=1, bright=range(14, 28))
+    folder = write_acquisition({(0, 0): t0, (1, 0): t1})
+    mosaic = um_mosaic_folder(folder, TIMELAPSE_REGEXES, use_cache=False)
+    out = tmp_path / "out"
+    mosaic.generate_big_stitcher(
+        str(out), projected=False, volume=True, zspacing=2.0, trim_z=True, content_threshold=1000
+    )
+
+    with h5py.File(out / "volume" / "dataset.h5", "r") as f:
+        for t, stack in enumerate((t0, t1)):
+            cells = f[f"t{t:05d}/s00/0/cells"][()].view(np.uint16)
+            np.testing.assert_array_equal(cells, stack[6:30])
+    sizes, affines = _registrations(out / "volume" / "dataset.xml")
+    assert sizes == {0: "32 32 24"}
+    assert set(affines) == {(0, 0), (1, 0)}
+    for affine in affines.values():
+        # 6 slices of 2 um at 1 um/pixel
+        assert affine[11] == 12.0
+
+
+def test_trim_z_timelapse_shards(write_acquisition, tmp_path):
+    # the timepoints of a tile are converted by different shards
+    t0 = noise_stack(32, 32, 32, seed=0, bright=range(8, 20))
+    t1 = noise_stack(32, 32, 32, seed=1, bright=range(14, 28))
+    folder = write_acquisition({(0, 0): t0, (1, 0): t1})
+    mosaic = um_mosaic_folder(folder, TIMELAPSE_REGEXES, use_cache=False)
+    out = tmp_path / "out"
+    mosaic.generate_big_stitcher_sharded(
+        str(out), 2, max_workers=1, projected=False, volume=True, trim_z=True, content_threshold=1000
+    )
+    with h5py.File(out / "volume" / "dataset.h5", "r") as f:
+        assert f["t00000/s00/0/cells"].shape == f["t00001/s00/0/cells"].shape == (24, 32, 32)
+
+
+def test_skip_empty_tiles_shards_share_threshold(write_acquisition, tmp_path):
+    # a shard with only the bright tile would estimate its background from
+    # the sample and drop the tile as empty
+    empty = noise_stack(16, 32, 32, seed=0)
+    bright = noise_stack(16, 32, 32, seed=1, bright=range(16))
+    folder = write_acquisition({(0, 0): empty, (0, 1): bright})
+    mosaic = um_mosaic_folder(folder, TIMELAPSE_REGEXES, use_cache=False)
+    assert mosaic.estimate_content_threshold() < 1000
+    out = tmp_path / "out"
+    mosaic.generate_big_stitcher_sharded(
+        str(out), 2, max_workers=1, projected=False, volume=True, skip_empty_tiles=True
+    )
+    with h5py.File(out / "volume" / "dataset.h5", "r") as f:
+        stored = [name for name in f["t00000"] if "0/cells" in f[f"t00000/{name}"]]
+        assert len(stored) == 1
+        cells = f[f"t00000/{stored[0]}/0/cells"][()].view(np.uint16)
+        np.testing.assert_array_equal(cells, bright)
+
+
+def _add_empty_slices(folder, nz, nempty, seed=0):
+    """Appends nempty background-only slices to every stack of a make_dataset folder"""
+    rng = np.random.default_rng(seed)
+    lines = (folder / "tiles.txt").read_text().splitlines()
+    for line in list(lines[1:]):
+        name, _, position = line.split(";")
+        if not name.endswith(f"_C{nz - 1:04d}.ome.tif"):
+            continue
+        x, y, _ = position.strip("()").split(",")
+        for z in range(nz, nz + nempty):
+            empty_name = name.replace(f"_C{nz - 1:04d}", f"_C{z:04d}")
+            tifffile.imwrite(folder / empty_name, rng.normal(100, 10, (64, 64)).astype(np.uint16))
+            lines.append(f"{empty_name};0;({x},{y}, {z:.1f})")
+    (folder / "tiles.txt").write_text("\n".join(lines) + "\n")
+
+
+@pytest.mark.parametrize("nempty", [0, 8])
+def test_trim_z_keeps_dim_sample_slices(tmp_path, nempty):
+    # the sample of make_dataset is dim but present in every slice, the
+    # background-only slices appended to the stacks are trimmed
+    folder = make_dataset(tmp_path / "dataset", 2, 1, 24, 64, 64)
+    _add_empty_slices(folder, 24, nempty)
+    mosaic = um_mosaic_folder(str(folder), REGEXES, use_cache=False)
+    # the dimmest slices with sample have a brightness of about 430
+    assert mosaic.estimate_content_threshold() < 300
+    out = tmp_path / "out"
+    mosaic.generate_big_stitcher(
+        str(out), projected=False, volume=True, skip_empty_tiles=True, trim_z=True
+    )
+    nkept = 24 + min(nempty, 2)
+    sizes, _ = _registrations(out / "volume" / "dataset.xml")
+    assert len(sizes) == 4
+    assert set(sizes.values()) == {f"64 64 {nkept}"}
+
+
+def test_timepoints_with_different_depths_fail_before_writing(write_acquisition, tmp_path):
+    folder = write_acquisition(
+        {(0, 0): noise_stack(8, 32, 32, seed=0), (1, 0): noise_stack(6, 32, 32, seed=1)}
+    )
+    mosaic = um_mosaic_folder(folder, TIMELAPSE_REGEXES, use_cache=False)
+    out = tmp_path / "out"
+    with pytest.raises(ValueError, match="different numbers of slices"):
+        mosaic.generate_big_stitcher(str(out), projected=False, volume=True)
+    assert not (out / "volume" / "dataset.h5").exists()
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+import tifffile
+
+from conftest import REGEXES, read_bdv_levels
+from um2bs.flatfield import FlatFieldCorrection, estimate_flatfield
+from um2bs.process_um_folder import uint16_converter, um_mosaic_folder
+
+
+def _corrected(src, flat, dark):
+    """numpy reference of (src - dark) / flat, with flat normalized to a mean of 1"""
+    flat = np.asarray(flat, np.float64) / np.mean(flat)
+    return np.clip(np.rint((src.astype(np.float64) - dark) / flat), 0, 65535).astype(np.uint16)
+
+
+def _falloff(ny, nx):
+    yy, xx = np.mgrid[0:ny, 0:nx]
+    return 0.5 + np.exp(-(((xx - nx / 3) / nx) ** 2)) * np.cos((yy - ny / 2) / ny)
+
+
+@pytest.mark.parametrize("dark", [None, 100.0, "image"])
+def test_converter_matches_numpy(tmp_path, dark):
+    rng = np.random.default_rng(0)
+    src = rng.integers(0, 60000, (3, 48, 40), dtype=np.uint16)
+    flat = rng.uniform(0.5, 1.5, (48, 40)).astype(np.float32)
+    if dark == "image":
+        dark = rng.uniform(50, 150, (48, 40)).astype(np.float32)
+        tifffile.imwrite(tmp_path / "dark.tif", dark)
+        dark_spec = str(tmp_path / "dark.tif")
+    else:
+        dark_spec = dark
+    tifffile.imwrite(tmp_path / "flat.tif", flat)
+    correction = FlatFieldCorrection(str(tmp_path / "flat.tif"), dark_spec)
+    expected = _corrected(src, flat, 0 if dark is None else dark)
+
+    convert = correction.converter()
+    result = np.empty_like(src)
+    for z in range(len(src)):
+        convert(src[z].copy(), result[z])
+    # float32 arithmetic may round the other way at .5
+    assert np.abs(result.astype(int) - expected).max() <= 1
+
+    # passed on to the conversion into uint16, which warns about clipping
+    chained = np.empty_like(src)
+    convert = correction.converter(uint16_converter())
+    with pytest.warns(UserWarning, match="clipped"):
+        for z in range(len(src)):
+            convert(src[z].copy(), chained[z])
+    np.testing.assert_array_equal(chained, result)
+
+
+def test_estimate_flatfield_recovers_falloff(tmp_path):
+    rng = np.random.default_rng(0)
+    ny, nx = 96, 128
+    falloff = _falloff(ny, nx)
+    stacks = []
+    for tile in range(6):
+        files = []
+        for z in range(4):
+            # a bright sparse sample at a different place in every tile
+            sample = np.full((ny, nx), 1000.0)
+            y, x = rng.integers(0, ny - 16), rng.integers(0, nx - 16)
+            sample[y : y + 16, x : x + 16] += 20000
+            image = sample * falloff + 100 + rng.normal(0, 5, (ny, nx))
+            files.append(str(tmp_path / f"tile{tile}_z{z}.tif"))
+            tifffile.imwrite(files[-1], image.astype(np.uint16))
+        stacks.append(files)
+
+    flat = estimate_flatfield(stacks, dark=100.0, nslices=24, block=16)
+    assert flat.dtype == np.float32 and flat.shape == (ny, nx)
+    assert abs(flat.mean() - 1) < 1e-4
+    expected = falloff / falloff.mean()
+    # between the outermost block centres the flat-field is interpolated,
+    # outside it keeps the value of the nearest block
+    np.testing.assert_allclose(flat[8:-8, 8:-8], expected[8:-8, 8:-8], rtol=0.05)
+    np.testing.assert_allclose(flat, expected, rtol=0.1)
+
+
+def test_conversion_applies_correction(dataset, tmp_path):
+    flat = _falloff(64, 64).astype(np.float32)
+    tifffile.imwrite(tmp_path / "flat.tif", flat)
+    options = dict(projected=False, volume=True)
+    mosaic = um_mosaic_folder(str(dataset), REGEXES, use_cache=False)
+    mosaic.generate_big_stitcher(str(tmp_path / "raw"), **options)
+    mosaic.generate_big_stitcher(
+        str(tmp_path / "corrected"), flatfield=str(tmp_path / "flat.tif"), darkframe=90, **options
+    )
+
+    raw = read_bdv_levels(tmp_path / "raw" / "volume" / "dataset.h5")
+    corrected = read_bdv_levels(tmp_path / "corrected" / "volume" / "dataset.h5")
+    assert raw.keys() == corrected.keys()
+    for key in (key for key in raw if key[2] == 0):
+        difference = corrected[key].astype(int) - _corrected(raw[key], flat, 90)
+        assert np.abs(difference).max() <= 1, key
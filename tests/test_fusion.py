@@ -0,0 +1,83 @@
+import re
+
+import numpy as np
+import pytest
+import tifffile
+
+from conftest import REGEXES, read_bdv_levels
+from um2bs.fusion import fuse_stacks, illumination_weights
+from um2bs.process_um_folder import um_mosaic_folder
+
+
+def _stacks(n, shape=(5, 24, 40)):
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 65536, shape, dtype=np.uint16) for _ in range(n)]
+
+
+def _sigmoid_reference(stacks, weights):
+    blended = sum(s.astype(np.float64) * w for s, w in zip(stacks, weights))
+    return np.clip(np.rint(blended), 0, 65535).astype(np.uint16)
+
+
+def test_max_fusion():
+    stacks = _stacks(3)
+    expected = np.maximum.reduce(stacks)
+    np.testing.assert_array_equal(fuse_stacks([s.copy() for s in stacks], "max"), expected)
+
+
+def test_sigmoid_fusion():
+    stacks = _stacks(2)
+    weights = illumination_weights(["Left", "Right"], stacks[0].shape[2])
+    fused = fuse_stacks([s.copy() for s in stacks], "sigmoid", weights)
+    assert fused.dtype == np.uint16
+    # float32 arithmetic may round the other way at .5
+    assert np.abs(fused.astype(int) - _sigmoid_reference(stacks, weights)).max() <= 1
+
+
+def test_illumination_weights():
+    nx = 101
+    left, right = illumination_weights(["IllLeft", "IllRight"], nx)
+    np.testing.assert_allclose(left + right, 1, rtol=1e-6)
+    assert left[0] > 0.99 and left[-1] < 0.01 and abs(left[nx // 2] - 0.5) < 1e-6
+    # the sides follow the names, not their order
+    swapped = illumination_weights(["right", "left"], nx)
+    np.testing.assert_array_equal(swapped[0], right)
+    np.testing.assert_array_equal(swapped[1], left)
+    # without left/right in the names the first illumination comes from the left
+    np.testing.assert_array_equal(illumination_weights(["0", "1"], nx)[0], left)
+
+
+def _expected_views(dataset, method):
+    """numpy reference of the fused stack of each tile, read from the files"""
+    tiles = {}
+    for name in sorted(dataset.glob("*.tif")):
+        tile = re.search(r"\[(\d+ x \d+)\]", name.name).group(1)
+        illumination = re.search(REGEXES["illu"], name.name).group(0)
+        tiles.setdefault(tile, {}).setdefault(illumination, []).append(tifffile.imread(name))
+    views = []
+    for illuminations in tiles.values():
+        stacks = [np.stack(illuminations[name]) for name in ("Left", "Right")]
+        if method == "max":
+            views.append(np.maximum(*stacks))
+        else:
+            weights = illumination_weights(["Left", "Right"], stacks[0].shape[2])
+            views.append(_sigmoid_reference(stacks, weights))
+    return views
+
+
+@pytest.mark.parametrize("method", ["max", "sigmoid"])
+def test_conversion_fuses_illuminations(dataset, tmp_path, method):
+    mosaic = um_mosaic_folder(str(dataset), REGEXES, use_cache=False)
+    mosaic.generate_big_stitcher(str(tmp_path), volume=True, fuse_illuminations=method)
+
+    expected = _expected_views(dataset, method)
+    for projtype, reference in (
+        ("volume", expected),
+        ("projected", [np.max(view, axis=0, keepdims=True) for view in expected]),
+    ):
+        levels = read_bdv_levels(tmp_path / projtype / "dataset.h5")
+        written = [data for key, data in sorted(levels.items()) if key[2] == 0]
+        # one view per tile, in any setup order
+        assert len(written) == len(reference) == 2
+        for data in written:
+            assert min(np.abs(data.astype(int) - ref).max() for ref in reference) <= 1, projtype
@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+
+from conftest import REGEXES
+from um2bs.process_um_folder import um_mosaic_folder
+
+
+def test_cached_index_matches_scan(dataset, tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    cachedir = tmp_path / "home" / ".cache" / "um2bs"
+    scanned = um_mosaic_folder(str(dataset), REGEXES)
+    assert [p.suffix for p in cachedir.iterdir()] == [".json"]
+    cached = um_mosaic_folder(str(dataset), REGEXES)
+    pd.testing.assert_frame_equal(cached.df, scanned.df)
+    assert sorted(cached.tiffiles) == sorted(scanned.tiffiles)
+    assert list(cached.tiles.filenames) == list(scanned.tiles.filenames)
+    np.testing.assert_array_equal(cached.tiles.xyz, scanned.tiles.xyz)
+
+    # other regexes replace the cached index of the folder instead of adding one
+    left = um_mosaic_folder(str(dataset), {**REGEXES, "filewhitelist": r".*_IllLeft.*tif"})
+    assert len(left.df) == len(scanned.df) // 2
+    assert len(list(cachedir.iterdir())) == 1
+    assert len(um_mosaic_folder(str(dataset), REGEXES).df) == len(scanned.df)
+
+
+def test_no_cache(dataset, tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    um_mosaic_folder(str(dataset), REGEXES, use_cache=False)
+    assert not (tmp_path / "home" / ".cache").exists()
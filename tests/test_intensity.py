@@ -0,0 +1,75 @@
+import warnings
+
+import numpy as np
+import pytest
+import tifffile
+
+from um2bs.process_um_folder import _to_dtype, bdv_dtype, readstack, uint16_converter
+
+
+def _write_slices(folder, stack):
+    files = []
+    for z, image in enumerate(stack):
+        files.append(str(folder / f"slice{z:04d}.tif"))
+        tifffile.imwrite(files[-1], image)
+    return files
+
+
+def _read(files, dtype, **intensity):
+    outdtype, convert_func = bdv_dtype(dtype, **intensity)
+    return readstack(files, convertto=outdtype, convert_func=convert_func)
+
+
+def test_uint8_is_widened(tmp_path):
+    stack = np.random.default_rng(0).integers(0, 256, (3, 16, 16), dtype=np.uint8)
+    assert bdv_dtype(np.uint8) == (np.dtype(np.uint16), None)
+    result = _read(_write_slices(tmp_path, stack), np.uint8)
+    assert result.dtype == np.uint16
+    np.testing.assert_array_equal(result, stack)
+
+
+def test_uint16_is_kept(tmp_path):
+    # values above 32767 must not wrap to negative numbers
+    stack = np.random.default_rng(0).integers(30000, 65536, (3, 16, 16), dtype=np.uint16)
+    assert bdv_dtype(np.uint16) == (np.dtype(np.uint16), None)
+    result = _read(_write_slices(tmp_path, stack), np.uint16)
+    assert result.dtype == np.uint16
+    np.testing.assert_array_equal(result, stack)
+
+
+def test_float_is_rounded_and_clipped(tmp_path):
+    stack = np.random.default_rng(0).uniform(-100, 70000, (3, 16, 16)).astype(np.float32)
+    with pytest.warns(UserWarning, match="clipped"):
+        result = _read(_write_slices(tmp_path, stack), np.float32)
+    assert result.dtype == np.uint16
+    np.testing.assert_array_equal(result, np.clip(np.rint(stack), 0, 65535))
+
+
+def test_float_is_rescaled(tmp_path):
+    stack = np.random.default_rng(0).uniform(0, 1, (3, 16, 16)).astype(np.float32)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        result = _read(
+            _write_slices(tmp_path, stack), np.float32, intensity="rescale", input_range=(0, 1)
+        )
+    expected = np.rint(stack.astype(np.float32) * np.float32(65535))
+    np.testing.assert_allclose(result, expected, atol=1)
+
+
+def test_converter_without_clipping_does_not_warn():
+    src = np.array([[0.4, 65534.6]], dtype=np.float64)
+    dst = np.empty(src.shape, np.uint16)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        uint16_converter()(src, dst)
+    np.testing.assert_array_equal(dst, [[0, 65535]])
+
+
+def test_sum_projection_past_range_warns():
+    projection = np.sum(np.full((2, 4, 4), 40000, np.uint16), axis=0, dtype=np.float64)
+    with pytest.warns(UserWarning, match="clipped"):
+        result = _to_dtype(projection, np.uint16)
+    np.testing.assert_array_equal(result, 65535)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        np.testing.assert_array_equal(_to_dtype(projection / 2, np.uint16), 40000)
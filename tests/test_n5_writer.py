@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from conftest import read_bdv_levels
+from um2bs.bdv_writer import BdvWriter, downsample_mean
+from um2bs.n5_writer import BdvN5Writer
+from um2bs.process_um_folder import VOLUME_BLOCKDIM, VOLUME_SUBSAMP
+
+WRITERS = {".h5": BdvWriter, ".n5": BdvN5Writer}
+
+
+def _stack(shape, seed=0):
+    return np.random.default_rng(seed).integers(0, 65535, shape, dtype=np.uint16)
+
+
+def _write(filename, stacks, slab_depth=None, mode="w", compression="gzip"):
+    writer = WRITERS[filename.suffix](
+        str(filename),
+        ntiles=len(stacks),
+        subsamp=VOLUME_SUBSAMP,
+        blockdim=VOLUME_BLOCKDIM,
+        compression=compression,
+        mode=mode,
+    )
+    for tile, stack in enumerate(stacks):
+        if slab_depth is None:
+            writer.append_view(stack, tile=tile)
+        else:
+            writer.new_view(stack.shape, tile=tile)
+            for z in range(0, len(stack), slab_depth):
+                writer.append_slab(stack[z : z + slab_depth], z, tile=tile)
+    writer.write_xml_file()
+    writer.close()
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+@pytest.mark.parametrize("slab_depth", [None, 12, 68])
+def test_n5_matches_hdf5(tmp_path, compression, slab_depth):
+    # not a multiple of the blocks in any dimension, so the edge blocks are
+    # truncated, and slabs that only partially cover blocks are merged
+    stacks = [_stack((150, 70, 45)), _stack((150, 70, 45), seed=1)]
+    _write(tmp_path / "test.n5", stacks, slab_depth, compression=compression)
+    _write(tmp_path / "test.h5", stacks, compression=compression)
+
+    n5 = read_bdv_levels(tmp_path / "test.n5")
+    h5 = read_bdv_levels(tmp_path / "test.h5")
+    assert n5.keys() == h5.keys() == {
+        (0, tile, ilevel) for tile in range(2) for ilevel in range(len(VOLUME_SUBSAMP))
+    }
+    for (_, tile, ilevel), data in h5.items():
+        expected = downsample_mean(stacks[tile], VOLUME_SUBSAMP[ilevel]).astype(np.uint16)
+        np.testing.assert_array_equal(data, expected)
+        np.testing.assert_array_equal(n5[(0, tile, ilevel)], expected)
+
+
+@pytest.mark.parametrize("suffix", [".h5", ".n5"])
+def test_retain_views_swaps_setups(tmp_path, suffix):
+    stacks = [_stack((20, 16, 16)), _stack((20, 16, 16), seed=1), _stack((20, 16, 16), seed=2)]
+    filename = tmp_path / f"test{suffix}"
+    _write(filename, stacks)
+
+    # the old and new locations overlap, so the views are moved in two steps
+    writer = WRITERS[suffix](str(filename), ntiles=3, subsamp=VOLUME_SUBSAMP, mode="a")
+    assert writer.stored_views() == {(0, tile): (20, 16, 16) for tile in range(3)}
+    writer.retain_views({(0, 0): (0, 1), (0, 1): (0, 0)})
+    writer.close()
+
+    levels = read_bdv_levels(filename)
+    np.testing.assert_array_equal(levels[(0, 0, 0)], stacks[1])
+    np.testing.assert_array_equal(levels[(0, 1, 0)], stacks[0])
+    np.testing.assert_array_equal(
+        levels[(0, 1, 1)], downsample_mean(stacks[0], VOLUME_SUBSAMP[1]).astype(np.uint16)
+    )
+    # HDF5 drops the views that are not retained, N5 leaves them for other writers
+    assert ((0, 2, 0) in levels) == (suffix == ".n5")
@@ -0,0 +1,16 @@
+from um2bs.pipeline import reader_pool
+
+
+def test_reader_pool_per_settings(tmp_path):
+    filename = tmp_path / "slice.raw"
+    filename.write_bytes(b"data")
+    first = reader_pool(io_threads=2, decode_threads=2)
+    # another conversion with different settings must not shut down the first pool
+    second = reader_pool(io_threads=3)
+    assert second is not first
+    assert second.settings() == (3, 2, first.readahead)
+    assert first.fetch(str(filename)).result() == 4
+    assert first.map(len, ["ab", "c"]) == [2, 1]
+    # None keeps the settings of the pool requested last
+    assert reader_pool() is second
+    assert reader_pool(io_threads=2) is first
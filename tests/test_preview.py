@@ -0,0 +1,65 @@
+import re
+
+import numpy as np
+import pytest
+import tifffile
+
+from conftest import REGEXES, make_dataset
+from um2bs.preview import mosaic_overview
+from um2bs.process_um_folder import um_mosaic_folder
+
+
+def _tiles(folder):
+    """{(tx, ty): (stage x, stage y, stack)} read directly from tiles.txt and the slices"""
+    tiles = {}
+    for line in (folder / "tiles.txt").read_text().splitlines()[1:]:
+        name, _, xyz = line.split(";")
+        tx, ty = map(int, re.search(r"\[(\d+) x (\d+)\]", name).groups())
+        x, y, _ = map(float, xyz.strip("()").split(","))
+        tiles.setdefault((tx, ty), (x, y, []))[2].append(tifffile.imread(folder / name))
+    return {key: (x, y, np.stack(slices)) for key, (x, y, slices) in tiles.items()}
+
+
+@pytest.mark.parametrize("direction_x, direction_y", [(1, -1), (-1, 1)])
+@pytest.mark.parametrize("xy_step, z_step", [(8, 4), (4, 16)])
+def test_tiles_land_at_stage_positions(tmp_path, direction_x, direction_y, xy_step, z_step):
+    # 3x2 tiles with a 10% overlap and a single illumination
+    folder = make_dataset(tmp_path / "dataset", 3, 2, 12, 64, 48, illuminations=("Left",))
+    xyspacing = 0.5
+    mosaic = um_mosaic_folder(str(folder), REGEXES, use_cache=False)
+    overview, boxes = mosaic_overview(
+        mosaic,
+        xyspacing=xyspacing,
+        direction_x=direction_x,
+        direction_y=direction_y,
+        z_step=z_step,
+        xy_step=xy_step,
+    )
+
+    # numpy reference: stage positions in um, turned into pixels and flipped
+    tiles = _tiles(folder)
+    offsets = {
+        key: (y / xyspacing * direction_y, x / xyspacing * direction_x)
+        for key, (x, y, _) in tiles.items()
+    }
+    ymin = min(y for y, _ in offsets.values())
+    xmin = min(x for _, x in offsets.values())
+    expected = np.zeros_like(overview)
+    placed = set()
+    for key, (_, _, stack) in tiles.items():
+        thumbnail = np.max(stack[::z_step, ::xy_step, ::xy_step], axis=0)
+        oy = int(round((offsets[key][0] - ymin) / xy_step))
+        ox = int(round((offsets[key][1] - xmin) / xy_step))
+        placed.add((oy, ox, thumbnail.shape))
+        region = expected[oy : oy + thumbnail.shape[0], ox : ox + thumbnail.shape[1]]
+        assert region.shape == thumbnail.shape, "tile outside of the overview"
+        np.maximum(region, thumbnail, out=region)
+
+    assert len(boxes) == 6
+    columns = boxes[["oy", "ox", "ony", "onx"]].values
+    assert {(oy, ox, (ony, onx)) for oy, ox, ony, onx in columns} == placed
+    assert overview.shape == (
+        max(oy + shape[0] for oy, _, shape in placed),
+        max(ox + shape[1] for _, ox, shape in placed),
+    )
+    np.testing.assert_array_equal(overview, expected)
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+import tifffile
+
+from conftest import REGEXES, make_dataset, read_bdv_levels
+from um2bs.process_um_folder import (
+    _to_dtype,
+    project_stack,
+    readstack,
+    uint16_converter,
+    um_mosaic_folder,
+)
+
+FUNCS = [np.max, np.min, np.sum, np.mean]
+
+
+def _write_slices(folder, stack):
+    files = []
+    for z, image in enumerate(stack):
+        files.append(str(folder / f"slice{z:04d}.tif"))
+        tifffile.imwrite(files[-1], image)
+    return files
+
+
+@pytest.mark.parametrize("nthreads", [1, 3, 20])
+@pytest.mark.parametrize("project_func", FUNCS, ids=lambda f: f.__name__)
+def test_project_stack_matches_numpy(tmp_path, project_func, nthreads):
+    stack = np.random.default_rng(0).integers(0, 65536, (11, 24, 20), dtype=np.uint16)
+    files = _write_slices(tmp_path, stack)
+    result = project_stack(files, project_func, nthreads=nthreads)
+    expected = project_func(readstack(files), axis=0)
+    assert result.dtype == expected.dtype
+    np.testing.assert_allclose(result, expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize("project_func", FUNCS, ids=lambda f: f.__name__)
+def test_project_stack_converts_slices(tmp_path, project_func):
+    stack = np.random.default_rng(0).uniform(0, 1000, (7, 16, 16)).astype(np.float32)
+    files = _write_slices(tmp_path, stack)
+    options = dict(convertto=np.uint16, convert_func=uint16_converter())
+    result = project_stack(files, project_func, nthreads=2, **options)
+    np.testing.assert_allclose(result, project_func(readstack(files, **options), axis=0))
+
+
+def test_project_stack_rejects_other_functions(tmp_path):
+    files = _write_slices(tmp_path, np.zeros((2, 4, 4), np.uint16))
+    with pytest.raises(ValueError):
+        project_stack(files, np.median)
+
+
+@pytest.mark.parametrize("project_func", [np.max, np.sum, np.mean], ids=lambda f: f.__name__)
+def test_projected_views_with_and_without_slabs(tmp_path, project_func):
+    # 12 slices, so slabs of 8 leave a shorter last slab
+    dataset = make_dataset(tmp_path / "dataset", 2, 1, 12, 32, 32)
+    mosaic = um_mosaic_folder(str(dataset), REGEXES, use_cache=False)
+    runs = {
+        "stacks": dict(volume=True),
+        "slabs": dict(volume=True, slab_depth=8),
+        "streamed": dict(volume=False),
+    }
+    for name, options in runs.items():
+        mosaic.generate_big_stitcher(str(tmp_path / name), project_func=project_func, **options)
+
+    volume = read_bdv_levels(tmp_path / "stacks" / "volume" / "dataset.h5")
+    for name in runs:
+        projected = read_bdv_levels(tmp_path / name / "projected" / "dataset.h5")
+        views = {key: data for key, data in volume.items() if key[2] == 0}
+        assert {key for key in projected if key[2] == 0} == views.keys()
+        for key, stack in views.items():
+            expected = _to_dtype(project_func(stack, axis=0), np.uint16)
+            np.testing.assert_array_equal(projected[key][0], expected, err_msg=f"{name} {key}")
@@ -0,0 +1,79 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from conftest import REGEXES, read_bdv_levels
+from um2bs.process_um_folder import BACKENDS, um_mosaic_folder
+
+NVIEWS = 4
+
+
+def _convert(dataset, output, **options):
+    """Converts the dataset, returns the number of views that were (re)converted"""
+    events = []
+    callback = options.pop("progress_callback", None)
+
+    def _record(event):
+        events.append(event)
+        if callback is not None:
+            callback(event)
+
+    mosaic = um_mosaic_folder(str(dataset), REGEXES, use_cache=False)
+    mosaic.generate_big_stitcher(str(output), progress_callback=_record, **options)
+    return events[0]["nviews"]
+
+
+def _assert_same_output(output, expected, backend):
+    container = "dataset" + BACKENDS[backend][1]
+    for projtype in ("projected", "volume"):
+        written = read_bdv_levels(output / projtype / container)
+        reference = read_bdv_levels(expected / projtype / container)
+        assert written.keys() == reference.keys()
+        for key, data in reference.items():
+            np.testing.assert_array_equal(written[key], data, err_msg=f"{projtype} {key}")
+        xml = (output / projtype / "dataset.xml").read_text()
+        assert xml == (expected / projtype / "dataset.xml").read_text()
+
+
+@pytest.mark.parametrize("backend", ["hdf5", "n5"])
+def test_resume_after_cancel_matches_full_run(dataset, tmp_path, backend):
+    assert _convert(dataset, tmp_path / "full", backend=backend) == NVIEWS
+
+    cancel = threading.Event()
+
+    def _cancel_after_first_view(event):
+        if event["event"] == "view":
+            cancel.set()
+
+    output = tmp_path / "out"
+    _convert(
+        dataset, output, backend=backend, cancel=cancel, progress_callback=_cancel_after_first_view
+    )
+    assert _convert(dataset, output, backend=backend, resume=True) == NVIEWS - 1
+    _assert_same_output(output, tmp_path / "full", backend)
+    # nothing is converted again once complete
+    assert _convert(dataset, output, backend=backend, resume=True) == 0
+    _assert_same_output(output, tmp_path / "full", backend)
+
+
+@pytest.mark.parametrize("backend", ["hdf5", "n5"])
+def test_resume_reconverts_changed_views(dataset, tmp_path, backend, capsys):
+    output = tmp_path / "out"
+    _convert(dataset, output, backend=backend)
+
+    # a changed file only reconverts the view it belongs to
+    first = sorted(dataset.glob("*.tif"))[0]
+    mtime = first.stat().st_mtime_ns + 10**9
+    os.utime(first, ns=(mtime, mtime))
+    assert _convert(dataset, output, backend=backend, resume=True) == 1
+
+    # the projection only affects the projected views
+    capsys.readouterr()
+    assert _convert(dataset, output, backend=backend, resume=True, project_func=np.mean) == NVIEWS
+    resumed = [line for line in capsys.readouterr().out.splitlines() if "Resuming" in line]
+    assert resumed == [f"Resuming: {NVIEWS} of {NVIEWS} views already converted"]
+
+    _convert(dataset, tmp_path / "full", backend=backend, project_func=np.mean)
+    _assert_same_output(output, tmp_path / "full", backend)
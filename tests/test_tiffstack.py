@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+import tifffile
+
+from um2bs.tiffstack import TiffStack
+
+
+@pytest.fixture(params=[None, "zlib"])
+def files(tmp_path, request):
+    """10 slices, uncompressed (memory-mapped) or compressed (decoded)"""
+    rng = np.random.default_rng(0)
+    names = []
+    for z in range(10):
+        name = str(tmp_path / f"slice{z:02d}.tif")
+        image = rng.integers(0, 4096, (12, 16), dtype=np.uint16)
+        tifffile.imwrite(name, image, compression=request.param)
+        names.append(name)
+    return names
+
+
+@pytest.mark.parametrize(
+    "key",
+    [
+        0,
+        9,
+        -1,
+        -10,
+        np.int64(3),
+        slice(None),
+        slice(2, 7, 2),
+        slice(None, None, -3),
+        slice(20, 30),
+        (4, slice(None, None, 4)),
+        (slice(1, 3), 5, slice(2, 10)),
+        [1, 8, 3],
+    ],
+)
+def test_indexing(files, key):
+    expected = tifffile.imread(files)
+    np.testing.assert_array_equal(TiffStack(files)[key], expected[key])
+
+
+@pytest.mark.parametrize("key", [10, 15, -11, (10, 0)])
+def test_out_of_range(files, key):
+    with pytest.raises(IndexError):
+        TiffStack(files)[key]
+
+
+def test_array(files):
+    stack = TiffStack(files)
+    assert stack.shape == (10, 12, 16)
+    np.testing.assert_array_equal(np.asarray(stack), tifffile.imread(files))
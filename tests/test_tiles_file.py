@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import REGEXES
+from um2bs.process_um_folder import um_mosaic_folder
+from um2bs.tiles_file import parse_positions, read_tiles_file
+
+LINES = ["[tiles]", "a.tif;0;(1.0, 2.0, 3.0)", "b.tif;0;[4.5, -5.0, 6e3]"]
+XYZ = [[1.0, 2.0, 3.0], [4.5, -5.0, 6000.0]]
+
+
+def _read(tmp_path, lines, newline="\n"):
+    filename = tmp_path / "tiles.txt"
+    filename.write_bytes(newline.join(lines).encode() + newline.encode())
+    return read_tiles_file(str(filename))
+
+
+def _assert_positions(tiles, filenames, xyz):
+    assert list(tiles.filenames) == filenames
+    assert tiles.xyz.dtype == np.float64
+    np.testing.assert_array_equal(tiles.xyz, xyz)
+
+
+def test_read_tiles_file(tmp_path):
+    tiles = _read(tmp_path, LINES + ["a.tif;0;(7.0, 8.0, 9.0)"])
+    # the first position of a file listed twice is used
+    _assert_positions(tiles, ["a.tif", "b.tif"], XYZ)
+    np.testing.assert_array_equal(tiles.lookup(["b.tif", "c.tif", "a.tif"]), [1, -1, 0])
+
+
+def test_missing_file(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        read_tiles_file(str(tmp_path / "tiles.txt"))
+
+
+def test_crlf_line_endings(tmp_path):
+    _assert_positions(_read(tmp_path, LINES, newline="\r\n"), ["a.tif", "b.tif"], XYZ)
+
+
+@pytest.mark.parametrize(
+    "extra", [(";extra", ";extra"), ("", ";x;y"), (";1;2", "")], ids=["all", "later", "first"]
+)
+def test_extra_columns_are_ignored(tmp_path, extra):
+    lines = [LINES[0]] + [line + suffix for line, suffix in zip(LINES[1:], extra)]
+    _assert_positions(_read(tmp_path, lines), ["a.tif", "b.tif"], XYZ)
+
+
+def test_empty_file(tmp_path):
+    _assert_positions(_read(tmp_path, LINES[:1]), [], np.empty((0, 3)))
+
+
+def test_positions_need_three_coordinates():
+    with pytest.raises(ValueError):
+        parse_positions(["(1.0, 2.0)", "(3.0, 4.0)"])
+
+
+def test_mosaic_reads_crlf_tiles_file(dataset):
+    expected = um_mosaic_folder(str(dataset), REGEXES, use_cache=False).df
+    tilefile = dataset / "tiles.txt"
+    tilefile.write_bytes(tilefile.read_bytes().replace(b"\n", b"\r\n"))
+    df = um_mosaic_folder(str(dataset), REGEXES, use_cache=False).df
+    pd.testing.assert_frame_equal(df, expected)
@@ -24,13 +24,13 @@ class WorkerSignals(QObject):
         `object` data returned from processing, anything
 
     progress
-        `int` indicating % progress 
+        `dict` progress event (see um2bs.instrumentation.ConversionMonitor)
 
     '''
     finished = pyqtSignal()
     error = pyqtSignal(tuple)
     result = pyqtSignal(object)
-    progress = pyqtSignal(int)
+    progress = pyqtSignal(object)
 
 
 class Worker(QRunnable):
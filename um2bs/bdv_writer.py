@@ -0,0 +1,770 @@
+# Incremental writer for Big Data Viewer / Big Stitcher HDF5 files
+#
+# The file layout (setup groups, resolutions/subdivisions, t#####/s##/#/cells,
+# int16 cells) and the XML header follow what npy2bdv produces, so that the
+# resulting projects open in BigStitcher exactly as before. In contrast to
+# npy2bdv, views can be written slab by slab along Z, including all of their
+# pyramid levels, so a whole stack never has to be held in memory.
+#
+# License BSD-3
+# Volker
+# .Hilsenstein @ monash
+# .edu
+
+import os
+import zlib
+import numpy as np
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree as ET
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
+from um2bs.instrumentation import StageClock
+
+# h5py is imported when a file is first opened, so that importing this module
+# (e.g. for COMPRESSIONS) does not load the HDF5 library
+if TYPE_CHECKING:
+    import h5py
+
+
+# Compression options for BdvWriter. blosc-*, lz4 and zstd are HDF5 filter
+# plugins; writing them requires the hdf5plugin package and reading them
+# requires the plugins to be available to BigStitcher's HDF5 library.
+COMPRESSIONS = ("none", "gzip", "lzf", "blosc-lz4", "blosc-zstd", "lz4", "zstd")
+
+# Data types that can be written. BDV stores 16 bit cells and interprets
+# them as unsigned, uint16 data is therefore stored with its bits unchanged.
+BDV_DTYPES = (np.dtype(np.int16), np.dtype(np.uint16))
+
+
+def h5py_compression_args(compression: Optional[str], level: Optional[int] = None) -> dict:
+    """Translates a compression name from COMPRESSIONS into h5py create_dataset arguments
+
+    Parameters
+    ----------
+    compression : str or None
+        one of COMPRESSIONS (None is the same as "none")
+    level : int, optional
+        compression level, ignored for lzf and lz4, by default None
+        (the codec's default level)
+
+    Returns
+    -------
+    dict
+        compression and compression_opts arguments for create_dataset
+    """
+    if compression is None or compression == "none":
+        return {}
+    if compression == "gzip":
+        return {"compression": "gzip", "compression_opts": level}
+    if compression == "lzf":
+        return {"compression": "lzf"}
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression}, must be one of {COMPRESSIONS}")
+    try:
+        import hdf5plugin
+    except ImportError:
+        raise ImportError(
+            f"Compression {compression} requires the hdf5plugin package (pip install hdf5plugin)"
+        )
+    if compression == "lz4":
+        return dict(hdf5plugin.LZ4())
+    if compression == "zstd":
+        return dict(hdf5plugin.Zstd(clevel=3 if level is None else level))
+    cname = compression.split("-")[1]
+    return dict(
+        hdf5plugin.Blosc(
+            cname=cname,
+            clevel=5 if level is None else level,
+            shuffle=hdf5plugin.Blosc.SHUFFLE,
+        )
+    )
+
+
+def downsample_mean(stack: np.ndarray, factors: Sequence[int]) -> np.ndarray:
+    """Downsamples a stack by averaging non-overlapping blocks
+
+    Edges that are not a multiple of the block size are padded with zeros
+    before averaging, which matches skimage.transform.downscale_local_mean
+    (as used by npy2bdv).
+
+    Parameters
+    ----------
+    stack : np.ndarray
+        3D (z,y,x) array
+    factors : Sequence[int]
+        downsampling factors in (z,y,x) order
+
+    Returns
+    -------
+    np.ndarray
+        downsampled stack (float64)
+    """
+    factors = tuple(int(f) for f in factors)
+    if all(f == 1 for f in factors):
+        return stack
+    pad = [(0, -s % f) for s, f in zip(stack.shape, factors)]
+    if any(p[1] for p in pad):
+        stack = np.pad(stack, pad, mode="constant")
+    nz, ny, nx = (s // f for s, f in zip(stack.shape, factors))
+    fz, fy, fx = factors
+    blocks = stack.reshape(nz, fz, ny, fy, nx, fx)
+    return blocks.mean(axis=(1, 3, 5))
+
+
+def _block_sum(stack: np.ndarray, factors: Sequence[int]) -> np.ndarray:
+    """Sums non-overlapping blocks (zero padded at the edges) into int64"""
+    pad = [(0, -s % f) for s, f in zip(stack.shape, factors)]
+    if any(p[1] for p in pad):
+        stack = np.pad(stack, pad, mode="constant")
+    nz, ny, nx = (s // f for s, f in zip(stack.shape, factors))
+    fz, fy, fx = factors
+    blocks = stack.reshape(nz, fz, ny, fy, nx, fx)
+    return blocks.sum(axis=(1, 3, 5), dtype=np.int64)
+
+
+def downsample_pyramid(stack: np.ndarray, subsamp: Sequence[Sequence[int]]) -> List[np.ndarray]:
+    """Computes all pyramid levels of a stack in the stack's dtype (int16 or uint16)
+
+    If the subsampling factors of consecutive levels are multiples of each
+    other (as usual), each level is computed from the block sums of the
+    previous one, so only the first downsampling step touches the full
+    resolution data. Since the block sums are exact, the result is identical
+    to applying downsample_mean to the full resolution stack for each level.
+
+    Parameters
+    ----------
+    stack : np.ndarray
+        3D (z,y,x) array
+    subsamp : Sequence[Sequence[int]]
+        (z,y,x) downsampling factors for each level
+
+    Returns
+    -------
+    List[np.ndarray]
+        one array per level, with the dtype of stack
+    """
+    dtype = stack.dtype
+    levels = []
+    sums = stack
+    previous = (1, 1, 1)
+    for factors in subsamp:
+        factors = tuple(int(f) for f in factors)
+        if all(f == 1 for f in factors):
+            levels.append(stack)
+        elif any(f % p for f, p in zip(factors, previous)):
+            levels.append(downsample_mean(stack, factors).astype(dtype))
+        else:
+            sums = _block_sum(sums, [f // p for f, p in zip(factors, previous)])
+            previous = factors
+            levels.append((sums / np.prod(factors)).astype(dtype))
+    return levels
+
+
+class BdvWriter:
+    def __init__(
+        self,
+        filename: str,
+        nchannels: int = 1,
+        nilluminations: int = 1,
+        ntiles: int = 1,
+        nangles: int = 1,
+        subsamp: Tuple[Tuple[int, int, int], ...] = ((1, 1, 1),),
+        blockdim: Tuple[Tuple[int, int, int], ...] = ((4, 256, 256),),
+        compression: Optional[str] = None,
+        compression_level: Optional[int] = None,
+        nthreads: Optional[int] = None,
+        mode: str = "w",
+        filename_xml: Optional[str] = None,
+    ):
+        """Writer for Big Data Viewer HDF5/XML file pairs
+
+        Pyramid levels are computed and compressed by a pool of threads.
+        For gzip and uncompressed files, chunks are encoded with zlib (at
+        the level of the dataset) and handed to HDF5 as they are (direct
+        chunk writes). The HDF5 deflate filter encodes chunks the same way,
+        but it may store a chunk that does not compress raw instead (with
+        the filter skipped, depending on the HDF5 version); direct writes
+        always store the zlib stream, which any HDF5 reader decodes. Other
+        compressions go through the HDF5 filter pipeline.
+
+        Other storage backends (see n5_writer.BdvN5Writer) subclass this
+        writer and override the methods that access the file: _open,
+        _write_setups_header, stored_views, retain_views, _create_level,
+        _write_level_data, _xml_image_loader, flush and close.
+
+        Parameters
+        ----------
+        filename : str
+            name of the .h5 file
+        nchannels : int, optional
+            number of channels, by default 1
+        nilluminations : int, optional
+            number of illumination directions, by default 1
+        ntiles : int, optional
+            number of tiles, by default 1
+        nangles : int, optional
+            number of angles, by default 1
+        subsamp : tuple of (z,y,x) tuples, optional
+            subsampling factors for each pyramid level, by default ((1, 1, 1),)
+        blockdim : tuple of (z,y,x) tuples, optional
+            HDF5 chunk size for each pyramid level. If fewer entries than
+            pyramid levels are given, the first one is used for all levels.
+        compression : str, optional
+            compression, one of COMPRESSIONS, by default None (uncompressed)
+        compression_level : int, optional
+            compression level for gzip (0-9), blosc (0-9) and zstd (1-22),
+            by default None (the codec's default)
+        nthreads : int, optional
+            number of threads for computing pyramids and compressing chunks,
+            by default None (number of CPUs)
+        mode : str, optional
+            "w" to create a new file (an existing one is overwritten) or "a"
+            to open an existing file and keep the image data it contains.
+            In mode "a" the views to keep are selected with retain_views.
+            By default "w"
+        filename_xml : str, optional
+            name of the .xml file, by default the .h5 file name with the
+            extension replaced by .xml
+        """
+        self.filename = str(filename)
+        if filename_xml is None:
+            filename_xml = os.path.splitext(self.filename)[0] + ".xml"
+        self.filename_xml = str(filename_xml)
+        self.nchannels = nchannels
+        self.nilluminations = nilluminations
+        self.ntiles = ntiles
+        self.nangles = nangles
+        self.nsetups = nchannels * nilluminations * ntiles * nangles
+        self.subsamp = np.asarray(subsamp, dtype=int)
+        if len(blockdim) < len(subsamp):
+            blockdim = (blockdim[0],) * len(subsamp)
+        self.chunks = np.asarray(blockdim, dtype=int)
+        self.nlevels = len(self.subsamp)
+        self.compression = None if compression == "none" else compression
+        self.compression_level = compression_level
+        # per view metadata, keyed by (time, setup), filled by new_view.
+        # The same setup can have a different translation at every timepoint.
+        self.stack_shapes: Dict[Tuple[int, int], Tuple[int, int, int]] = {}
+        self.affine_matrices: Dict[Tuple[int, int], np.ndarray] = {}
+        self.affine_names: Dict[Tuple[int, int], str] = {}
+        self.calibrations: Dict[Tuple[int, int], Tuple[float, float, float]] = {}
+        # per setup metadata
+        self.voxel_size_xyz: Dict[int, Tuple[float, float, float]] = {}
+        self.voxel_units: Dict[int, str] = {}
+        self.views_present = set()
+        self.nthreads = nthreads if nthreads is not None else (os.cpu_count() or 1)
+        self._pool = ThreadPoolExecutor(max_workers=self.nthreads)
+
+        assert mode in ("w", "a"), "mode must be 'w' or 'a'"
+        self._open(mode)
+        self._write_setups_header()
+
+    def _open(self, mode: str):
+        import h5py
+
+        self._compression_args = h5py_compression_args(self.compression, self.compression_level)
+        self.filename_h5 = self.filename
+        self._h5 = h5py.File(self.filename_h5, mode)
+
+    def _write_setups_header(self):
+        for key in list(self._h5):
+            if key.startswith("s"):
+                del self._h5[key]
+        for isetup in range(self.nsetups):
+            grp = self._h5.create_group(f"s{isetup:02d}")
+            grp.create_dataset(
+                "resolutions", data=np.flip(self.subsamp, 1), dtype="<f8"
+            )
+            grp.create_dataset(
+                "subdivisions", data=np.flip(self.chunks, 1), dtype="<i4"
+            )
+
+    def setup_id(
+        self, illumination: int = 0, channel: int = 0, tile: int = 0, angle: int = 0
+    ) -> int:
+        """Returns the setup id of a view (same numbering as npy2bdv)"""
+        return (
+            (illumination * self.nchannels + channel) * self.ntiles + tile
+        ) * self.nangles + angle
+
+    def _level_shape(self, shape: Sequence[int], ilevel: int) -> Tuple[int, ...]:
+        return tuple(-(-s // f) for s, f in zip(shape, self.subsamp[ilevel]))
+
+    def stored_views(self) -> Dict[Tuple[int, int], Tuple[int, ...]]:
+        """Returns {(time, setup): shape} of the views stored in the file"""
+        views = {}
+        for tkey in self._h5:
+            if not tkey.startswith("t"):
+                continue
+            for skey in self._h5[tkey]:
+                cells = self._h5[tkey][skey].get("0/cells")
+                if cells is not None:
+                    views[(int(tkey[1:]), int(skey[1:]))] = cells.shape
+        return views
+
+    def retain_views(self, mapping: Dict[Tuple[int, int], Tuple[int, int]]):
+        """Keeps the image data of some of the views stored in the file
+
+        Used with mode "a". The views listed as keys in mapping are moved to
+        the (time, setup) given as the value, all other stored views are
+        deleted. Note that HDF5 does not reclaim the space of deleted data
+        (use h5repack to compact the file).
+
+        Parameters
+        ----------
+        mapping : Dict[Tuple[int, int], Tuple[int, int]]
+            {(old time, old setup): (new time, new setup)}
+        """
+        # move in two steps, as old and new locations may overlap
+        tmp = self._h5.require_group("_retained")
+        for time, isetup in self.stored_views():
+            name = f"t{time:05d}/s{isetup:02d}"
+            if (time, isetup) in mapping:
+                self._h5.move(name, f"_retained/{time}_{isetup}")
+            else:
+                del self._h5[name]
+        for (time, isetup), (new_time, new_isetup) in mapping.items():
+            self._h5.require_group(f"t{new_time:05d}")
+            self._h5.move(
+                f"_retained/{time}_{isetup}", f"t{new_time:05d}/s{new_isetup:02d}"
+            )
+        del self._h5["_retained"]
+        for key in list(self._h5):
+            if key.startswith("t") and len(self._h5[key]) == 0:
+                del self._h5[key]
+
+    def new_view(
+        self,
+        shape: Tuple[int, int, int],
+        time: int = 0,
+        illumination: int = 0,
+        channel: int = 0,
+        tile: int = 0,
+        angle: int = 0,
+        m_affine: Optional[np.ndarray] = None,
+        name_affine: str = "manually defined",
+        voxel_size_xyz: Tuple[float, float, float] = (1, 1, 1),
+        voxel_units: str = "px",
+        calibration: Tuple[float, float, float] = (1, 1, 1),
+        allocate: bool = True,
+    ) -> int:
+        """Creates empty datasets for all pyramid levels of a view
+
+        The datasets are subsequently filled using append_slab. With
+        allocate=False, only the metadata of a view whose image data is
+        already stored in the file (see retain_views) is registered.
+
+        Returns
+        -------
+        int
+            setup id of the view
+        """
+        assert len(shape) == 3, "view shape must be (z,y,x)"
+        isetup = self.setup_id(illumination, channel, tile, angle)
+        if not allocate:
+            assert (time, isetup) in self.stored_views(), f"view {time}/{isetup} not in file"
+        for ilevel in range(self.nlevels if allocate else 0):
+            self._create_level(time, isetup, ilevel, self._level_shape(shape, ilevel))
+        view = (time, isetup)
+        self.stack_shapes[view] = tuple(shape)
+        if m_affine is not None:
+            self.affine_matrices[view] = m_affine.copy()
+            self.affine_names[view] = name_affine
+        self.calibrations[view] = calibration
+        self.voxel_size_xyz[isetup] = voxel_size_xyz
+        self.voxel_units[isetup] = voxel_units
+        self.views_present.add((time, isetup))
+        return isetup
+
+    def _create_level(self, time: int, isetup: int, ilevel: int, shape: Tuple[int, ...]):
+        """Creates the (empty) dataset of a pyramid level, replacing an existing one"""
+        grp = self._h5.require_group(f"t{time:05d}/s{isetup:02d}/{ilevel}")
+        if "cells" in grp:
+            del grp["cells"]
+        grp.create_dataset(
+            "cells",
+            shape=shape,
+            chunks=tuple(self.chunks[ilevel]),
+            maxshape=(None, None, None),
+            dtype="int16",
+            **self._compression_args,
+        )
+
+    def append_slab(
+        self,
+        slab: np.ndarray,
+        z_start: int,
+        time: int = 0,
+        illumination: int = 0,
+        channel: int = 0,
+        tile: int = 0,
+        angle: int = 0,
+        clock: Optional[StageClock] = None,
+    ):
+        """Writes a Z-slab of a view (created with new_view) into all pyramid levels
+
+        Parameters
+        ----------
+        slab : np.ndarray
+            (z,y,x) slab covering the full XY extent of the view, with a
+            dtype from BDV_DTYPES
+        z_start : int
+            Z index of the first slice of the slab within the view. Must
+            be a multiple of the Z subsampling factor of every pyramid level,
+            and only the last slab of a view may have a depth that is not.
+        clock : StageClock, optional
+            if set, the time spent computing the pyramid ("pyramid") and
+            compressing and writing it ("write", with the number of bytes
+            stored) is added to it. By default None
+        """
+        isetup = self.setup_id(illumination, channel, tile, angle)
+        assert (time, isetup) in self.views_present, "call new_view first"
+        assert slab.shape[1:] == self.stack_shapes[(time, isetup)][1:], "slab must span the whole view in XY"
+        assert slab.dtype in BDV_DTYPES, f"slab dtype must be one of {BDV_DTYPES}, not {slab.dtype}"
+        z_subsamp = self.subsamp[:, 0]
+        assert all(z_start % fz == 0 for fz in z_subsamp), (
+            f"slab start {z_start} not aligned to z subsampling {z_subsamp}"
+        )
+
+        # Compute the pyramid for Z-pieces of the slab in parallel. Pieces
+        # are aligned to all Z subsampling factors, so that they do not
+        # share any downsampled voxels.
+        nz = slab.shape[0]
+        z_align = int(np.lcm.reduce(z_subsamp))
+        piece_depth = -(-nz // self.nthreads)
+        piece_depth = max(z_align, -(-piece_depth // z_align) * z_align)
+        piece_starts = list(range(0, nz, piece_depth))
+        levels = [
+            np.empty(self._level_shape(slab.shape, ilevel), dtype=slab.dtype)
+            for ilevel in range(self.nlevels)
+        ]
+
+        def _piece_pyramid(piece_start):
+            piece = slab[piece_start : piece_start + piece_depth]
+            for ilevel, subdata in enumerate(downsample_pyramid(piece, self.subsamp)):
+                z0 = piece_start // z_subsamp[ilevel]
+                levels[ilevel][z0 : z0 + subdata.shape[0]] = subdata
+
+        clock = clock if clock is not None else StageClock()
+        with clock.time("pyramid", slab.nbytes):
+            list(self._pool.map(_piece_pyramid, piece_starts))
+
+        for ilevel, subdata in enumerate(levels):
+            t0 = perf_counter()
+            stored = self._write_level_data(
+                time, isetup, ilevel, subdata, z_start // z_subsamp[ilevel]
+            )
+            clock.add("write", perf_counter() - t0, stored)
+
+    def _write_level_data(
+        self, time: int, isetup: int, ilevel: int, data: np.ndarray, z0: int
+    ) -> int:
+        """Writes data at Z offset z0 into a pyramid level, returns the number of bytes stored"""
+        dataset = self._h5[f"t{time:05d}/s{isetup:02d}/{ilevel}/cells"]
+        stored = dataset.id.get_storage_size()
+        # store the bits of uint16 data unchanged (HDF5 would clip the values)
+        self._write_level(dataset, data.view(np.int16), z0)
+        return dataset.id.get_storage_size() - stored
+
+    def _write_level(self, dataset: "h5py.Dataset", data: np.ndarray, z0: int):
+        """Writes data at Z offset z0 into a dataset
+
+        Chunks that are completely covered by data are compressed in the
+        thread pool and written with direct chunk writes. Otherwise (e.g.
+        slabs that are not aligned to the chunk depth) the data is written
+        through the regular HDF5 filter pipeline.
+        """
+        cz, cy, cx = dataset.chunks
+        z1 = z0 + data.shape[0]
+        aligned = z0 % cz == 0 and (z1 % cz == 0 or z1 == dataset.shape[0])
+        if not aligned or self.compression not in (None, "gzip"):
+            dataset[z0:z1] = data
+            return
+
+        level = dataset.compression_opts
+        offsets = [
+            (z, y, x)
+            for z in range(z0, z1, cz)
+            for y in range(0, data.shape[1], cy)
+            for x in range(0, data.shape[2], cx)
+        ]
+
+        def _encode(offset):
+            z, y, x = offset
+            chunk = data[z - z0 : z - z0 + cz, y : y + cy, x : x + cx]
+            if chunk.shape != (cz, cy, cx):
+                # HDF5 stores edge chunks in full, padded with the fill value
+                padded = np.zeros((cz, cy, cx), dtype=data.dtype)
+                padded[: chunk.shape[0], : chunk.shape[1], : chunk.shape[2]] = chunk
+                chunk = padded
+            chunk = np.ascontiguousarray(chunk, dtype="<i2")
+            if self.compression == "gzip":
+                return zlib.compress(chunk, level)
+            return chunk.tobytes()
+
+        for offset, encoded in zip(offsets, self._pool.map(_encode, offsets)):
+            dataset.id.write_direct_chunk(offset, encoded)
+
+    def append_view(self, stack: np.ndarray, clock: Optional[StageClock] = None, **kwargs):
+        """Writes a whole (z,y,x) stack as a view. Accepts the keyword arguments of new_view."""
+        self.new_view(stack.shape, **kwargs)
+        slab_kwargs = {
+            k: kwargs[k]
+            for k in ("time", "illumination", "channel", "tile", "angle")
+            if k in kwargs
+        }
+        self.append_slab(stack, 0, clock=clock, **slab_kwargs)
+
+    def write_xml_file(self, ntimes: int = 1):
+        """Writes the XML header for the HDF5 file
+
+        Every view gets its own ViewRegistration. All views of a setup must
+        have the same shape, as BDV stores the size per setup.
+
+        Parameters
+        ----------
+        ntimes : int, optional
+            number of timepoints, by default 1
+        """
+        root = ET.Element("SpimData")
+        root.set("version", "0.2")
+        bp = ET.SubElement(root, "BasePath")
+        bp.set("type", "relative")
+        bp.text = "."
+
+        seqdesc = ET.SubElement(root, "SequenceDescription")
+        self._xml_image_loader(seqdesc)
+
+        setup_shapes = {}
+        for (time, isetup), shape in sorted(self.stack_shapes.items()):
+            if setup_shapes.setdefault(isetup, shape) != shape:
+                raise ValueError(
+                    f"views of setup {isetup} have different shapes "
+                    f"{setup_shapes[isetup]} and {shape} (timepoint {time})"
+                )
+
+        viewsets = ET.SubElement(seqdesc, "ViewSetups")
+        for isetup in sorted(setup_shapes):
+            illumination, rest = divmod(isetup, self.nchannels * self.ntiles * self.nangles)
+            channel, rest = divmod(rest, self.ntiles * self.nangles)
+            tile, angle = divmod(rest, self.nangles)
+            vs = ET.SubElement(viewsets, "ViewSetup")
+            ET.SubElement(vs, "id").text = str(isetup)
+            ET.SubElement(vs, "name").text = f"setup {isetup}"
+            nz, ny, nx = setup_shapes[isetup]
+            ET.SubElement(vs, "size").text = f"{nx} {ny} {nz}"
+            vox = ET.SubElement(vs, "voxelSize")
+            ET.SubElement(vox, "unit").text = self.voxel_units[isetup]
+            dx, dy, dz = self.voxel_size_xyz[isetup]
+            ET.SubElement(vox, "size").text = f"{dx} {dy} {dz}"
+            a = ET.SubElement(vs, "attributes")
+            ET.SubElement(a, "illumination").text = str(illumination)
+            ET.SubElement(a, "channel").text = str(channel)
+            ET.SubElement(a, "tile").text = str(tile)
+            ET.SubElement(a, "angle").text = str(angle)
+
+        counts = {
+            "illumination": self.nilluminations,
+            "channel": self.nchannels,
+            "tile": self.ntiles,
+            "angle": self.nangles,
+        }
+        for attribute, count in counts.items():
+            attrs = ET.SubElement(viewsets, "Attributes")
+            attrs.set("name", attribute)
+            for i in range(count):
+                att = ET.SubElement(attrs, attribute.capitalize())
+                ET.SubElement(att, "id").text = str(i)
+                ET.SubElement(att, "name").text = str(i)
+
+        tpoints = ET.SubElement(seqdesc, "Timepoints")
+        tpoints.set("type", "range")
+        ET.SubElement(tpoints, "first").text = "0"
+        ET.SubElement(tpoints, "last").text = str(ntimes - 1)
+
+        missing = [
+            (t, s)
+            for t in range(ntimes)
+            for s in sorted(setup_shapes)
+            if (t, s) not in self.views_present
+        ]
+        if missing:
+            miss_views = ET.SubElement(seqdesc, "MissingViews")
+            for t, s in missing:
+                miss_view = ET.SubElement(miss_views, "MissingView")
+                miss_view.set("timepoint", str(t))
+                miss_view.set("setup", str(s))
+
+        vregs = ET.SubElement(root, "ViewRegistrations")
+        for itime in range(ntimes):
+            for isetup in sorted(setup_shapes):
+                view = (itime, isetup)
+                if view not in self.views_present:
+                    continue
+                vreg = ET.SubElement(vregs, "ViewRegistration")
+                vreg.set("timepoint", str(itime))
+                vreg.set("setup", str(isetup))
+                if view in self.affine_matrices:
+                    vt = ET.SubElement(vreg, "ViewTransform")
+                    vt.set("type", "affine")
+                    ET.SubElement(vt, "Name").text = self.affine_names[view]
+                    ET.SubElement(vt, "affine").text = " ".join(
+                        f"{v:.6f}" for v in self.affine_matrices[view].flatten()
+                    )
+                vt = ET.SubElement(vreg, "ViewTransform")
+                vt.set("type", "affine")
+                ET.SubElement(vt, "Name").text = "calibration"
+                calx, caly, calz = self.calibrations[view]
+                ET.SubElement(vt, "affine").text = (
+                    f"{calx} 0.0 0.0 0.0 0.0 {caly} 0.0 0.0 0.0 0.0 {calz} 0.0"
+                )
+
+        _xml_indent(root)
+        ET.ElementTree(root).write(
+            self.filename_xml, xml_declaration=True, encoding="utf-8", method="xml"
+        )
+
+    def _xml_image_loader(self, seqdesc: ET.Element):
+        imgload = ET.SubElement(seqdesc, "ImageLoader")
+        imgload.set("format", "bdv.hdf5")
+        el = ET.SubElement(imgload, "hdf5")
+        el.set("type", "relative")
+        el.text = os.path.relpath(self.filename, os.path.dirname(os.path.abspath(self.filename_xml)))
+
+    def flush(self):
+        self._h5.flush()
+
+    def close(self):
+        self._pool.shutdown()
+        self._h5.flush()
+        self._h5.close()
+
+
+def _xml_indent(elem, level=0):
+    """Pretty printing for ElementTree (in place)"""
+    i = "\n" + level * "  "
+    if len(elem):
+        if not elem.text or not elem.text.strip():
+            elem.text = i + "  "
+        if not elem.tail or not elem.tail.strip():
+            elem.tail = i
+        for child in elem:
+            _xml_indent(child, level + 1)
+        if not child.tail or not child.tail.strip():
+            child.tail = i
+    else:
+        if level and (not elem.tail or not elem.tail.strip()):
+            elem.tail = i
+
+
+def merge_bdv_files(shard_files: Sequence[str], filename: str, link: bool = True):
+    """Merges BDV HDF5/XML pairs that each hold a subset of the views into one project
+
+    All shards must have been written with the same number of setups and
+    the same pyramid settings, e.g. by converting disjoint sets of tiles
+    with BdvWriter.
+
+    Parameters
+    ----------
+    shard_files : Sequence[str]
+        .h5 files of the shards (the .xml files are expected next to them)
+    filename : str
+        .h5 file of the merged project
+    link : bool, optional
+        if True, the merged .h5 file references the image data of the shards
+        through HDF5 external links, which is instantaneous but requires the
+        shard files to stay next to it. If False, the image data is copied.
+        By default True
+    """
+    import h5py
+
+    filename = str(filename)
+    outdir = os.path.dirname(os.path.abspath(filename))
+    with h5py.File(filename, "w") as merged:
+        for shard in map(str, shard_files):
+            with h5py.File(shard, "r") as f:
+                for key in f:
+                    if key.startswith("s"):
+                        # setup header, identical in all shards
+                        if key not in merged:
+                            f.copy(key, merged)
+                        continue
+                    timegroup = merged.require_group(key)
+                    for setup in f[key]:
+                        if link:
+                            relpath = os.path.relpath(os.path.abspath(shard), outdir)
+                            timegroup[setup] = h5py.ExternalLink(
+                                relpath, f"/{key}/{setup}"
+                            )
+                        else:
+                            f.copy(f"{key}/{setup}", timegroup)
+
+    merge_bdv_xml(
+        [os.path.splitext(shard)[0] + ".xml" for shard in map(str, shard_files)],
+        os.path.splitext(filename)[0] + ".xml",
+        container=os.path.basename(filename),
+    )
+
+
+def merge_bdv_xml(
+    shard_xml_files: Sequence[str], filename_xml: str, container: Optional[str] = None
+):
+    """Merges the XML files of shards into one XML file
+
+    Raises a ValueError if the shards give the same setup different sizes.
+
+    Parameters
+    ----------
+    shard_xml_files : Sequence[str]
+        .xml files of the shards
+    filename_xml : str
+        merged .xml file
+    container : str, optional
+        image data file (or N5 container) the merged XML refers to, by
+        default None (the one of the first shard, for shards that share a
+        container)
+    """
+    view_setups = {}
+    view_registrations = {}
+    root = None
+    for shard_xml in map(str, shard_xml_files):
+        shard_root = ET.parse(shard_xml).getroot()
+        if root is None:
+            root = shard_root
+        for vs in shard_root.iter("ViewSetup"):
+            isetup = int(vs.find("id").text)
+            size = vs.find("size").text
+            if isetup in view_setups and view_setups[isetup].find("size").text != size:
+                raise ValueError(
+                    f"setup {isetup} has size {view_setups[isetup].find('size').text} in one "
+                    f"shard and {size} in {shard_xml}, but BDV stores one size per setup"
+                )
+            view_setups[isetup] = vs
+        for vreg in shard_root.iter("ViewRegistration"):
+            key = (int(vreg.get("timepoint")), int(vreg.get("setup")))
+            view_registrations[key] = vreg
+
+    seqdesc = root.find("SequenceDescription")
+    if container is not None:
+        seqdesc.find("ImageLoader")[0].text = container
+    viewsets = seqdesc.find("ViewSetups")
+    for vs in viewsets.findall("ViewSetup"):
+        viewsets.remove(vs)
+    for position, isetup in enumerate(sorted(view_setups)):
+        viewsets.insert(position, view_setups[isetup])
+    missing = seqdesc.find("MissingViews")
+    if missing is not None:
+        seqdesc.remove(missing)
+    vregs = root.find("ViewRegistrations")
+    for vreg in vregs.findall("ViewRegistration"):
+        vregs.remove(vreg)
+    for key in sorted(view_registrations):
+        vregs.append(view_registrations[key])
+
+    _xml_indent(root)
+    ET.ElementTree(root).write(
+        str(filename_xml),
+        xml_declaration=True,
+        encoding="utf-8",
+        method="xml",
+    )
@@ -0,0 +1,490 @@
+# Command line interface for converting Ultramicroscope acquisitions
+# to Big Stitcher projects without the GUI, e.g. on a processing server
+#
+# License BSD-3
+# Volker
+# .Hilsenstein @ monash
+# .edu
+
+import sys
+import json
+import argparse
+import pathlib
+import traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, List, Optional, Tuple
+
+from um2bs.bdv_writer import COMPRESSIONS
+from um2bs.instrumentation import JsonLinesWriter
+from um2bs.fusion import FUSIONS
+from um2bs.preview import mosaic_overview
+from um2bs.tiffstack import TiffStack
+from um2bs.process_um_folder import (
+    BACKENDS,
+    um_mosaic_folder,
+    default_prefetch_depth,
+    merge_big_stitcher_shards,
+    _shared_content_threshold,
+)
+
+PROJECTIONS = {"max": np.max, "min": np.min, "mean": np.mean, "sum": np.sum}
+
+DEFAULT_REGEXES = {
+    "filewhitelist": ".*tif",
+    "Z": r"(?<=_C)\d+",
+    "ch": r"(?<=channel)\d+",
+    "illu": r"(?<=_Ill)[\da-zA-Z]+",
+}
+
+# job options that are passed on to generate_big_stitcher
+CONVERSION_OPTIONS = (
+    "projected",
+    "volume",
+    "xyspacing",
+    "zspacing",
+    "direction_x",
+    "direction_y",
+    "slab_depth",
+    "prefetch_depth",
+    "compression",
+    "compression_level",
+    "resume",
+    "backend",
+    "intensity",
+    "input_range",
+    "io_threads",
+    "decode_threads",
+    "readahead",
+    "skip_empty_tiles",
+    "trim_z",
+    "content_threshold",
+    "flatfield",
+    "darkframe",
+    "fuse_illuminations",
+)
+
+
+def first_stack_shape(mosaic: um_mosaic_folder) -> Tuple[int, int, int]:
+    """Returns the (z,y,x) shape of the first stack of a mosaic, only its first file is opened"""
+    first = mosaic.df["first_Z"].min()
+    return TiffStack(mosaic.df.loc[mosaic.df["first_Z"] == first, "pathname"].values).shape
+
+
+def estimate_memory(mosaic: um_mosaic_folder, shape: Tuple[int, int, int], options: dict) -> int:
+    """Rough estimate of the peak memory (bytes) of converting a mosaic
+
+    Based on the shape of the first tile (see first_stack_shape), the slab
+    depth and the read-ahead: prefetch_depth + 2 slabs (whole stacks if
+    there is no slab_depth) are held while reading ahead, see
+    default_prefetch_depth. Pyramid levels and compressed chunks are
+    accounted for as one additional slab. Fused views read the stacks of
+    all illuminations.
+    """
+    nz, ny, nx = shape
+    nillu = mosaic.df["illu"].nunique() if options.get("fuse_illuminations") else 1
+    if options.get("projected", True) and not options.get("volume", False):
+        # streamed projections only hold a few slices per thread
+        return ny * nx * 8 * 4 * nillu
+    depth = min(options.get("slab_depth") or nz, nz)
+    prefetch_depth = options.get("prefetch_depth")
+    if prefetch_depth is None:
+        prefetch_depth = default_prefetch_depth(options.get("slab_depth"))
+    return ny * nx * 2 * depth * (prefetch_depth + 3) * nillu
+
+
+def fit_slab_depth(
+    mosaic: um_mosaic_folder, shape: Tuple[int, int, int], options: dict, memory_budget: int
+) -> dict:
+    """Reduces the slab depth (in multiples of 64) until the estimated memory fits the budget"""
+    options = dict(options)
+    depth = options.get("slab_depth") or shape[0]
+    while estimate_memory(mosaic, shape, options) > memory_budget and depth > 64:
+        depth = max(64, (depth // 2) // 64 * 64)
+        options["slab_depth"] = depth
+    return options
+
+
+def _convert(mosaic: um_mosaic_folder, output: str, options: dict):
+    mosaic.generate_big_stitcher(output, **options)
+
+
+def run_jobs(
+    jobs: List[dict],
+    max_jobs: int = 1,
+    memory_budget: Optional[float] = None,
+    events: Optional[str] = None,
+) -> int:
+    """Converts a list of acquisition folders
+
+    Each job (folder) can be split into several shards. Shards of all jobs
+    are run by a pool of max_jobs processes, but only as many as fit into
+    the memory budget at the same time (at least one always runs). Once all
+    shards of a job are done, they are merged. If the shards skip or trim
+    tiles without a content_threshold, it is estimated once from all views
+    of the job beforehand.
+
+    Parameters
+    ----------
+    jobs : List[dict]
+        one dict per folder with the keys input, output, regexes, shards and
+        any of CONVERSION_OPTIONS as well as projection (a key of PROJECTIONS).
+        projected defaults to True and volume to False
+    max_jobs : int, optional
+        maximum number of shards converted at the same time, by default 1
+    memory_budget : float, optional
+        memory budget in bytes, by default None (unlimited)
+    events : str, optional
+        file to which the progress events of all jobs are appended as JSON
+        lines ("-" for stdout), tagged with the input folder and shard.
+        Failed jobs are reported as "failed" events. By default None
+
+    Returns
+    -------
+    int
+        number of failed jobs
+    """
+    failed = set()
+    tasks = []
+    job_options = {}
+
+    def _report(job, **event):
+        if events is not None:
+            JsonLinesWriter(events, input=job["input"])(event)
+    for job_nr, job in enumerate(jobs):
+        print(f"Scanning {job['input']}")
+        try:
+            mosaic = um_mosaic_folder(
+                job["input"], job["regexes"], use_cache=job.get("use_cache", True)
+            )
+            shape = first_stack_shape(mosaic)
+        except (Exception, SystemExit):
+            traceback.print_exc()
+            print(f"FAILED to scan {job['input']}")
+            _report(job, event="failed", stage="scan", error=traceback.format_exc())
+            failed.add(job_nr)
+            continue
+        options = {k: job[k] for k in CONVERSION_OPTIONS if k in job}
+        # resolved here, so that the conversion, the memory estimate and the
+        # merge of the shards all use the same projects
+        options.setdefault("projected", True)
+        options.setdefault("volume", False)
+        options["project_func"] = PROJECTIONS[job.get("projection", "max")]
+        if memory_budget is not None:
+            options = fit_slab_depth(mosaic, shape, options, memory_budget)
+        memory = estimate_memory(mosaic, shape, options)
+        shards = job.get("shards", 1)
+        try:
+            # estimated from all views, so that all shards skip and trim alike
+            options = _shared_content_threshold(mosaic, shards, options)
+        except Exception:
+            traceback.print_exc()
+            print(f"FAILED to estimate the content threshold of {job['input']}")
+            _report(job, event="failed", stage="scan", error=traceback.format_exc())
+            failed.add(job_nr)
+            continue
+        job_options[job_nr] = options
+        for shard_index in range(shards):
+            shard_options = dict(options)
+            if shards > 1:
+                shard_options["shard"] = (shard_index, shards)
+            if events is not None:
+                fields = dict(input=job["input"])
+                if shards > 1:
+                    fields["shard"] = shard_index
+                shard_options["progress_callback"] = JsonLinesWriter(events, **fields)
+            tasks.append((job_nr, mosaic, shard_options, memory))
+
+    remaining_shards = {job_nr: 0 for job_nr, *_ in tasks}
+    for job_nr, *_ in tasks:
+        remaining_shards[job_nr] += 1
+
+    running: Dict = {}
+    used_memory = 0
+    with ProcessPoolExecutor(max_workers=max_jobs) as p:
+        while tasks or running:
+            # submit as many tasks as fit into the memory budget
+            while tasks and len(running) < max_jobs:
+                job_nr, mosaic, options, memory = tasks[0]
+                fits = memory_budget is None or used_memory + memory <= memory_budget
+                if running and not fits:
+                    break
+                tasks.pop(0)
+                if job_nr in failed:
+                    continue
+                future = p.submit(_convert, mosaic, jobs[job_nr]["output"], options)
+                running[future] = (job_nr, memory)
+                used_memory += memory
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job_nr, memory = running.pop(future)
+                used_memory -= memory
+                remaining_shards[job_nr] -= 1
+                job = jobs[job_nr]
+                try:
+                    future.result()
+                except Exception:
+                    traceback.print_exc()
+                    print(f"FAILED to convert {job['input']}")
+                    _report(job, event="failed", stage="convert", error=traceback.format_exc())
+                    failed.add(job_nr)
+                    continue
+                if remaining_shards[job_nr] == 0 and job_nr not in failed:
+                    if job.get("shards", 1) > 1:
+                        options = job_options[job_nr]
+                        merge_big_stitcher_shards(
+                            job["output"],
+                            job["shards"],
+                            projected=options["projected"],
+                            volume=options["volume"],
+                            backend=options.get("backend", "hdf5"),
+                        )
+                    print(f"Finished {job['input']}")
+    return len(failed)
+
+
+def preview_jobs(jobs: List[dict]) -> int:
+    """Writes a low resolution overview of the tile layout of each job to <output>/overview.tif
+
+    Nothing is converted. Returns the number of failed jobs.
+    """
+    import tifffile
+
+    nfailed = 0
+    for job in jobs:
+        try:
+            mosaic = um_mosaic_folder(
+                job["input"], job["regexes"], use_cache=job.get("use_cache", True)
+            )
+            overview, boxes = mosaic_overview(
+                mosaic,
+                xyspacing=job.get("xyspacing", 1.0),
+                direction_x=job.get("direction_x", 1),
+                direction_y=job.get("direction_y", -1),
+            )
+        except (Exception, SystemExit):
+            traceback.print_exc()
+            print(f"FAILED to preview {job['input']}")
+            nfailed += 1
+            continue
+        output = pathlib.Path(job["output"])
+        output.mkdir(parents=True, exist_ok=True)
+        tifffile.imwrite(str(output / "overview.tif"), overview)
+        print(f"Wrote overview of {len(boxes)} tiles to {output / 'overview.tif'}")
+    return nfailed
+
+
+def read_job_file(filename: str) -> List[dict]:
+    """Reads a JSON job file
+
+    The file contains an optional "defaults" object with options shared by
+    all jobs and a list of "jobs", each with at least "input" and "output",
+    e.g.
+
+        {"defaults": {"xyspacing": 1.2, "zspacing": 5.0, "compression": "lzf",
+                      "regexes": {"Z": "(?<=_C)\\\\d+"}},
+         "jobs": [{"input": "/data/run1", "output": "/results/run1"},
+                  {"input": "/data/run2", "output": "/results/run2", "volume": true}]}
+
+    Regexes that are not given default to those of the GUI. As on the
+    command line, only the projected project is generated unless "volume"
+    is true. Jobs on temporary folders should set "use_cache" to false, so
+    the index of the folder is not cached in ~/.cache/um2bs.
+    """
+    with open(filename, "r") as f:
+        content = json.load(f)
+    defaults = content.get("defaults", {})
+    jobs = []
+    for job in content["jobs"]:
+        merged = {**defaults, **job}
+        merged["regexes"] = {
+            **DEFAULT_REGEXES,
+            **defaults.get("regexes", {}),
+            **job.get("regexes", {}),
+        }
+        jobs.append(merged)
+    return jobs
+
+
+def _image_or_constant(value: Optional[str]):
+    """A number given on the command line is a constant, anything else a file name"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="um2bs",
+        description="Convert Ultramicroscope acquisitions to Big Stitcher projects.",
+    )
+    parser.add_argument("inputs", nargs="*", help="acquisition folder(s)")
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="output folder. With several input folders, one sub-folder per input is created",
+    )
+    parser.add_argument("--job-file", help="JSON job file (see um2bs.cli.read_job_file)")
+    parser.add_argument("--re-filewhitelist", default=DEFAULT_REGEXES["filewhitelist"])
+    parser.add_argument("--re-Z", default=DEFAULT_REGEXES["Z"])
+    parser.add_argument("--re-ch", default=DEFAULT_REGEXES["ch"])
+    parser.add_argument("--re-illu", default=DEFAULT_REGEXES["illu"])
+    parser.add_argument(
+        "--re-T", help="regex for the timepoint of time-lapse acquisitions, e.g. '(?<=_T)\\d+'"
+    )
+    parser.add_argument("--xyspacing", type=float, default=1.0, help="um/pixel")
+    parser.add_argument("--zspacing", type=float, default=1.0, help="um/slice")
+    parser.add_argument("--direction-x", type=int, choices=(1, -1), default=1)
+    parser.add_argument("--direction-y", type=int, choices=(1, -1), default=-1)
+    parser.add_argument("--no-projected", dest="projected", action="store_false")
+    parser.add_argument("--volume", action="store_true")
+    parser.add_argument("--projection", choices=PROJECTIONS, default="max")
+    parser.add_argument("--backend", choices=BACKENDS, default="hdf5")
+    parser.add_argument("--compression", choices=COMPRESSIONS, default="gzip")
+    parser.add_argument("--compression-level", type=int)
+    parser.add_argument(
+        "--intensity",
+        choices=("clip", "rescale"),
+        default="clip",
+        help="conversion of images that are not 8/16 bit integers (see generate_big_stitcher)",
+    )
+    parser.add_argument("--input-range", type=float, nargs=2, metavar=("LOW", "HIGH"))
+    parser.add_argument("--slab-depth", type=int)
+    parser.add_argument(
+        "--prefetch-depth",
+        type=int,
+        help="slabs read ahead (default: 1 with --slab-depth, else 0)",
+    )
+    parser.add_argument(
+        "--io-threads", type=int, help="maximum number of files read at the same time"
+    )
+    parser.add_argument("--decode-threads", type=int, help="number of threads decoding files")
+    parser.add_argument(
+        "--readahead", type=int, help="number of files of the next tile read in advance"
+    )
+    parser.add_argument(
+        "--skip-empty-tiles",
+        action="store_true",
+        help="do not convert tiles that only contain background (fast pre-pass)",
+    )
+    parser.add_argument(
+        "--trim-z", action="store_true", help="trim the Z range of each tile to its content"
+    )
+    parser.add_argument(
+        "--content-threshold",
+        type=float,
+        help="slice brightness above which a slice contains the sample (default: estimated)",
+    )
+    parser.add_argument(
+        "--flatfield",
+        help="flat-field TIFF file for all views, or 'estimate' to estimate one per channel/illumination",
+    )
+    parser.add_argument(
+        "--darkframe", help="dark frame TIFF file or constant camera offset subtracted from all slices"
+    )
+    parser.add_argument(
+        "--fuse-illuminations",
+        choices=FUSIONS,
+        help="fuse the illuminations of each tile into a single view while reading",
+    )
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument(
+        "--no-cache",
+        dest="use_cache",
+        action="store_false",
+        help="do not cache the index of the input folders in ~/.cache/um2bs",
+    )
+    parser.add_argument(
+        "--preview",
+        action="store_true",
+        help="only write a low resolution overview of the tile layout to <output>/overview.tif",
+    )
+    parser.add_argument(
+        "--events",
+        help="append progress, timing and throughput events as JSON lines to this file ('-' for stdout)",
+    )
+    parser.add_argument(
+        "--shards", type=int, default=1, help="number of processes per folder"
+    )
+    parser.add_argument(
+        "--max-jobs",
+        type=int,
+        default=1,
+        help="maximum number of folders/shards converted at the same time",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        help="memory budget in GB; limits concurrent jobs and the slab depth",
+    )
+    args = parser.parse_args(argv)
+
+    jobs = read_job_file(args.job_file) if args.job_file else []
+    if args.inputs:
+        if not args.output:
+            parser.error("--output is required for input folders")
+        regexes = {
+            "filewhitelist": args.re_filewhitelist,
+            "Z": args.re_Z,
+            "ch": args.re_ch,
+            "illu": args.re_illu,
+        }
+        if args.re_T:
+            regexes["T"] = args.re_T
+        for folder in args.inputs:
+            output = pathlib.Path(args.output)
+            if len(args.inputs) > 1:
+                output = output / pathlib.Path(folder).name
+            jobs.append(
+                {
+                    "input": folder,
+                    "output": str(output),
+                    "regexes": regexes,
+                    "use_cache": args.use_cache,
+                    "projected": args.projected,
+                    "volume": args.volume,
+                    "projection": args.projection,
+                    "xyspacing": args.xyspacing,
+                    "zspacing": args.zspacing,
+                    "direction_x": args.direction_x,
+                    "direction_y": args.direction_y,
+                    "backend": args.backend,
+                    "compression": args.compression,
+                    "compression_level": args.compression_level,
+                    "intensity": args.intensity,
+                    "input_range": args.input_range,
+                    "slab_depth": args.slab_depth,
+                    "prefetch_depth": args.prefetch_depth,
+                    "io_threads": args.io_threads,
+                    "decode_threads": args.decode_threads,
+                    "readahead": args.readahead,
+                    "resume": args.resume,
+                    "skip_empty_tiles": args.skip_empty_tiles,
+                    "trim_z": args.trim_z,
+                    "content_threshold": args.content_threshold,
+                    "flatfield": args.flatfield,
+                    "darkframe": _image_or_constant(args.darkframe),
+                    "fuse_illuminations": args.fuse_illuminations,
+                    "shards": args.shards,
+                }
+            )
+    if not jobs:
+        parser.error("no input folders or job file given")
+
+    if args.preview:
+        sys.exit(1 if preview_jobs(jobs) else 0)
+
+    memory_budget = None if args.memory_budget is None else args.memory_budget * 1e9
+    nfailed = run_jobs(
+        jobs, max_jobs=args.max_jobs, memory_budget=memory_budget, events=args.events
+    )
+    if nfailed:
+        print(f"{nfailed} of {len(jobs)} jobs failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# Finding the tiles and Z ranges of a mosaic that contain the sample,
+# so that background-only tiles and slices need not be converted
+#
+# License BSD-3
+# Volker
+# .Hilsenstein @ monash
+# .edu
+
+import numpy as np
+from typing import List, Optional, Sequence, Tuple
+
+from um2bs.pipeline import ReaderPool, reader_pool
+from um2bs.tiffstack import TiffStack
+
+
+def slice_statistics(
+    stacks: Sequence[Sequence[str]],
+    xy_step: int = 8,
+    percentile: float = 99.9,
+    background_percentile: float = 50,
+    pool: Optional[ReaderPool] = None,
+) -> List[np.ndarray]:
+    """Computes the brightness and background level of every slice of every stack
+
+    Slices are read subsampled by xy_step in x and y (memory-mapped where
+    possible, see TiffStack), which is much faster than reading them fully.
+
+    Parameters
+    ----------
+    stacks : Sequence[Sequence[str]]
+        files (Z slices) of each stack
+    xy_step : int, optional
+        subsampling in x and y, by default 8
+    percentile : float, optional
+        the brightness is this percentile of the subsampled slice, which is
+        insensitive to a few hot pixels, by default 99.9
+    background_percentile : float, optional
+        the background level is this percentile of the subsampled slice,
+        by default 50 (the median, which is background as long as the
+        sample covers less than half of the slice)
+    pool : ReaderPool, optional
+        stacks are read by its decode threads, by default None (the shared
+        pool, see pipeline.reader_pool)
+
+    Returns
+    -------
+    List[np.ndarray]
+        one (z, 2) array per stack, with the brightness and the background
+        level of each slice
+    """
+    if pool is None:
+        pool = reader_pool()
+
+    def _statistics(files) -> np.ndarray:
+        stack = TiffStack(files)
+        return np.array(
+            [
+                np.percentile(stack[z, ::xy_step, ::xy_step], (percentile, background_percentile))
+                for z in range(len(stack))
+            ]
+        ).reshape(len(stack), 2)
+
+    return pool.map(_statistics, stacks)
+
+
+def estimate_threshold(statistics: Sequence[np.ndarray], factor: float = 2.0) -> float:
+    """Estimates the slice brightness above which a slice contains the sample
+
+    The background is estimated from the pixels rather than from the
+    brightness of the slices, so that it does not depend on how many slices
+    are empty: it is the 5th percentile of the background levels of all
+    slices (see slice_statistics), i.e. it assumes that a few percent of
+    the slices are mostly background. Slices brighter than factor times the
+    background are considered to contain the sample.
+    """
+    background = np.percentile(np.concatenate([stats[:, 1] for stats in statistics]), 5)
+    return float(factor * max(background, 1.0))
+
+
+def content_range(
+    statistics: np.ndarray, threshold: float, margin: int = 2
+) -> Optional[Tuple[int, int]]:
+    """Returns the range (start, stop) of slices brighter than threshold, None if there are none
+
+    statistics are those of a stack, see slice_statistics. The range is
+    widened by margin slices on either side, so that the dim edges of the
+    sample are kept.
+    """
+    (content,) = np.nonzero(statistics[:, 0] > threshold)
+    if len(content) == 0:
+        return None
+    return max(content[0] - margin, 0), min(content[-1] + 1 + margin, len(statistics))
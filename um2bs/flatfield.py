@@ -0,0 +1,144 @@
+# Flat-field and dark-frame correction of slices while they are read
+#
+# License BSD-3
+# Volker
+# .Hilsenstein @ monash
+# .edu
+
+import threading
+import numpy as np
+from typing import Callable, Optional, Sequence, Union
+
+from um2bs.tiffstack import TiffStack
+
+# an image, a TIFF file with an image, or (dark frame only) a constant
+ImageSpec = Union[np.ndarray, str, float]
+
+
+class FlatFieldCorrection:
+    def __init__(self, flat: Optional[ImageSpec] = None, dark: Optional[ImageSpec] = None):
+        """Corrects slices as (slice - dark) / flat
+
+        Parameters
+        ----------
+        flat : np.ndarray or str, optional
+            flat-field image or TIFF file (e.g. an average of images of a
+            homogeneous sample, with the dark frame subtracted). It is
+            normalized to a mean of 1, so that the corrected intensities stay
+            in the range of the input. By default None (no flat-field)
+        dark : np.ndarray, str or float, optional
+            dark frame (image or TIFF file) or constant camera offset,
+            by default None (0)
+        """
+        self.flat = None if flat is None else _load(flat).astype(np.float32)
+        if self.flat is not None:
+            self.flat /= self.flat.mean()
+        self.dark = np.float32(0) if dark is None else _load(dark).astype(np.float32)
+        self._scratch = threading.local()
+
+    def converter(
+        self, convert_func: Optional[Callable[[np.ndarray, np.ndarray], None]] = None
+    ) -> Callable[[np.ndarray, np.ndarray], None]:
+        """Returns a function(src, dst) for readstack/project_stack that corrects a slice
+
+        The correction is computed in a float32 buffer per thread. If
+        convert_func is given (e.g. a uint16_converter), the corrected
+        buffer is passed on to it, otherwise it is rounded and clipped to
+        the range of dst.
+        """
+
+        def _convert(src: np.ndarray, dst: np.ndarray):
+            buffer = getattr(self._scratch, "buffer", None)
+            if buffer is None or buffer.shape != src.shape:
+                buffer = self._scratch.buffer = np.empty(src.shape, dtype=np.float32)
+            np.subtract(src, self.dark, out=buffer, casting="unsafe")
+            if self.flat is not None:
+                np.divide(buffer, self.flat, out=buffer)
+            if convert_func is not None:
+                convert_func(buffer, dst)
+                return
+            np.rint(buffer, out=buffer)
+            info = np.iinfo(dst.dtype)
+            np.clip(buffer, info.min, info.max, out=dst, casting="unsafe")
+
+        return _convert
+
+
+def estimate_flatfield(
+    stacks: Sequence[Sequence[str]],
+    dark: Optional[ImageSpec] = None,
+    nslices: int = 64,
+    block: int = 16,
+) -> np.ndarray:
+    """Estimates a flat-field from a sample of slices of several tiles
+
+    nslices slices, spread evenly over all stacks and their Z ranges, are
+    averaged in blocks of block x block pixels. The median over the
+    samples suppresses the structure of the sample (which is at different
+    positions in different tiles) and keeps the intensity falloff of the
+    illumination, which is the same in all tiles. The result is smoothed
+    and interpolated back to full resolution.
+
+    This works best for mosaics of many tiles with sparse samples. For
+    dense samples, supply a flat-field acquired from a homogeneous sample.
+
+    Parameters
+    ----------
+    stacks : Sequence[Sequence[str]]
+        files of the stacks of one channel and illumination
+    dark : np.ndarray, str or float, optional
+        dark frame subtracted from the samples, by default None (0)
+    nslices : int, optional
+        number of slices sampled, by default 64
+    block : int, optional
+        block size in pixels, by default 16
+
+    Returns
+    -------
+    np.ndarray
+        float32 flat-field normalized to a mean of 1
+    """
+    dark = np.float32(0) if dark is None else _load(dark).astype(np.float32)
+    if len(stacks) > nslices:
+        stacks = [stacks[i] for i in np.linspace(0, len(stacks) - 1, nslices).astype(int)]
+    per_stack = max(1, -(-nslices // len(stacks)))
+    samples = []
+    for files in stacks:
+        stack = TiffStack(files)
+        for z in np.linspace(0, len(stack) - 1, per_stack + 2)[1:-1].round().astype(int):
+            image = stack[int(z)].astype(np.float32) - dark
+            samples.append(_block_mean(image, block))
+    coarse = np.median(np.stack(samples), axis=0)
+    flat = np.maximum(_interpolate(coarse, block, stack.shape[1:]), 1e-3 * coarse.max())
+    return (flat / flat.mean()).astype(np.float32)
+
+
+def _load(image: ImageSpec) -> np.ndarray:
+    if isinstance(image, str):
+        import tifffile
+
+        return tifffile.imread(image)
+    return np.asarray(image)
+
+
+def _block_mean(image: np.ndarray, block: int) -> np.ndarray:
+    """Means of the block x block blocks, incomplete blocks at the edges are dropped"""
+    ny, nx = image.shape[0] // block, image.shape[1] // block
+    return image[: ny * block, : nx * block].reshape(ny, block, nx, block).mean(axis=(1, 3))
+
+
+def _interpolate(coarse: np.ndarray, block: int, shape) -> np.ndarray:
+    """Bilinear interpolation of block means (at the block centres) to shape
+
+    Pixels outside of the outermost block centres get the value of the
+    nearest block, extrapolating could amplify the noise of edge blocks.
+    """
+    for axis, n in enumerate(shape):
+        pos = np.clip((np.arange(n) + 0.5) / block - 0.5, 0, coarse.shape[axis] - 1)
+        i0 = np.floor(pos).astype(int)
+        i1 = np.minimum(i0 + 1, coarse.shape[axis] - 1)
+        w = pos - i0
+        lo, hi = np.take(coarse, i0, axis=axis), np.take(coarse, i1, axis=axis)
+        w = w[:, np.newaxis] if axis == 0 else w[np.newaxis, :]
+        coarse = lo * (1 - w) + hi * w
+    return coarse
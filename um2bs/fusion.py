@@ -0,0 +1,90 @@
+# Fusion of the views of a tile acquired with different illumination
+# directions (e.g. left and right light sheets) into a single view
+#
+# License BSD-3
+# Volker
+# .Hilsenstein @ monash
+# .edu
+
+import numpy as np
+from typing import List, Optional, Sequence
+
+# supported fusion methods
+FUSIONS = ("max", "sigmoid")
+
+
+def illumination_weights(
+    names: Sequence[str], nx: int, width: float = 0.05
+) -> List[np.ndarray]:
+    """Returns the blending weight along x of each illumination for sigmoid fusion
+
+    Each light sheet is sharpest on the side it enters the sample from, so
+    the view illuminated from the left is weighted on the left half of the
+    image and vice versa, with a smooth sigmoidal transition in the middle.
+
+    Parameters
+    ----------
+    names : Sequence[str]
+        names of the two illuminations (as extracted by the illu regex).
+        If they contain "left" and "right" (in any case), these determine
+        the sides; otherwise the first illumination is assumed to come
+        from the left.
+    nx : int
+        width of the images
+    width : float, optional
+        width of the transition as a fraction of nx, by default 0.05
+
+    Returns
+    -------
+    List[np.ndarray]
+        one float32 array of shape (nx,) per illumination, summing to 1
+    """
+    assert len(names) == 2, "sigmoid fusion requires exactly two illuminations"
+    lowered = [name.lower() for name in names]
+    left = 1 if "left" in lowered[1] or "right" in lowered[0] else 0
+    x = np.arange(nx, dtype=np.float32)
+    from_left = 1 / (1 + np.exp((x - (nx - 1) / 2) / (width * nx)))
+    weights = [1 - from_left, 1 - from_left]
+    weights[left] = from_left
+    return [w.astype(np.float32) for w in weights]
+
+
+def fuse_stacks(
+    stacks: Sequence[np.ndarray], method: str = "max", weights: Optional[Sequence[np.ndarray]] = None
+) -> np.ndarray:
+    """Fuses (z,y,x) stacks of the same tile acquired with different illuminations
+
+    The fusion is done slice by slice and in place in the first stack, so
+    that apart from the stacks themselves only a slice-sized buffer is
+    needed.
+
+    Parameters
+    ----------
+    stacks : Sequence[np.ndarray]
+        stacks of the same shape and dtype, one per illumination
+    method : str, optional
+        "max" (maximum of the illuminations) or "sigmoid" (blend with the
+        weights along x, see illumination_weights), by default "max"
+    weights : Sequence[np.ndarray], optional
+        weights for "sigmoid", one (x,) array per stack
+
+    Returns
+    -------
+    np.ndarray
+        fused stack (the first of stacks)
+    """
+    assert method in FUSIONS, f"unknown fusion {method}, use one of {FUSIONS}"
+    fused = stacks[0]
+    if method == "max":
+        for stack in stacks[1:]:
+            np.maximum(fused, stack, out=fused)
+        return fused
+    info = np.iinfo(fused.dtype)
+    blended = np.empty(fused.shape[1:], dtype=np.float32)
+    for z in range(fused.shape[0]):
+        np.multiply(stacks[0][z], weights[0], out=blended)
+        for stack, weight in zip(stacks[1:], weights[1:]):
+            blended += stack[z] * weight
+        np.rint(blended, out=blended)
+        np.clip(blended, info.min, info.max, out=fused[z], casting="unsafe")
+    return fused
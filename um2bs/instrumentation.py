@@ -0,0 +1,193 @@
+# Timing and throughput instrumentation of conversions
+#
+# License BSD-3
+# Volker
+# .Hilsenstein @ monash
+# .edu
+
+import json
+import sys
+import time
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+# Stages of the conversion of a view, in pipeline order
+STAGES = ("read", "convert", "fuse", "project", "pyramid", "write")
+
+
+class StageClock:
+    def __init__(self):
+        """Thread-safe accumulator of seconds and bytes per stage"""
+        self.seconds: Dict[str, float] = {}
+        self.nbytes: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float, nbytes: int = 0):
+        with self._lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.nbytes[stage] = self.nbytes.get(stage, 0) + int(nbytes)
+
+    @contextmanager
+    def time(self, stage: str, nbytes: int = 0):
+        """Context manager that adds the time spent in the with block to stage"""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - t0, nbytes)
+
+    def add_shares(self, other: "StageClock", wall: float):
+        """Distributes wall seconds over the stages of other in proportion to their times
+
+        Used where several threads work on interleaved stages (e.g. decoding
+        and converting slices), so that the times added here still sum to
+        the wall time of the whole step.
+        """
+        total = sum(other.seconds.values())
+        for stage, seconds in other.seconds.items():
+            share = wall * seconds / total if total > 0 else 0.0
+            self.add(stage, share, other.nbytes.get(stage, 0))
+
+
+class ConversionMonitor:
+    def __init__(self, callback: Optional[Callable[[dict], None]] = None):
+        """Reports the progress, timings and throughput of a conversion as events
+
+        Every event is a dict with an "event" key:
+
+        start
+            nviews (number of views to convert) and any extra information
+        view
+            one per converted view: its key, done/nviews, percent, seconds
+            (wall time since the previous view finished), bytes_in (size of
+            the input files), bytes_out (compressed bytes written), mb_per_s
+            (input throughput), elapsed, eta (seconds) and stages, a dict of
+            {stage: {seconds, bytes, mb_per_s}} for the stages in STAGES
+        finished
+            elapsed, bytes_in, bytes_out, mb_per_s, the stage totals and any
+            extra information (e.g. cancelled)
+
+        Parameters
+        ----------
+        callback : Callable[[dict], None], optional
+            called with every event, by default None (events are only
+            summarized on the console)
+        """
+        self.callback = callback
+        self.nviews = 0
+        self.done = 0
+        self.clocks: Dict = {}
+        self.totals = StageClock()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._lock = threading.Lock()
+
+    def emit(self, event: dict):
+        if self.callback is not None:
+            self.callback(event)
+
+    def start(self, nviews: int, **info):
+        self.nviews = nviews
+        self.done = 0
+        self.t_start = self.t_last = time.perf_counter()
+        self.emit(dict(event="start", nviews=nviews, **info))
+
+    def clock(self, view) -> StageClock:
+        """Returns the StageClock of a view, creating it on first use"""
+        with self._lock:
+            if view not in self.clocks:
+                self.clocks[view] = StageClock()
+            return self.clocks[view]
+
+    def view_done(self, view, bytes_in: int, bytes_out: int, **info):
+        clock = self.clocks.pop(view, StageClock())
+        now = time.perf_counter()
+        seconds, self.t_last = now - self.t_last, now
+        elapsed = now - self.t_start
+        self.done += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        for stage, stage_seconds in clock.seconds.items():
+            self.totals.add(stage, stage_seconds, clock.nbytes[stage])
+        eta = elapsed / self.done * (self.nviews - self.done)
+        event = dict(
+            event="view",
+            view=view,
+            done=self.done,
+            nviews=self.nviews,
+            percent=100.0 * self.done / max(self.nviews, 1),
+            seconds=seconds,
+            bytes_in=bytes_in,
+            bytes_out=bytes_out,
+            mb_per_s=_mb_per_s(bytes_in, seconds),
+            elapsed=elapsed,
+            eta=eta,
+            stages=_stage_summary(clock),
+            **info,
+        )
+        print(
+            f"view {self.done}/{self.nviews} done in {seconds:.2f} s "
+            f"({event['mb_per_s']:.1f} MB/s, "
+            + ", ".join(f"{s} {v['seconds']:.2f} s" for s, v in event["stages"].items())
+            + f"), ETA {eta:.0f} s"
+        )
+        self.emit(event)
+
+    def finish(self, **info):
+        elapsed = time.perf_counter() - self.t_start
+        self.emit(
+            dict(
+                event="finished",
+                nviews=self.done,
+                elapsed=elapsed,
+                bytes_in=self.bytes_in,
+                bytes_out=self.bytes_out,
+                mb_per_s=_mb_per_s(self.bytes_in, elapsed),
+                stages=_stage_summary(self.totals),
+                **info,
+            )
+        )
+
+
+class JsonLinesWriter:
+    def __init__(self, filename: str = "-", **fields):
+        """Monitor callback that appends each event as a line of JSON
+
+        Parameters
+        ----------
+        filename : str, optional
+            file to append to, "-" for stdout, by default "-"
+        fields :
+            added to every event, e.g. the input folder
+        """
+        self.filename = filename
+        self.fields = fields
+
+    def __call__(self, event: dict):
+        line = json.dumps({**self.fields, **event}, default=str) + "\n"
+        if self.filename == "-":
+            sys.stdout.write(line)
+            sys.stdout.flush()
+        else:
+            # a single write per line, so that several processes can
+            # append to the same file
+            with open(self.filename, "a") as f:
+                f.write(line)
+
+
+def _mb_per_s(nbytes: int, seconds: float) -> float:
+    return nbytes / 1e6 / seconds if seconds > 0 else 0.0
+
+
+def _stage_summary(clock: StageClock) -> Dict[str, dict]:
+    order = [s for s in STAGES if s in clock.seconds]
+    order += [s for s in clock.seconds if s not in STAGES]
+    return {
+        stage: dict(
+            seconds=clock.seconds[stage],
+            bytes=clock.nbytes[stage],
+            mb_per_s=_mb_per_s(clock.nbytes[stage], clock.seconds[stage]),
+        )
+        for stage in order
+    }
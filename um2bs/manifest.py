@@ -0,0 +1,81 @@
+# Bookkeeping of converted views, used to resume interrupted conversions
+#
+# License BSD-3
+# Volker
+# .Hilsenstein @ monash
+# .edu
+
+import os
+import json
+import hashlib
+from typing import Dict, Optional, Sequence
+
+
+def input_checksum(files: Sequence[str], params: Sequence = ()) -> str:
+    """Checksum over the input files of a view and the conversion parameters
+
+    Files are identified by name, size and modification time, so the
+    checksum is cheap to compute and changes whenever a file is replaced.
+
+    Parameters
+    ----------
+    files : Sequence[str]
+        input files of the view
+    params : Sequence, optional
+        conversion parameters that affect the written image data
+        (e.g. compression, pyramid levels), by default ()
+
+    Returns
+    -------
+    str
+        hex digest
+    """
+    h = hashlib.sha1()
+    h.update(repr(tuple(params)).encode())
+    for f in files:
+        st = os.stat(f)
+        h.update(f"{os.path.basename(f)}:{st.st_size}:{st.st_mtime_ns};".encode())
+    return h.hexdigest()
+
+
+class ConversionManifest:
+    def __init__(self, h5name: str):
+        """Record of the views that have been completely written to a BDV HDF5 file
+
+        The manifest is stored as <h5 name>.manifest.json next to the HDF5
+        file. Each view is identified by a key (the name of the first Z slice
+        of its stack) and stores the checksum of its inputs as well as the
+        time point and setup it was written to.
+
+        Parameters
+        ----------
+        h5name : str
+            name of the HDF5 file the manifest belongs to
+        """
+        self.filename = os.path.splitext(str(h5name))[0] + ".manifest.json"
+        self.views: Dict[str, dict] = {}
+
+    def load(self):
+        if os.path.exists(self.filename):
+            with open(self.filename, "r") as f:
+                self.views = json.load(f)["views"]
+        else:
+            self.views = {}
+
+    def save(self):
+        # write to a temporary file first, so that an interruption never
+        # leaves a truncated manifest behind
+        tmpname = self.filename + ".tmp"
+        with open(tmpname, "w") as f:
+            json.dump({"views": self.views}, f, indent=1)
+        os.replace(tmpname, self.filename)
+
+    def completed(self, key: str, checksum: str) -> Optional[dict]:
+        """Returns the entry for a view if it has been written with the same inputs, else None"""
+        entry = self.views.get(key)
+        if entry is not None and entry["checksum"] == checksum:
+            return entry
+        return None
+
+    def add(self, key: str, checksum: str, **info):
+        self.views[key] = dict(checksum=checksum, **info)
@@ -0,0 +1,220 @@
+# Writer for Big Data Viewer N5/XML projects
+#
+# The N5 container follows the layout of BigDataViewer's bdv.n5 format
+# (setup<id>/timepoint<t>/s<level> datasets with downsamplingFactors), so
+# that the projects open in BigStitcher. Every block is a separate file,
+# which is encoded and written directly with numpy and gzip; no N5 library
+# is needed.
+#
+# License BSD-3
+# Volker
+# .Hilsenstein @ monash
+# .edu
+
+import os
+import gzip
+import json
+import shutil
+import numpy as np
+from xml.etree import ElementTree as ET
+from typing import Dict, Tuple
+
+from um2bs.bdv_writer import BdvWriter
+
+# Compressions that can be written to N5 containers
+N5_COMPRESSIONS = ("none", "gzip")
+
+
+class BdvN5Writer(BdvWriter):
+    def __init__(self, filename: str, *args, **kwargs):
+        """Writer for Big Data Viewer N5/XML projects
+
+        Takes the same arguments as BdvWriter, filename is the N5 container
+        (a directory, e.g. dataset.n5). Compression must be one of
+        N5_COMPRESSIONS.
+
+        In contrast to HDF5 files, every block is stored in its own file.
+        Blocks are compressed and written by the thread pool in parallel,
+        and several processes can write different views into the same
+        container at the same time (e.g. the shards of a conversion, each
+        with its own XML file, see filename_xml). Blocks are written to a
+        temporary file first and then renamed, so that a container that is
+        being written is readable at any time.
+
+        An existing container is never deleted: mode "w" only replaces the
+        views that are written, and retain_views does not remove views
+        that are not kept (they are merely no longer referenced by the XML).
+        """
+        super().__init__(filename, *args, **kwargs)
+
+    def _open(self, mode: str):
+        if self.compression not in (None, "gzip"):
+            raise ValueError(
+                f"compression {self.compression} is not supported for N5, use one of {N5_COMPRESSIONS}"
+            )
+        if self.compression == "gzip":
+            level = -1 if self.compression_level is None else self.compression_level
+            self._n5_compression = {"type": "gzip", "useZlib": False, "level": level}
+        else:
+            self._n5_compression = {"type": "raw"}
+        os.makedirs(self.filename, exist_ok=True)
+        _write_json(os.path.join(self.filename, "attributes.json"), {"n5": "2.5.1"})
+
+    def _write_setups_header(self):
+        for isetup in range(self.nsetups):
+            _write_json(
+                self._path(f"setup{isetup}", "attributes.json"),
+                {
+                    "downsamplingFactors": np.flip(self.subsamp, 1).tolist(),
+                    "dataType": "uint16",
+                },
+            )
+
+    def _path(self, *parts) -> str:
+        return os.path.join(self.filename, *map(str, parts))
+
+    def _level_path(self, time: int, isetup: int, ilevel: int) -> str:
+        return self._path(f"setup{isetup}", f"timepoint{time}", f"s{ilevel}")
+
+    def stored_views(self) -> Dict[Tuple[int, int], Tuple[int, ...]]:
+        """Returns {(time, setup): shape} of the views stored in the container"""
+        views = {}
+        for setup_entry in os.scandir(self.filename):
+            if not (setup_entry.is_dir() and setup_entry.name.startswith("setup")):
+                continue
+            for time_entry in os.scandir(setup_entry.path):
+                attributes = os.path.join(time_entry.path, "s0", "attributes.json")
+                if time_entry.name.startswith("timepoint") and os.path.exists(attributes):
+                    with open(attributes, "r") as f:
+                        dimensions = json.load(f)["dimensions"]
+                    key = (int(time_entry.name[9:]), int(setup_entry.name[5:]))
+                    views[key] = tuple(reversed(dimensions))
+        return views
+
+    def retain_views(self, mapping: Dict[Tuple[int, int], Tuple[int, int]]):
+        """Moves the views listed as keys in mapping to the (time, setup) given as the value
+
+        Unlike BdvWriter.retain_views, views that are not listed are left
+        in place, as they may belong to another writer sharing the container.
+        """
+        moves = {old: new for old, new in mapping.items() if old != new}
+        # move in two steps, as old and new locations may overlap
+        tmp = self._path("_retained")
+        os.makedirs(tmp, exist_ok=True)
+        for time, isetup in moves:
+            os.replace(
+                self._path(f"setup{isetup}", f"timepoint{time}"),
+                os.path.join(tmp, f"{time}_{isetup}"),
+            )
+        for (time, isetup), (new_time, new_isetup) in moves.items():
+            target = self._path(f"setup{new_isetup}", f"timepoint{new_time}")
+            if os.path.exists(target):
+                shutil.rmtree(target)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(os.path.join(tmp, f"{time}_{isetup}"), target)
+        os.rmdir(tmp)
+
+    def _create_level(self, time: int, isetup: int, ilevel: int, shape: Tuple[int, ...]):
+        path = self._level_path(time, isetup, ilevel)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        _write_json(
+            os.path.join(path, "attributes.json"),
+            {
+                "dimensions": [int(s) for s in reversed(shape)],
+                "blockSize": np.flip(self.chunks[ilevel]).tolist(),
+                "dataType": "uint16",
+                "compression": self._n5_compression,
+                "downsamplingFactors": np.flip(self.subsamp[ilevel]).tolist(),
+            },
+        )
+
+    def _write_level_data(
+        self, time: int, isetup: int, ilevel: int, data: np.ndarray, z0: int
+    ) -> int:
+        path = self._level_path(time, isetup, ilevel)
+        shape = self._level_shape(self.stack_shapes[(time, isetup)], ilevel)
+        cz, cy, cx = self.chunks[ilevel]
+        z1 = z0 + data.shape[0]
+        blocks = [
+            (bz, by, bx)
+            for bz in range(z0 // cz, -(-z1 // cz))
+            for by in range(-(-data.shape[1] // cy))
+            for bx in range(-(-data.shape[2] // cx))
+        ]
+
+        def _write_block(block):
+            bz, by, bx = block
+            # extent of the block, N5 stores truncated blocks at the edges
+            zb0, zb1 = bz * cz, min((bz + 1) * cz, shape[0])
+            ys = slice(by * cy, (by + 1) * cy)
+            xs = slice(bx * cx, (bx + 1) * cx)
+            blockfile = os.path.join(path, str(bx), str(by), str(bz))
+            if z0 <= zb0 and zb1 <= z1:
+                values = data[zb0 - z0 : zb1 - z0, ys, xs]
+            else:
+                # block only partially covered by data, merge with what is stored
+                values = _read_block(blockfile, self._n5_compression)
+                if values is None:
+                    values = np.zeros((zb1 - zb0,) + data[:, ys, xs].shape[1:], np.uint16)
+                lo, hi = max(zb0, z0), min(zb1, z1)
+                values[lo - zb0 : hi - zb0] = data[lo - z0 : hi - z0, ys, xs].view(np.uint16)
+            encoded = _encode_block(values, self._n5_compression)
+            os.makedirs(os.path.dirname(blockfile), exist_ok=True)
+            tmpname = f"{blockfile}.{os.getpid()}.tmp"
+            with open(tmpname, "wb") as f:
+                f.write(encoded)
+            os.replace(tmpname, blockfile)
+            return len(encoded)
+
+        return sum(self._pool.map(_write_block, blocks))
+
+    def _xml_image_loader(self, seqdesc: ET.Element):
+        imgload = ET.SubElement(seqdesc, "ImageLoader")
+        imgload.set("format", "bdv.n5")
+        imgload.set("version", "1.0")
+        el = ET.SubElement(imgload, "n5")
+        el.set("type", "relative")
+        el.text = os.path.relpath(self.filename, os.path.dirname(os.path.abspath(self.filename_xml)))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._pool.shutdown()
+
+
+def _write_json(filename: str, content: dict):
+    tmpname = f"{filename}.{os.getpid()}.tmp"
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(tmpname, "w") as f:
+        json.dump(content, f)
+    os.replace(tmpname, filename)
+
+
+def _encode_block(values: np.ndarray, compression: dict) -> bytes:
+    """Encodes a (z,y,x) block as an N5 block (default mode, big endian)"""
+    header = np.array([0, values.ndim], dtype=">u2").tobytes()
+    header += np.array(values.shape[::-1], dtype=">u4").tobytes()
+    # int16 pyramid data is stored as uint16 with the same bits, as BDV
+    # interprets the int16 values of HDF5 files as unsigned
+    payload = np.ascontiguousarray(values).view(np.uint16).astype(">u2").tobytes()
+    if compression["type"] == "gzip":
+        level = compression["level"] if compression["level"] >= 0 else 6
+        payload = gzip.compress(payload, level, mtime=0)
+    return header + payload
+
+
+def _read_block(blockfile: str, compression: dict):
+    """Reads an N5 block written by _encode_block, None if it does not exist"""
+    if not os.path.exists(blockfile):
+        return None
+    with open(blockfile, "rb") as f:
+        content = f.read()
+    ndim = int(np.frombuffer(content, ">u2", 1, 2)[0])
+    shape = tuple(np.frombuffer(content, ">u4", ndim, 4)[::-1])
+    payload = content[4 + 4 * ndim :]
+    if compression["type"] == "gzip":
+        payload = gzip.decompress(payload)
+    return np.frombuffer(payload, ">u2").reshape(shape).astype(np.uint16)
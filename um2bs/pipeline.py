@@ -0,0 +1,225 @@
+# Helpers for overlapping reading with processing/writing
+#
+# License BSD-3
+# Volker
+# .Hilsenstein @ monash
+# .edu
+
+import os
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+_DONE = object()
+
+
+def prefetch(
+    load: Callable[[Any], Any], items: Iterable[Any], depth: int = 1
+) -> Iterator[Tuple[Any, Any]]:
+    """Yields (item, load(item)) for all items, loading ahead in a background thread
+
+    While the caller processes one item, the following items are loaded
+    by a reader thread and placed into a queue of at most depth entries.
+    At most depth + 2 loaded items are therefore alive at any time (one
+    being processed, depth queued and one waiting to be queued).
+
+    Parameters
+    ----------
+    load : Callable
+        function that loads an item, e.g. reads a slab of files
+    items : Iterable
+        items to load, in order
+    depth : int, optional
+        number of items to load ahead. If 0, items are loaded
+        sequentially in the calling thread. By default 1
+
+    Yields
+    ------
+    Tuple[Any, Any]
+        item and the result of load(item)
+    """
+    if depth < 1:
+        for item in items:
+            yield item, load(item)
+        return
+
+    results: queue.Queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def _put(entry) -> bool:
+        # retry with a timeout, so that the reader does not block forever
+        # if the consumer has stopped iterating
+        while not stop.is_set():
+            try:
+                results.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _reader():
+        try:
+            for item in items:
+                if not _put((item, load(item), None)):
+                    return
+        except BaseException as e:
+            _put((None, None, e))
+            return
+        _put(_DONE)
+
+    reader = threading.Thread(target=_reader, name="um2bs-prefetch", daemon=True)
+    reader.start()
+    try:
+        while True:
+            entry = results.get()
+            if entry is _DONE:
+                break
+            item, loaded, error = entry
+            if error is not None:
+                raise error
+            # drop our reference before waiting for the next item
+            entry = None
+            yield item, loaded
+    finally:
+        stop.set()
+        reader.join()
+
+
+class ReaderPool:
+    def __init__(
+        self,
+        io_threads: Optional[int] = None,
+        decode_threads: Optional[int] = None,
+        readahead: int = 0,
+    ):
+        """Long-lived thread pools for reading and decoding image files
+
+        Reading files (I/O) and decoding them are done by separate pools,
+        so that the number of reads in flight can be tuned to the storage
+        (e.g. a few for a local disk, more for a network file system)
+        independently of the number of CPUs used for decoding. The I/O
+        threads only read files into the operating system's page cache
+        (the data is discarded), the decode threads then decode them from
+        their path straight into the output arrays. No file contents are
+        therefore held in memory by the pool, however far it reads ahead.
+
+        Parameters
+        ----------
+        io_threads : int, optional
+            maximum number of files read at the same time, by default None
+            (8)
+        decode_threads : int, optional
+            number of threads decoding files, by default None (number of
+            CPUs)
+        readahead : int, optional
+            number of files of the next tile/slab that are read while the
+            current one is processed (see read_ahead), by default 0
+        """
+        self.io_threads = io_threads or 8
+        self.decode_threads = decode_threads or os.cpu_count() or 1
+        self.readahead = readahead
+        self._io = ThreadPoolExecutor(self.io_threads, thread_name_prefix="um2bs-io")
+        self._decode = ThreadPoolExecutor(self.decode_threads, thread_name_prefix="um2bs-decode")
+        self._ahead: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def settings(self) -> Tuple[int, int, int]:
+        return self.io_threads, self.decode_threads, self.readahead
+
+    def fetch(self, filename: str) -> Future:
+        """Returns a future that is done once a file has been read into the page cache,
+        reusing a read-ahead if there is one"""
+        with self._lock:
+            future = self._ahead.pop(filename, None)
+        if future is None:
+            future = self._io.submit(_warm_file, filename)
+        return future
+
+    def read_ahead(self, files: Sequence[str]):
+        """Starts reading files that will be fetched later"""
+        with self._lock:
+            for filename in files:
+                if filename not in self._ahead:
+                    self._ahead[filename] = self._io.submit(_warm_file, filename)
+
+    def discard(self):
+        """Drops read-ahead files that have not been fetched"""
+        with self._lock:
+            for future in self._ahead.values():
+                future.cancel()
+            self._ahead.clear()
+
+    def map(self, func: Callable, items: Iterable) -> List:
+        """Applies func to all items in the decode threads, returns the results in order"""
+        return list(self._decode.map(func, items))
+
+    def shutdown(self):
+        self.discard()
+        self._io.shutdown()
+        self._decode.shutdown()
+
+
+# size of the blocks in which _warm_file reads files
+_WARM_BLOCKSIZE = 1 << 20
+
+
+def _warm_file(filename: str) -> int:
+    """Reads a file into the page cache and discards it, returns its size"""
+    buffer = bytearray(_WARM_BLOCKSIZE)
+    nbytes = 0
+    with open(filename, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                return nbytes
+            nbytes += n
+
+
+# pools by their settings, and the settings of the pool requested last
+_shared_pools: Dict[Tuple[int, int, int], ReaderPool] = {}
+_current_settings: Optional[Tuple[int, int, int]] = None
+_shared_pool_lock = threading.Lock()
+
+
+def _reset_shared_pool():
+    # threads do not survive fork, a forked child (e.g. a worker of a
+    # ProcessPoolExecutor) creates its own pools
+    global _shared_pools, _current_settings, _shared_pool_lock
+    _shared_pools = {}
+    _current_settings = None
+    _shared_pool_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_shared_pool)
+
+
+def reader_pool(
+    io_threads: Optional[int] = None,
+    decode_threads: Optional[int] = None,
+    readahead: Optional[int] = None,
+) -> ReaderPool:
+    """Returns a reader pool shared by all conversions in this process
+
+    Pools are created on first use and kept for the lifetime of the
+    process, one per distinct settings. Conversions that request different
+    settings (e.g. two conversions started from the GUI at the same time)
+    thus get different pools, and a pool is never shut down while another
+    conversion is still using it. Arguments that are None keep the setting
+    of the pool requested last.
+    """
+    global _current_settings
+    with _shared_pool_lock:
+        if _current_settings is None:
+            default = ReaderPool()
+            _current_settings = default.settings()
+            _shared_pools[_current_settings] = default
+        requested = tuple(
+            c if r is None else r
+            for c, r in zip(_current_settings, (io_threads, decode_threads, readahead))
+        )
+        if requested not in _shared_pools:
+            _shared_pools[requested] = ReaderPool(*requested)
+        _current_settings = requested
+        return _shared_pools[requested]
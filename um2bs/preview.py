@@ -0,0 +1,140 @@
+# Low resolution overviews of a mosaic, to check the tile layout
+# (regexes, direction_x/direction_y) before converting it
+#
+# License BSD-3
+# Volker
+# .Hilsenstein @ monash
+# .edu
+
+import numpy as np
+from typing import TYPE_CHECKING, Callable, List, Optional, Tuple
+
+from um2bs.pipeline import ReaderPool, reader_pool
+from um2bs.tiffstack import TiffStack
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+def read_thumbnails(
+    layout: "pd.DataFrame",
+    z_step: int = 16,
+    xy_step: int = 8,
+    project_func: Callable = np.max,
+    pool: Optional[ReaderPool] = None,
+) -> List[np.ndarray]:
+    """Reads a projected, subsampled thumbnail of every stack in layout
+
+    Only every z_step-th slice is read, and of these only every
+    xy_step-th pixel in x and y. Uncompressed slices are memory-mapped
+    (see TiffStack), so that only the bytes of the selected pixels are read.
+
+    Parameters
+    ----------
+    layout : pd.DataFrame
+        stacks as returned by um_mosaic_folder.stack_layout
+    z_step : int, optional
+        Z subsampling, by default 16
+    xy_step : int, optional
+        subsampling in x and y, by default 8
+    project_func : Callable, optional
+        projection along Z, by default np.max
+    pool : ReaderPool, optional
+        stacks are read by its decode threads, by default None (the shared
+        pool, see pipeline.reader_pool)
+
+    Returns
+    -------
+    List[np.ndarray]
+        one (y,x) thumbnail per row of layout
+    """
+    if pool is None:
+        pool = reader_pool()
+
+    def _thumbnail(files) -> np.ndarray:
+        sampled = TiffStack(files)[::z_step, ::xy_step, ::xy_step]
+        return project_func(sampled, axis=0)
+
+    return pool.map(_thumbnail, layout["files"])
+
+
+def render_overview(
+    layout: "pd.DataFrame", thumbnails: List[np.ndarray], xy_step: int = 8
+) -> Tuple[np.ndarray, "pd.DataFrame"]:
+    """Places thumbnails at the positions of their tiles
+
+    Overlapping tiles are combined with their maximum.
+
+    Parameters
+    ----------
+    layout : pd.DataFrame
+        stacks as returned by um_mosaic_folder.stack_layout
+    thumbnails : List[np.ndarray]
+        one thumbnail per row of layout, see read_thumbnails
+    xy_step : int, optional
+        subsampling of the thumbnails, by default 8
+
+    Returns
+    -------
+    Tuple[np.ndarray, pd.DataFrame]
+        the overview image and a copy of layout with the columns oy, ox
+        (top left corner of the tile in the overview), ony and onx (size of
+        the thumbnail)
+    """
+    boxes = layout.copy()
+    boxes["oy"] = np.round((layout["y"] - layout["y"].min()) / xy_step).astype(int)
+    boxes["ox"] = np.round((layout["x"] - layout["x"].min()) / xy_step).astype(int)
+    boxes["ony"] = [t.shape[0] for t in thumbnails]
+    boxes["onx"] = [t.shape[1] for t in thumbnails]
+    shape = ((boxes["oy"] + boxes["ony"]).max(), (boxes["ox"] + boxes["onx"]).max())
+    overview = np.zeros(shape, dtype=np.result_type(*set(t.dtype for t in thumbnails)))
+    for (oy, ox), thumbnail in zip(boxes[["oy", "ox"]].values, thumbnails):
+        region = overview[oy : oy + thumbnail.shape[0], ox : ox + thumbnail.shape[1]]
+        np.maximum(region, thumbnail, out=region)
+    return overview, boxes
+
+
+def mosaic_overview(
+    mosaic,
+    xyspacing: float = 1.0,
+    direction_x: int = 1,
+    direction_y: int = -1,
+    z_step: int = 16,
+    xy_step: int = 8,
+    channel: int = 0,
+    illumination: int = 0,
+    time: int = 0,
+    project_func: Callable = np.max,
+) -> Tuple[np.ndarray, "pd.DataFrame"]:
+    """Renders a low resolution stitched overview of a mosaic
+
+    The tiles are placed using the stage positions in the same way as by
+    generate_big_stitcher, so the overview shows whether the regexes and
+    direction_x/direction_y produce a sensible layout, within seconds
+    instead of a full projected export. No stitching is performed.
+
+    Parameters
+    ----------
+    mosaic : um_mosaic_folder
+        the scanned folder
+    xyspacing, direction_x, direction_y :
+        as for generate_big_stitcher
+    z_step, xy_step, project_func :
+        see read_thumbnails
+    channel, illumination, time : int, optional
+        view to show (indices as in the Big Stitcher project), by default 0
+
+    Returns
+    -------
+    Tuple[np.ndarray, pd.DataFrame]
+        overview image and tile boxes, see render_overview
+    """
+    layout = mosaic.stack_layout(xyspacing, direction_x, direction_y)
+    layout = layout[
+        (layout["channel"] == channel)
+        & (layout["illumination"] == illumination)
+        & (layout["time"] == time)
+    ]
+    assert len(layout) > 0, "no stacks for this channel/illumination/timepoint"
+    thumbnails = read_thumbnails(layout, z_step, xy_step, project_func)
+    return render_overview(layout, thumbnails, xy_step)
@@ -7,62 +7,377 @@
 # .edu
 
 import re
+import os
 import pathlib
+import tempfile
+import json
+import hashlib
 import numpy as np
-import pandas as pd
 import time
-import npy2bdv
-import skimage.io
-from functools import partial
-from concurrent.futures import ThreadPoolExecutor
-from typing import Union, List, Dict
-import tifffile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, Callable, Union, List, Dict, Optional, Sequence, Tuple
 import warnings
+from um2bs.bdv_writer import BdvWriter, merge_bdv_files, merge_bdv_xml, COMPRESSIONS
+from um2bs.n5_writer import BdvN5Writer
+from um2bs.pipeline import prefetch, reader_pool, ReaderPool
+from um2bs.manifest import ConversionManifest, input_checksum
+from um2bs.tiffstack import TiffStack
+from um2bs.content import slice_statistics, estimate_threshold, content_range
+from um2bs.flatfield import FlatFieldCorrection, estimate_flatfield
+from um2bs.fusion import FUSIONS, fuse_stacks, illumination_weights
+from um2bs.instrumentation import ConversionMonitor, StageClock
 
+# pandas and tifffile are imported where they are first used. Scanning a
+# folder (um_mosaic_folder, stack_layout) only needs pandas, and none of the
+# heavy modules are loaded by just importing this module (e.g. by the GUI).
+# h5py is only loaded once a BDV file is written (see bdv_writer).
+if TYPE_CHECKING:
+    import pandas as pd
 
-def readstack(files: List[str], convertto=None) -> np.ndarray:
+
+# Pyramid levels and HDF5 chunk sizes of the generated Big Stitcher projects
+PROJECTED_SUBSAMP = ((1, 1, 1), (1, 2, 2), (1, 4, 4), (1, 8, 8), (1, 16, 16))
+PROJECTED_BLOCKDIM = ((1, 64, 64),)
+VOLUME_SUBSAMP = (
+    (1, 1, 1),
+    (1, 2, 2),
+    (1, 4, 4),
+    (1, 8, 8),
+    (2, 16, 16),
+    (4, 32, 32),
+)
+VOLUME_BLOCKDIM = (
+    (64, 64, 64),
+    (64, 64, 64),
+    (64, 64, 64),
+    (64, 64, 64),
+    (32, 32, 32),
+    (16, 16, 16),
+)
+
+# columns of um_mosaic_folder.df with the stage position of each file (from tiles.txt)
+STAGE_COLUMNS = ["stage_x", "stage_y", "stage_z"]
+
+# increased whenever the format of the cached folder index changes
+_INDEX_CACHE_VERSION = 3
+# maximum number of folders whose index is cached, the least recently
+# written are removed
+_INDEX_CACHE_MAX_FILES = 64
+
+# Storage backends of the generated projects: writer class and file extension
+BACKENDS = {"hdf5": (BdvWriter, ".h5"), "n5": (BdvN5Writer, ".n5")}
+
+
+def readstack(
+    files: List[str],
+    convertto=None,
+    out: Optional[np.ndarray] = None,
+    clock: Optional[StageClock] = None,
+    convert_func: Optional[Callable[[np.ndarray, np.ndarray], None]] = None,
+    pool: Optional[ReaderPool] = None,
+) -> np.ndarray:
     """Reads list of files as stack (using multiple Threads) with optional typeconversion
-    
+
+    The files are read into the page cache by the I/O threads of a
+    ReaderPool, which stay up to io_threads files ahead of the decode
+    threads. The stack is assembled in a single preallocated array. Each
+    decode thread decodes its slice from the file directly into that array;
+    if a type conversion is requested the slice is decoded into a
+    per-thread scratch buffer and cast into place.
+
     Parameters
     ----------
     files : List[str]
         list of filenames
     convertto : [type], optional
         type to convert to, by default None
-    
+    out : np.ndarray, optional
+        array of shape (len(files), y, x) to read the stack into. Its dtype
+        takes precedence over convertto. By default None (allocate a new array)
+    clock : StageClock, optional
+        if set, the wall time of reading the stack is added to it, split into
+        "read" and "convert" in proportion to the time the threads spent
+        decoding and converting. By default None
+    convert_func : Callable[[np.ndarray, np.ndarray], None], optional
+        function(src, dst) that converts a decoded slice into its place in
+        the stack. src is a scratch buffer that may be modified in place
+        (see uint16_converter). By default None (values are cast)
+    pool : ReaderPool, optional
+        pool used for reading, by default None (the shared pool, see
+        pipeline.reader_pool)
+
     Returns
     -------
     np.ndarray
         stack that has been read
     """
+    import tifffile
+
+    with tifffile.TiffFile(files[0]) as tif:
+        page = tif.pages[0]
+        shape, dtype = tuple(page.shape), page.dtype
+    if out is None:
+        outdtype = dtype if convertto is None else np.dtype(convertto)
+        out = np.empty((len(files),) + shape, dtype=outdtype)
+    assert out.shape == (len(files),) + shape, (
+        f"output array shape {out.shape} does not match stack shape "
+        f"{(len(files),) + shape}"
+    )
+    pool = pool if pool is not None else reader_pool()
+    scratch = threading.local()
+    thread_clock = StageClock()
+    t0 = time.perf_counter()
+    pool.read_ahead(files[: pool.io_threads])
+
+    def _imread(index):
+        ahead = index + pool.io_threads
+        if ahead < len(files):
+            pool.read_ahead(files[ahead : ahead + 1])
+        t_read = time.perf_counter()
+        # wait for the file to be in the page cache, then decode it in place
+        pool.fetch(files[index]).result()
+        with tifffile.TiffFile(files[index]) as tif:
+            page = tif.pages[0]
+            nbytes = page.size * page.dtype.itemsize
+            if page.dtype == out.dtype and convert_func is None:
+                page.asarray(out=out[index])
+                thread_clock.add("read", time.perf_counter() - t_read, nbytes)
+            else:
+                if getattr(scratch, "buffer", None) is None:
+                    scratch.buffer = np.empty(shape, dtype=page.dtype)
+                page.asarray(out=scratch.buffer)
+                thread_clock.add("read", time.perf_counter() - t_read, nbytes)
+                with thread_clock.time("convert", nbytes):
+                    if convert_func is None:
+                        np.copyto(out[index], scratch.buffer, casting="unsafe")
+                    else:
+                        convert_func(scratch.buffer, out[index])
+
+    pool.map(_imread, range(len(files)))
+    if clock is not None:
+        clock.add_shares(thread_clock, time.perf_counter() - t0)
+    return out
+
+
+# Projection functions that project_stack can compute incrementally, and the
+# ufuncs used to fold a slice into the running projection
+_ACCUMULATORS = {
+    np.max: np.maximum,
+    np.amax: np.maximum,
+    np.min: np.minimum,
+    np.amin: np.minimum,
+    np.sum: np.add,
+    np.mean: np.add,
+}
+
 
-    def _imread(input):
-        print(f"reading {input}")
-        tmp = tifffile.imread(input, multifile=False)
+def project_stack(
+    files: List[str],
+    project_func=np.max,
+    convertto=None,
+    nthreads: Optional[int] = None,
+    clock: Optional[StageClock] = None,
+    convert_func: Optional[Callable[[np.ndarray, np.ndarray], None]] = None,
+    pool: Optional[ReaderPool] = None,
+) -> np.ndarray:
+    """Z-projects a list of files without reading the whole stack into memory
 
-        print(tmp.shape)
-        if convertto is not None:
-            return tmp.astype(convertto)
+    The files are split into one contiguous run per decode thread. Each
+    thread decodes its slices one at a time (while the I/O threads read the
+    next one) and folds them into a running projection, so that at most a
+    few slices per thread are in memory.
+    The result is the same as project_func(readstack(files, convertto), axis=0).
+
+    Parameters
+    ----------
+    files : List[str]
+        list of filenames
+    project_func : [type], optional
+        one of np.max, np.min, np.sum and np.mean, by default np.max
+    convertto : [type], optional
+        type each slice is converted to before projecting, by default None
+    nthreads : int, optional
+        number of runs the files are split into, by default None (the
+        number of decode threads of the pool)
+    clock : StageClock, optional
+        if set, the wall time is added to it, split into "read", "convert"
+        and "project" as in readstack. By default None
+    convert_func : Callable[[np.ndarray, np.ndarray], None], optional
+        converts each slice to convertto, see readstack. By default None
+    pool : ReaderPool, optional
+        pool used for reading, by default None (the shared pool)
+
+    Returns
+    -------
+    np.ndarray
+        2D projection
+    """
+    import tifffile
+
+    if project_func not in _ACCUMULATORS:
+        raise ValueError(f"project_stack does not support {project_func}")
+    accumulate = _ACCUMULATORS[project_func]
+    with tifffile.TiffFile(files[0]) as tif:
+        page = tif.pages[0]
+        shape, dtype = tuple(page.shape), page.dtype
+    slicedtype = dtype if convertto is None else np.dtype(convertto)
+    # e.g. int64 for np.sum and float64 for np.mean, as numpy would return
+    resultdtype = project_func(np.zeros((1, 1), dtype=slicedtype), axis=0).dtype
+    pool = pool if pool is not None else reader_pool()
+    nthreads = nthreads or pool.decode_threads
+    runs = [run for run in np.array_split(np.arange(len(files)), nthreads) if len(run)]
+    thread_clock = StageClock()
+    t0 = time.perf_counter()
+
+    def _project_run(indices):
+        raw = np.empty(shape, dtype=dtype)
+        if slicedtype == dtype and convert_func is None:
+            plane = raw
         else:
-            return tmp
+            plane = np.empty(shape, dtype=slicedtype)
+        projection = None
+        pool.read_ahead(files[indices[0] : indices[0] + 1])
+        for index in indices:
+            if index + 1 <= indices[-1]:
+                pool.read_ahead(files[index + 1 : index + 2])
+            with thread_clock.time("read", raw.nbytes):
+                pool.fetch(files[index]).result()
+                with tifffile.TiffFile(files[index]) as tif:
+                    tif.pages[0].asarray(out=raw)
+            if plane is not raw:
+                with thread_clock.time("convert", raw.nbytes):
+                    if convert_func is None:
+                        np.copyto(plane, raw, casting="unsafe")
+                    else:
+                        convert_func(raw, plane)
+            with thread_clock.time("project", plane.nbytes):
+                if projection is None:
+                    projection = plane.astype(resultdtype)
+                else:
+                    accumulate(projection, plane, out=projection)
+        return projection
+
+    projections = pool.map(_project_run, runs)
+    result = projections[0]
+    for projection in projections[1:]:
+        accumulate(result, projection, out=result)
+    if project_func is np.mean:
+        result /= len(files)
+    if clock is not None:
+        clock.add_shares(thread_clock, time.perf_counter() - t0)
+    return result
 
-    with ThreadPoolExecutor() as p:
-        images = list(p.map(_imread, files))
-    return np.array(images)
 
+def uint16_converter(
+    intensity: str = "clip", input_range: Optional[Tuple[float, float]] = None
+) -> Callable[[np.ndarray, np.ndarray], None]:
+    """Returns a function(src, dst) that converts an image into a uint16 array
 
-def conv_strvector_to_np(strvalue: str) -> np.ndarray:
-    """converts a string vector such as '(12.0, 13.0, 14.0)' into 
-       a numpy array. To be used as a converter function with 
-     np.read_csv
+    The conversion is vectorized and works in place on src (a scratch
+    buffer), so apart from integer images that are rescaled no temporary
+    arrays are needed.
+
+    Parameters
+    ----------
+    intensity : str, optional
+        "clip": values are rounded and clipped to 0..65535.
+        "rescale": input_range is mapped linearly onto 0..65535, values
+        outside are clipped. By default "clip"
+    input_range : Tuple[float, float], optional
+        (low, high) for "rescale". By default None, which is the range of
+        the input dtype for integer images (floating point images require
+        an input_range)
+    """
+    assert intensity in ("clip", "rescale"), f"unknown intensity mode {intensity}"
+
+    def _convert(src: np.ndarray, dst: np.ndarray):
+        if intensity == "rescale":
+            if input_range is not None:
+                low, high = input_range
+            else:
+                assert src.dtype.kind in "iu", "rescaling floating point images requires input_range"
+                low, high = np.iinfo(src.dtype).min, np.iinfo(src.dtype).max
+            if src.dtype.kind != "f":
+                src = src.astype(np.float32)
+            np.subtract(src, low, out=src)
+            np.multiply(src, 65535 / (high - low), out=src)
+        if src.dtype.kind == "f":
+            np.rint(src, out=src)
+        elif src.dtype == np.uint16:
+            dst[...] = src
+            return
+        if src.min() < 0 or src.max() > 65535:
+            warnings.warn("Image values outside of 0..65535 were clipped")
+        np.clip(src, 0, 65535, out=dst, casting="unsafe")
+
+    return _convert
+
+
+def bdv_dtype(
+    dtype, intensity: str = "clip", input_range: Optional[Tuple[float, float]] = None
+) -> Tuple[np.dtype, Optional[Callable[[np.ndarray, np.ndarray], None]]]:
+    """Returns the dtype images of a given dtype are written to BDV files in, and the conversion
+
+    uint16 and int16 images are written as they are (BDV stores 16 bit
+    data), uint8 images are widened to uint16. Other images are converted
+    to uint16 with uint16_converter, as are all images if intensity is
+    "rescale".
+
+    Returns
+    -------
+    Tuple[np.dtype, Callable]
+        dtype and a convert_func for readstack (None if values are only cast)
+    """
+    dtype = np.dtype(dtype)
+    if intensity == "clip" and dtype in (np.dtype(np.uint16), np.dtype(np.int16)):
+        return dtype, None
+    if intensity == "clip" and dtype == np.dtype(np.uint8):
+        return np.dtype(np.uint16), None
+    return np.dtype(np.uint16), uint16_converter(intensity, input_range)
+
+
+def default_prefetch_depth(slab_depth: Optional[int]) -> int:
+    """Number of slabs read ahead if no prefetch_depth is given: 1, but no whole stacks"""
+    return 1 if slab_depth else 0
+
+
+def _to_dtype(image: np.ndarray, dtype) -> np.ndarray:
+    """Rounds and clips an image (e.g. a mean or sum projection) to the range of an integer dtype
+
+    Warns if values are clipped, e.g. when a sum projection exceeds the range.
     """
-    strvalue = re.sub("[\[\]\(\)]", "", strvalue)
-    npar = np.fromstring(strvalue, sep=",", dtype=np.float)
-    return npar
+    if image.dtype == dtype:
+        return image
+    info = np.iinfo(dtype)
+    if image.dtype.kind == "f":
+        image = np.rint(image)
+    if image.min() < info.min or image.max() > info.max:
+        warnings.warn(f"Image values outside of {info.min}..{info.max} were clipped")
+    return np.clip(image, info.min, info.max).astype(dtype)
+
+
+def stage_to_pixels(
+    xyz: Sequence[float], xyspacing: float, direction_x: int = 1, direction_y: int = -1
+) -> Tuple[float, float]:
+    """Converts a stage position to the (x, y) translation of a tile in pixels"""
+    # Explanation for formula below:
+    # Stage position in metadata appears to be in units of metres (m)
+    # PhysicalSize appears to be micrometers per voxel (um/vox)
+    # therefore for the stageposition in voxel coordinates we need to
+    # scale from meters to um (factor 1000000) and then divide by um/vox
+    # the direction vectors should be either 1 or -1 and can be used
+    # to flip the direction of the coordinate axes.
+    return xyz[0] / xyspacing * direction_x, xyz[1] / xyspacing * direction_y
 
 
 class um_mosaic_folder:
-    def __init__(self, foldername: Union[pathlib.Path, str], regexes: Dict[str, str]):
+    def __init__(
+        self,
+        foldername: Union[pathlib.Path, str],
+        regexes: Dict[str, str],
+        use_cache: bool = True,
+    ):
         """init ultramicroscope mosaic folder object
         
         Parameters
@@ -78,16 +393,57 @@ class um_mosaic_folder:
             'Z' regular expression to extract Z slice number
             'ch' regular expression to extract channel number
             'illu' regular expression to extract illumination direction
+            'T' (optional) regular expression to extract the timepoint of
+            time-lapse acquisitions. All timepoints are written into the
+            same Big Stitcher project.
+        use_cache : bool, optional
+            if True, the result of scanning the folder is cached in
+            ~/.cache/um2bs as a JSON file, together with the folder's
+            modification time, the modification time of tiles.txt and the
+            regexes. Reopening an unchanged folder with the same regexes
+            then skips the scan. There is one file per folder, which is
+            replaced whenever the folder is scanned again (e.g. with other
+            regexes), and only the most recently scanned folders are kept.
+            Pass False for temporary folders. By default True
         """
         # Take the provided foldername and anlyze the contents
         self.umpath = pathlib.Path(foldername)
         self.regexes = regexes
+        self.use_cache = use_cache
         assert self.umpath.exists
         self.update()
 
     def update(self):
+        if self.use_cache:
+            cachefile, key = self._index_cachefile(), self._index_cachekey()
+            index = _read_index_cache(cachefile, key)
+            if index is not None:
+                self.tiles, self.df = index
+                self.tiffiles = list(self.df["pathname"])
+                print(f"Read folder index from cache {cachefile}")
+                return
         self._read_tile_info()
         self._find_imfiles()
+        if self.use_cache:
+            _write_index_cache(cachefile, key, self.tiles, self.df)
+
+    def _index_cachefile(self) -> pathlib.Path:
+        """Name of the cache file for the folder index, one per folder"""
+        # the unresolved folder is part of the name, as the pathnames in
+        # the index are relative to it
+        folder = [str(self.umpath), str(self.umpath.resolve())]
+        digest = hashlib.sha1(repr(folder).encode()).hexdigest()
+        return pathlib.Path.home() / ".cache" / "um2bs" / f"{digest}.json"
+
+    def _index_cachekey(self) -> list:
+        """Identifies the state of the folder and the regexes the cached index is valid for"""
+        tilefile = self.umpath / "tiles.txt"
+        key = [_INDEX_CACHE_VERSION, os.stat(self.umpath).st_mtime_ns]
+        if tilefile.exists():
+            st = os.stat(tilefile)
+            key += [st.st_mtime_ns, st.st_size]
+        key += [list(item) for item in sorted(self.regexes.items())]
+        return key
 
     def _find_imfiles(self):
         """ looks for all files in self.umpath 
@@ -96,40 +452,54 @@ class um_mosaic_folder:
 
         Uses the other regexes  in self.regexes to populate metadata 
         """
-        self.tiffiles = list(self.umpath.glob("*"))
-        regex = re.compile(self.regexes["filewhitelist"])
-        self.tiffiles = list(filter(regex.search, map(str, self.tiffiles)))
-        self.df = pd.DataFrame(self.tiffiles, columns=["pathname"])
-        self.df["filename"] = self.df["pathname"].apply(lambda f: pathlib.Path(f).name)
-
-        def _extract_first_match_with_regex(regex, teststring):
-            try:
-                return regex.findall(teststring)[0]
-            except:
-                print(f"{regex} did not match {teststring}")
-                return ""
+        import pandas as pd
+
+        folder = str(self.umpath)
+        with os.scandir(folder) as it:
+            pathnames = pd.Series(
+                [os.path.join(folder, entry.name) for entry in it], dtype=object
+            )
+        pathnames = pathnames[pathnames.str.contains(self.regexes["filewhitelist"], regex=True)]
+        self.tiffiles = list(pathnames)
+        self.df = pd.DataFrame({"pathname": pathnames.values})
+        self.df["filename"] = self.df["pathname"].str.rsplit(os.sep, n=1).str[-1]
 
         for regexname in self.regexes.keys():
             if regexname != "filewhitelist":
                 print(f"Applying regex {regexname} to filenames.")
-                regex = re.compile(self.regexes[regexname])
-                _extract = partial(_extract_first_match_with_regex, regex)
-                self.df[regexname] = self.df["filename"].apply(_extract)
+                # like re.findall(...)[0]: the whole match if the regex has
+                # no group, otherwise the first group
+                pattern = self.regexes[regexname]
+                if re.compile(pattern).groups == 0:
+                    pattern = f"({pattern})"
+                extracted = self.df["filename"].str.extract(pattern, expand=True)[0]
+                nomatch = extracted.isna()
+                if nomatch.any():
+                    print(
+                        f"{regexname} regex {self.regexes[regexname]} did not match "
+                        f"{nomatch.sum()} files, e.g. {self.df['filename'][nomatch].iloc[0]}"
+                    )
+                self.df[regexname] = extracted.fillna("")
         # for column in ["Z","ch"]:
         #    self.df[column] = pd.to_numeric(self.df[column])
 
-        self.df = pd.merge(self.df, self.tiles, on="filename")
+        # look up the stage positions, files not listed in tiles.txt are skipped
+        rows = self.tiles.lookup(self.df["filename"])
+        listed = rows >= 0
+        if not listed.all():
+            print(f"Skipping {(~listed).sum()} files that are not listed in tiles.txt")
+        self.df = self.df[listed].reset_index(drop=True)
+        self.df[STAGE_COLUMNS] = self.tiles.xyz[rows[listed]]
 
         # In order to identify Z-stacks we add a column with the filename of the first Z slice
-        unique_z = self.df["Z"].unique()
-        print(unique_z)
-        # numeric_unique_z  = list(map(int, unique_z))
-        unique_z = sorted(unique_z, key=int)
-        print(f"first z slice is {unique_z[0]}")
-        _replacer = partial(re.sub, self.regexes["Z"], unique_z[0])
-        self.df["first_Z"] = self.df["filename"].apply(_replacer)
-
-        self.df["Znumeric"] = self.df["Z"].apply(int)
+        znumeric = pd.to_numeric(self.df["Z"]).astype(int)
+        first_z = self.df["Z"].values[znumeric.values.argmin()]
+        print(f"first z slice is {first_z}")
+        self.df["first_Z"] = self.df["filename"].str.replace(
+            self.regexes["Z"], first_z, regex=True
+        )
+
+        self.df["Znumeric"] = znumeric
         self.df = self.df.sort_values("Znumeric")
         print(self.df)
         print(f'nr of unique Z: {len(self.df["Z"].unique())}')
@@ -137,26 +507,177 @@ class um_mosaic_folder:
         print(f'nr of uniqu ch: {len(self.df["ch"].unique())}')
 
     def _read_tile_info(self):
+        from um2bs.tiles_file import read_tiles_file
+
         tilefile = self.umpath / "tiles.txt"
         # print(str(tilefile))
         if tilefile.exists():
             print("Trying to read tiles.txt file")
-            self.tiles = pd.read_csv(
-                str(tilefile),
-                sep=";",
-                skiprows=[0],
-                names=["filename", "unknown", "stagexyz"],
-                converters={"stagexyz": conv_strvector_to_np},
-            )
+            self.tiles = read_tiles_file(str(tilefile))
         else:
             print("Error: Tiles.txt not found. That file should have been produced"
                     "by the microscope software and contains the stage positions")
             exit(-1)
 
-    def _generate_project_folder(self, basefolder: str, projtype: str):
+    def stack_views(self) -> List[TiffStack]:
+        """Returns lazy (z,y,x) views of all stacks (tiles), in the order in which
+        generate_big_stitcher numbers the tiles
+
+        The views only read image data when indexed, see TiffStack.
+        """
+        return [
+            TiffStack(group["pathname"].values)
+            for _, group in self.df.groupby("first_Z")
+        ]
+
+    def _timepoints(self) -> Tuple[int, Dict[str, Tuple[str, int]]]:
+        """Returns the number of timepoints and, for every stack (first_Z),
+        a key that identifies its tile independent of the timepoint and the
+        index of its timepoint
+
+        Timepoints are numbered in the numeric order of the "T" regex
+        matches. Without a "T" regex all stacks belong to timepoint 0.
+        """
+        import pandas as pd
+
+        first_z = self.df.groupby("first_Z")["T" if "T" in self.regexes else "Z"].first()
+        if "T" not in self.regexes:
+            return 1, {grname: (grname, 0) for grname in first_z.index}
+        tnumeric = pd.to_numeric(first_z).astype(int)
+        timepoints = sorted(tnumeric.unique().tolist())
+        first_t = first_z.values[tnumeric.values.argmin()]
+        stacks = {
+            grname: (re.sub(self.regexes["T"], first_t, grname), timepoints.index(t))
+            for grname, t in tnumeric.items()
+        }
+        return len(timepoints), stacks
+
+    def stack_layout(
+        self, xyspacing: float = 1.0, direction_x: int = 1, direction_y: int = -1
+    ) -> "pd.DataFrame":
+        """Returns the views of the Big Stitcher project, one row per stack
+
+        Only the folder index is used, no image data is read.
+
+        Parameters
+        ----------
+        xyspacing, direction_x, direction_y :
+            as for generate_big_stitcher
+
+        Returns
+        -------
+        pd.DataFrame
+            in the order in which generate_big_stitcher converts the stacks,
+            with the columns first_Z (the stack), files (pathnames of the
+            slices in Z order), stagexyz, tile, channel, illumination, time
+            (the indices of the view in the project) and x, y (translation of
+            the tile in pixels, see stage_to_pixels)
+        """
+        import pandas as pd
+
+        # the index into these lists will be used to identify the dataset
+        channels = list(
+            map(str, self.df["ch"].unique())
+        )  # converting to string fixes problems with nan
+        illuminations = list(map(str, self.df["illu"].unique()))
+        # the same tile at different timepoints shares a setup, stacks are
+        # matched by their first_Z filename with the timepoint replaced
+        _, stack_timepoints = self._timepoints()
+        tile_keys = sorted(set(key for key, _ in stack_timepoints.values()))
+        tile_numbers = {key: nr for nr, key in enumerate(tile_keys)}
+        rows = []
+        for grname, group in self.df.groupby("first_Z"):
+            xyz = group[STAGE_COLUMNS].values[0]
+            x, y = stage_to_pixels(xyz, xyspacing, direction_x, direction_y)
+            tile_key, time_index = stack_timepoints[grname]
+            rows.append(
+                dict(
+                    first_Z=grname,
+                    files=group["pathname"].values,
+                    stagexyz=xyz,
+                    tile=tile_numbers[tile_key],
+                    channel=channels.index(str(group["ch"].values[0])),
+                    illumination=illuminations.index(str(group["illu"].values[0])),
+                    time=time_index,
+                    x=x,
+                    y=y,
+                )
+            )
+        return pd.DataFrame(rows)
+
+    def fused_layout(self, layout: "pd.DataFrame") -> "pd.DataFrame":
+        """Combines the views of each tile, channel and timepoint that differ
+        only in their illumination into a single view
+
+        Stacks are matched by their first_Z filename with the "illu" regex
+        match removed.
+
+        Parameters
+        ----------
+        layout : pd.DataFrame
+            as returned by stack_layout
+
+        Returns
+        -------
+        pd.DataFrame
+            one row per fused view, with the columns of layout and
+            illuminations (the illumination indices of the combined
+            stacks). files is a (z, illumination) array of pathnames, tiles
+            are renumbered and illumination is 0.
+        """
+        import pandas as pd
+
+        keys = layout["first_Z"].str.replace(self.regexes["illu"], "", regex=True)
+        rows = []
+        for key, views in layout.groupby(keys.values, sort=False):
+            views = views.sort_values("illumination")
+            nz = set(len(files) for files in views["files"])
+            assert len(nz) == 1, f"illuminations of {key} have different numbers of slices"
+            row = views.iloc[0].to_dict()
+            row["files"] = np.stack(list(views["files"]), axis=1)
+            row["illuminations"] = list(views["illumination"])
+            row["tile"] = views["tile"].min()
+            rows.append(row)
+        fused = pd.DataFrame(rows)
+        fused["tile"] = fused["tile"].rank(method="dense").astype(int) - 1
+        fused["illumination"] = 0
+        return fused
+
+    def estimate_content_threshold(
+        self, fuse_illuminations: Optional[str] = None, pool: Optional[ReaderPool] = None
+    ) -> float:
+        """Estimates the content threshold of skip_empty_tiles and trim_z from all views
+
+        generate_big_stitcher estimates the threshold from the views it
+        converts, which for a shard are only some of them. Shards of the
+        same conversion should use the threshold returned by this method
+        instead, so that they all drop and trim tiles alike. This costs an
+        extra pre-pass over all views.
+
+        Parameters
+        ----------
+        fuse_illuminations : str, optional
+            as for generate_big_stitcher, by default None
+        pool : ReaderPool, optional
+            pool used to read the slices, by default None (the shared pool)
+
+        Returns
+        -------
+        float
+            the threshold, see content.estimate_threshold
+        """
+        views = self.stack_layout()
+        if fuse_illuminations is not None:
+            views = self.fused_layout(views)
+        pool = reader_pool() if pool is None else pool
+        return estimate_threshold(_view_statistics(list(views["files"]), pool))
+
+    def _generate_project_folder(
+        self, basefolder: str, projtype: str, h5name: str = "dataset.h5"
+    ):
         projectfolder = pathlib.Path(basefolder) / pathlib.Path(projtype)
         projectfolder.mkdir(parents=True, exist_ok=True)
-        return str(projectfolder / "dataset.h5")
+        return str(projectfolder / h5name)
 
     def generate_big_stitcher(
         self,
@@ -168,6 +689,26 @@ class um_mosaic_folder:
         project_func=np.max,
         direction_x: int = 1,
         direction_y: int = -1,
+        slab_depth: Optional[int] = None,
+        prefetch_depth: Optional[int] = None,
+        shard: Optional[Tuple[int, int]] = None,
+        compression: str = "gzip",
+        compression_level: Optional[int] = None,
+        resume: bool = False,
+        progress_callback: Optional[Callable[[dict], None]] = None,
+        backend: str = "hdf5",
+        intensity: str = "clip",
+        input_range: Optional[Tuple[float, float]] = None,
+        io_threads: Optional[int] = None,
+        decode_threads: Optional[int] = None,
+        readahead: Optional[int] = None,
+        cancel: Optional[threading.Event] = None,
+        skip_empty_tiles: bool = False,
+        trim_z: bool = False,
+        content_threshold: Optional[float] = None,
+        flatfield=None,
+        darkframe=None,
+        fuse_illuminations: Optional[str] = None,
     ):
         """Generate a big stitcher project (.xml/h5)
         
@@ -189,6 +730,143 @@ class um_mosaic_folder:
             can be used to flip coordinate axes should be 1 or -1, by default 1
         direction_y : int, optional
             as above, by default -1
+        slab_depth : int, optional
+            if set, tiles are read and written in Z-slabs of this many slices
+            instead of as whole stacks, so that peak memory is bounded by the
+            slab size. Must be a multiple of the largest Z subsampling of
+            the volume pyramid (4). Multiples of the volume chunk depth (64)
+            are recommended: slabs of other depths are not aligned to the
+            chunks and are written through the (serial) HDF5 filter
+            pipeline instead of being compressed in parallel (for N5, the
+            partially covered blocks are read back and merged).
+            In this mode project_func is applied per slab and then to the
+            partial projections, so it must be a reduction such as np.max,
+            np.min or np.sum (np.mean is summed and divided by the depth of
+            the stack). By default None (read whole stacks). If only the projected
+            project is generated and project_func is np.max, np.min, np.sum
+            or np.mean, the stacks are never held in memory regardless of
+            slab_depth (see project_stack).
+        prefetch_depth : int, optional
+            number of stacks (or slabs, if slab_depth is set) that are read
+            ahead in the background while the current one is compressed and
+            written. At most prefetch_depth + 2 stacks/slabs are held in
+            memory. 0 disables read-ahead. By default None, which is 1 if
+            slab_depth is set and 0 otherwise, so that by default only one
+            whole stack is held in memory (use readahead to overlap reading
+            whole stacks with writing them)
+        shard : Tuple[int, int], optional
+            (shard index, number of shards). If set, only every
+            number-of-shards-th view (tile, channel, illumination and
+            timepoint), starting at shard index, is converted
+            and written to dataset-shard<index>.h5/.xml instead of
+            dataset.h5/.xml. This allows the shards to be converted by
+            separate processes or cluster jobs; once all are finished, they
+            are combined with merge_big_stitcher_shards. By default None
+            (convert all tiles)
+        compression : str, optional
+            compression of the HDF5 files, one of bdv_writer.COMPRESSIONS.
+            Use measure_compression to compare the codecs on a sample tile.
+            By default "gzip"
+        compression_level : int, optional
+            compression level, by default None (the codec's default)
+        resume : bool, optional
+            Every completed view is recorded in dataset.manifest.json next to
+            dataset.h5, together with a checksum of its input files and of
+            the conversion settings. If resume is True, an existing
+            dataset.h5 is kept and only views that are missing from the
+            manifest or whose inputs have changed are converted. This
+            continues interrupted conversions and adds tiles or channels that
+            were acquired later. If False, existing output is overwritten.
+            By default False
+        progress_callback : Callable[[dict], None], optional
+            called with progress events (see instrumentation.ConversionMonitor)
+            that report, for every converted tile, the time spent reading,
+            converting, projecting, computing the pyramid and compressing/
+            writing, the bytes read and written, the throughput and an ETA.
+            By default None
+        backend : str, optional
+            storage of the image data, a key of BACKENDS. "hdf5" writes
+            dataset.h5. "n5" writes a dataset.n5 container (a directory with
+            one file per block) that BigStitcher opens as well; its blocks
+            are written in parallel, shards write into the same container
+            (each with its own XML file) and partially written projects stay
+            readable. N5 supports the compressions "none" and "gzip".
+            By default "hdf5"
+        intensity : str, optional
+            uint16 and int16 images are written with their values unchanged
+            and uint8 images are widened to uint16 (see bdv_dtype). Images of
+            other types are converted to uint16: with "clip", values are
+            rounded and clipped to 0..65535; with "rescale", input_range is
+            mapped onto 0..65535 (this is applied to all images). The
+            conversion is done per slice while reading. By default "clip"
+        input_range : Tuple[float, float], optional
+            (low, high) intensity range for "rescale", by default None (the
+            range of the image dtype)
+        io_threads : int, optional
+            maximum number of files read at the same time, e.g. higher for
+            network file systems. By default None (8, or the setting of the
+            previous conversion in this process)
+        decode_threads : int, optional
+            number of threads decoding the files, by default None (number of
+            CPUs, or the setting of the previous conversion)
+        readahead : int, optional
+            number of files of the next tile (or slab) that are read into
+            the page cache while the current one is written (they take no
+            memory of the process), by default None (0, or the setting of
+            the previous conversion). The reader threads are shared by all
+            conversions in a process (see pipeline.reader_pool).
+        cancel : threading.Event, optional
+            if set (e.g. from a GUI thread), the conversion stops before the
+            next tile. The XML is written for the views converted so far,
+            which are also recorded in the manifest, so that the conversion
+            can be continued with resume=True. By default None
+        skip_empty_tiles : bool, optional
+            if True, a fast pre-pass reads every slice subsampled 8x in x
+            and y and computes its brightness (see content.slice_statistics).
+            Tiles without any slice brighter than content_threshold are not
+            converted. By default False
+        trim_z : bool, optional
+            if True, the Z range of each tile is trimmed to the slices
+            brighter than content_threshold (plus a margin of 2 slices),
+            using the same pre-pass. The translation of trimmed volume tiles
+            is shifted in Z accordingly. All timepoints of a tile are trimmed
+            to the same range (the union of their content), as BDV stores one
+            size per view setup. By default False
+        content_threshold : float, optional
+            brightness (99.9th percentile of a slice) above which a slice
+            contains the sample, by default None (twice the background, the
+            typical median of a slice, estimated from the tiles converted, see
+            content.estimate_threshold). When converting in shards, set it
+            explicitly so that all shards use the same threshold (see
+            estimate_content_threshold, generate_big_stitcher_sharded does
+            so if it is not given).
+        flatfield : optional
+            flat-field correction of the light-sheet intensity falloff,
+            applied to every slice while it is read (see
+            flatfield.FlatFieldCorrection), so no extra pass over the files
+            is needed. One of: None (no correction); "estimate" to estimate
+            a flat-field per channel and illumination from a sample of
+            slices of all tiles (see flatfield.estimate_flatfield); an image
+            or TIFF file used for all views; or a dict {(channel index,
+            illumination index): image or TIFF file}, views of channels and
+            illuminations that are not in the dict are not corrected.
+            By default None
+        darkframe : optional
+            dark frame (image or TIFF file) or constant camera offset that is
+            subtracted from every slice (before the flat-field correction),
+            by default None
+        fuse_illuminations : str, optional
+            if set, the stacks of a tile and channel acquired with different
+            illuminations are fused slice by slice while they are read (see
+            fused_layout and fusion.fuse_stacks), and only one view per tile
+            and channel is written, which halves the data written for two
+            light sheets. "max" takes the maximum of the illuminations,
+            "sigmoid" blends two illuminations with sigmoidal weights along
+            x (see fusion.illumination_weights). Flat-field corrections are
+            applied to each illumination before fusing. Unless fusing with
+            "max" and projecting with np.max, projected-only conversions
+            read whole stacks (use slab_depth to bound memory).
+            By default None (write every illumination as a separate view)
         """
 
         if not (projected or volume):
@@ -199,117 +877,780 @@ class um_mosaic_folder:
         print(f"Zspacing: {zspacing}")
         print(f"XYspacing: {xyspacing}")
 
-        # get unique channels and illuminations
-        # the index into these lists will be used to identify the dataset
-        channels = list(
-            map(str, self.df["ch"].unique())
-        )  # converting to string fixes problems with nan
-        illuminations = list(map(str, self.df["illu"].unique()))
-
-        # Group by stack
-        grouped_stacks = self.df.groupby("first_Z")
-        ntiles: int = len(grouped_stacks)
-        nchannels: int = len(channels)
-        nillu: int = len(illuminations)
-        print(f"Processing {ntiles} tiles.")
+        layout = self.stack_layout(xyspacing, direction_x, direction_y)
+        if fuse_illuminations is None:
+            views = layout
+        else:
+            assert fuse_illuminations in FUSIONS, f"unknown fusion {fuse_illuminations}"
+            views = self.fused_layout(layout)
+            # as indexed by the illumination column of stack_layout
+            illumination_names = list(map(str, self.df["illu"].unique()))
+            print(f"Fusing illuminations ({fuse_illuminations})")
+        ntiles: int = int(views["tile"].max()) + 1
+        ntimes: int = int(views["time"].max()) + 1
+        nchannels: int = int(views["channel"].max()) + 1
+        nillu: int = int(views["illumination"].max()) + 1
+        print(f"Processing {ntiles} tiles at {ntimes} timepoint(s).")
+        if volume and ntimes > 1:
+            # checked before anything is written, BDV stores one size per setup
+            _check_timepoint_depths(views)
         affine_matrix_template = np.array(
             ((1.0, 0.0, 0.0, 0.0), (0.0, 1.0, 0.0, 0.0), (0.0, 0.0, 1.0, 0.0))
         )
 
+        writer_class, extension = BACKENDS[backend]
+        xmlname = "dataset.xml" if shard is None else _shard_xmlname(shard[0])
+        if backend == "n5":
+            # all shards write into the same container
+            h5name = "dataset.n5"
+        else:
+            h5name = os.path.splitext(xmlname)[0] + extension
+        writer_mode = "a" if resume else "w"
+
         if projected:
-            h5_proj_name: str = self._generate_project_folder(outfolder_base, "projected")
-            bdv_proj_writer = npy2bdv.BdvWriter(
+            h5_proj_name: str = self._generate_project_folder(
+                outfolder_base, "projected", h5name
+            )
+            xml_proj_name = os.path.join(os.path.dirname(h5_proj_name), xmlname)
+            bdv_proj_writer = writer_class(
                 h5_proj_name,
                 nchannels=nchannels,
                 nilluminations=nillu,
                 ntiles=ntiles,
-                subsamp=((1, 1, 1), (1, 2, 2), (1, 4, 4), (1, 8, 8), (1, 16, 16)),
-                blockdim=((1, 64, 64),),
-                compression="gzip",
+                subsamp=PROJECTED_SUBSAMP,
+                blockdim=PROJECTED_BLOCKDIM,
+                compression=compression,
+                compression_level=compression_level,
+                mode=writer_mode,
+                filename_xml=xml_proj_name,
+            )
+            proj_manifest = ConversionManifest(xml_proj_name)
+            proj_params = (
+                compression,
+                compression_level,
+                PROJECTED_SUBSAMP,
+                PROJECTED_BLOCKDIM,
+                getattr(project_func, "__name__", repr(project_func)),
+                intensity,
+                input_range,
             )
 
         if volume:
-            h5_vol_name: str = self._generate_project_folder(outfolder_base, "volume")
-            bdv_vol_writer = npy2bdv.BdvWriter(
+            h5_vol_name: str = self._generate_project_folder(
+                outfolder_base, "volume", h5name
+            )
+            xml_vol_name = os.path.join(os.path.dirname(h5_vol_name), xmlname)
+            bdv_vol_writer = writer_class(
                 h5_vol_name,
                 nchannels=nchannels,
                 nilluminations=nillu,
                 ntiles=ntiles,
-                subsamp=(
-                    (1, 1, 1),
-                    (1, 2, 2),
-                    (1, 4, 4),
-                    (1, 8, 8),
-                    (2, 16, 16),
-                    (4, 32, 32),
-                ),
-                blockdim=(
-                    (64, 64, 64),
-                    (64, 64, 64),
-                    (64, 64, 64),
-                    (64, 64, 64),
-                    (32, 32, 32),
-                    (16, 16, 16),
-                ),
-                compression="gzip",
+                subsamp=VOLUME_SUBSAMP,
+                blockdim=VOLUME_BLOCKDIM,
+                compression=compression,
+                compression_level=compression_level,
+                mode=writer_mode,
+                filename_xml=xml_vol_name,
+            )
+            vol_manifest = ConversionManifest(xml_vol_name)
+            vol_params = (
+                compression,
+                compression_level,
+                VOLUME_SUBSAMP,
+                VOLUME_BLOCKDIM,
+                intensity,
+                input_range,
             )
 
-        for tile_nr, (grname, group) in enumerate(grouped_stacks):
-            print(f"Processing {tile_nr+1} out of {ntiles}:")
-            stack = readstack(group["pathname"].values, convertto=np.int16)
+        if slab_depth is not None and volume:
+            max_z_subsamp = bdv_vol_writer.subsamp[:, 0].max()
+            assert (
+                slab_depth % max_z_subsamp == 0
+            ), f"slab_depth must be a multiple of {max_z_subsamp}"
 
-            print("finished reading stack")
-            xyz = group["stagexyz"].values[0]
-            print(f"xyz is {xyz}")
+        # The views of all timepoints are converted in a single pass (and
+        # distributed over the shards), rather than one timepoint after the other
+        tiles = []
+        in_shard = []
+        # illumination indices of the stacks of fused views
+        view_illuminations = {}
+        for view_nr, view in enumerate(views.itertuples()):
             affine = affine_matrix_template.copy()
+            affine[0, 3] = view.x
+            affine[1, 3] = view.y
+            view_id = dict(
+                time=int(view.time),
+                channel=int(view.channel),
+                illumination=int(view.illumination),
+                tile=int(view.tile),
+            )
+            tiles.append((view.first_Z, view.files, view.stagexyz, affine, view_id))
+            in_shard.append(shard is None or view_nr % shard[1] == shard[0])
+            if fuse_illuminations is not None:
+                view_illuminations[view.first_Z] = view.illuminations
+
+        reader = reader_pool(io_threads, decode_threads, readahead)
 
-            # Explanation for formula below:
-            # Stage position in metadata appears to be in units of metres (m)
-            # PhysicalSize appears to be micrometers per voxel (um/vox)
-            # therefore for the stageposition in voxel coordinates we need to
-            # scale from meters to um (factor 1000000) and then divide by um/vox
-            # the direction vectors should be either 1 or -1 and can be used
-            # to flip the direction of the coordinate axes.
-            affine[1, 3] = xyz[1] / xyspacing * direction_y
-            affine[0, 3] = xyz[0] / xyspacing * direction_x
-
-            ch = str(group["ch"].values[0])
-            illu = str(group["illu"].values[0])
-            ch_index = channels.index(ch)
-            illu_index = illuminations.index(illu)
+        # Z offset (in slices) of the first converted slice of each tile
+        if skip_empty_tiles or trim_z:
+            tiles, z_offsets = _crop_to_content(
+                tiles, in_shard, skip_empty_tiles, trim_z, content_threshold, reader
+            )
+        else:
+            tiles = [tile for tile, selected in zip(tiles, in_shard) if selected]
+            z_offsets = [0] * len(tiles)
 
+        corrections = self._flatfield_corrections(layout, flatfield, darkframe)
+        if corrections:
+            # views are converted again if the correction changes
+            correction_params = (_image_param(flatfield), _image_param(darkframe))
             if volume:
-                bdv_vol_writer.append_view(
-                    stack,
-                    time=0,
-                    channel=ch_index,
-                    illumination=illu_index,
-                    m_affine=affine,
-                    tile=tile_nr,
-                    name_affine=f"tile {tile_nr} translation",
+                vol_params += correction_params
+            if projected:
+                proj_params += correction_params
+        if fuse_illuminations is not None:
+            if volume:
+                vol_params += (fuse_illuminations,)
+            if projected:
+                proj_params += (fuse_illuminations,)
+
+        todo_vol = todo_proj = set(range(len(tiles)))
+        if volume:
+            vol_checksums = [input_checksum(np.ravel(t[1]), vol_params) for t in tiles]
+            vol_metadata = [
+                dict(
+                    # the translation is applied to calibrated coordinates,
+                    # in which a slice is zspacing / xyspacing pixels thick
+                    m_affine=_shift_z(affine, z_offset * zspacing / xyspacing),
+                    name_affine=f"tile {view_id['tile']} translation",
                     voxel_size_xyz=(xyspacing, xyspacing, zspacing),
                     voxel_units="um",
                     calibration=(1, 1, zspacing / xyspacing),
                 )
-            if projected:
-                outstack = np.expand_dims(project_func(stack, axis=0), axis=0)
-                bdv_proj_writer.append_view(
-                    outstack,
-                    time=0,
-                    channel=ch_index,
-                    illumination=illu_index,
+                for (_, _, _, affine, view_id), z_offset in zip(tiles, z_offsets)
+            ]
+            todo_vol = _resume_views(
+                bdv_vol_writer, vol_manifest, tiles, vol_checksums, vol_metadata, resume
+            )
+        if projected:
+            proj_checksums = [input_checksum(np.ravel(t[1]), proj_params) for t in tiles]
+            proj_metadata = [
+                dict(
                     m_affine=affine,
-                    tile=tile_nr,
-                    name_affine=f"proj. tile {tile_nr} translation",
+                    name_affine=f"proj. tile {view_id['tile']} translation",
                     # Projections are inherently 2D, so we just repeat the X voxel size for Z
                     voxel_size_xyz=(xyspacing, xyspacing, xyspacing),
                     voxel_units="um",
                     # calibration=(1, 1, 1),
                 )
+                for (_, _, _, affine, view_id) in tiles
+            ]
+            todo_proj = _resume_views(
+                bdv_proj_writer, proj_manifest, tiles, proj_checksums, proj_metadata, resume
+            )
+
+        # For projections only, the stacks never need to be held in memory.
+        # The maximum of the illuminations can be taken after projecting
+        # them, as long as the projection is a maximum as well.
+        stream_projection = (
+            projected
+            and not volume
+            and project_func in _ACCUMULATORS
+            and (
+                fuse_illuminations is None
+                or (fuse_illuminations == "max" and _ACCUMULATORS[project_func] is np.maximum)
+            )
+        )
+
+        def _slabs():
+            for index, (grname, files, *_) in enumerate(tiles):
+                if not (
+                    (volume and index in todo_vol) or (projected and index in todo_proj)
+                ):
+                    continue
+                # Without slab_depth the whole stack is a single slab
+                if slab_depth is None or stream_projection:
+                    z_step = len(files)
+                else:
+                    z_step = slab_depth
+                for z_start in range(0, len(files), z_step):
+                    yield index, z_start, files[z_start : z_start + z_step]
+
+        todo = sorted(
+            i
+            for i in range(len(tiles))
+            if (volume and i in todo_vol) or (projected and i in todo_proj)
+        )
+        if todo:
+            # uint16 camera data is kept as it is, no conversion is needed
+            stack_dtype, convert_func = bdv_dtype(
+                TiffStack(np.ravel(tiles[todo[0]][1])).dtype, intensity, input_range
+            )
+            print(f"Writing images as {stack_dtype}")
+            # flat-field correction per channel and illumination, fused
+            # with the type conversion
+            view_converters = {
+                key: correction.converter(convert_func)
+                for key, correction in corrections.items()
+            }
+        monitor = ConversionMonitor(progress_callback)
+        monitor.start(len(todo), ntiles=ntiles, ntimes=ntimes)
+
+        slabs = list(_slabs())
+        next_slab = {slab[:2]: following for slab, following in zip(slabs, slabs[1:])}
+
+        def _read_slab(slab_item):
+            grname, _, _, _, view_id = tiles[slab_item[0]]
+            clock = monitor.clock(grname)
+            illuminations = view_illuminations.get(grname, [view_id["illumination"]])
+            stacks = []
+            for illumination, files in zip(illuminations, _illumination_files(slab_item[2])):
+                slice_converter = view_converters.get(
+                    (view_id["channel"], illumination), convert_func
+                )
+                if stream_projection:
+                    # The slices are folded into the projection while they are
+                    # read. The projection is passed on as a single slice stack,
+                    # which project_func below leaves unchanged.
+                    projection = project_stack(
+                        files,
+                        project_func,
+                        convertto=stack_dtype,
+                        clock=clock,
+                        convert_func=slice_converter,
+                        pool=reader,
+                    )
+                    stacks.append(projection[np.newaxis])
+                else:
+                    stacks.append(
+                        readstack(
+                            files,
+                            convertto=stack_dtype,
+                            clock=clock,
+                            convert_func=slice_converter,
+                            pool=reader,
+                        )
+                    )
+            slab = stacks[0]
+            if len(stacks) > 1:
+                with clock.time("fuse", sum(s.nbytes for s in stacks)):
+                    weights = None
+                    if fuse_illuminations == "sigmoid":
+                        weights = illumination_weights(
+                            [illumination_names[i] for i in illuminations], slab.shape[2]
+                        )
+                    slab = fuse_stacks(stacks, fuse_illuminations, weights)
+            # start reading the next slab while this one is written
+            following = next_slab.get(slab_item[:2])
+            if following is not None and reader.readahead > 0:
+                reader.read_ahead(np.ravel(following[2])[: reader.readahead])
+            return slab
+
+        # streamed projections are complete, otherwise a mean is summed over the slabs
+        mean_of_slabs = project_func is np.mean and not stream_projection
+        # The next slabs are read in the background while the current one
+        # is compressed and written
+        if prefetch_depth is None:
+            prefetch_depth = default_prefetch_depth(slab_depth)
+        for (index, z_start, slab_files), slab in prefetch(
+            _read_slab, slabs, depth=prefetch_depth
+        ):
+            grname, files, xyz, affine, view_id = tiles[index]
+            write_vol = volume and index in todo_vol
+            write_proj = projected and index in todo_proj
+            nz = len(files)
+            clock = monitor.clock(grname)
+            if z_start == 0 and cancel is not None and cancel.is_set():
+                print("Conversion cancelled")
+                break
+            if z_start == 0:
+                print(
+                    f"Processing {view_id['tile']+1} out of {ntiles}, "
+                    f"timepoint {view_id['time']+1} out of {ntimes}:"
+                )
+                print(f"xyz is {xyz}")
+                projection = None
+
+            if write_vol:
+                if z_start == 0:
+                    bdv_vol_writer.new_view(
+                        (nz,) + slab.shape[1:], **view_id, **vol_metadata[index]
+                    )
+                bdv_vol_writer.append_slab(slab, z_start, **view_id, clock=clock)
+            if write_proj:
+                with clock.time("project", slab.nbytes):
+                    if mean_of_slabs:
+                        # slabs differ in depth, so their means are not averaged
+                        slab_projection = np.sum(slab, axis=0, dtype=np.float64)
+                    else:
+                        slab_projection = project_func(slab, axis=0)
+                    if projection is None:
+                        projection = slab_projection
+                    elif mean_of_slabs:
+                        projection += slab_projection
+                    else:
+                        projection = project_func(
+                            np.stack((projection, slab_projection)), axis=0
+                        )
+                    if mean_of_slabs and z_start + len(slab_files) == nz:
+                        projection /= nz
+            del slab
+
+            if z_start + len(slab_files) < nz:
+                continue
+            print("finished reading stack")
+
+            if write_vol:
+                bdv_vol_writer.flush()
+                vol_manifest.add(
+                    grname,
+                    vol_checksums[index],
+                    setup=_view_setup(bdv_vol_writer, view_id),
+                    stagexyz=xyz.tolist(),
+                    **view_id,
+                )
+                vol_manifest.save()
+            if write_proj:
+                # e.g. mean projections are rounded back to the image dtype
+                outstack = np.expand_dims(_to_dtype(projection, stack_dtype), axis=0)
+                bdv_proj_writer.append_view(
+                    outstack, clock=clock, **view_id, **proj_metadata[index]
+                )
+                bdv_proj_writer.flush()
+                proj_manifest.add(
+                    grname,
+                    proj_checksums[index],
+                    setup=_view_setup(bdv_proj_writer, view_id),
+                    stagexyz=xyz.tolist(),
+                    **view_id,
+                )
+                proj_manifest.save()
+            monitor.view_done(
+                grname,
+                bytes_in=sum(os.path.getsize(f) for f in np.ravel(files)),
+                bytes_out=clock.nbytes.get("write", 0),
+                **view_id,
+            )
 
         if projected:
-            bdv_proj_writer.write_xml_file(ntimes=1)
+            bdv_proj_writer.write_xml_file(ntimes=ntimes)
             bdv_proj_writer.close()
         if volume:
-            bdv_vol_writer.write_xml_file(ntimes=1)
+            bdv_vol_writer.write_xml_file(ntimes=ntimes)
             bdv_vol_writer.close()
+        reader.discard()
+        monitor.finish(cancelled=cancel is not None and cancel.is_set())
+
+    def _flatfield_corrections(
+        self, layout: "pd.DataFrame", flatfield, darkframe
+    ) -> Dict[Tuple[int, int], FlatFieldCorrection]:
+        """Returns the FlatFieldCorrection of each (channel, illumination), see generate_big_stitcher"""
+        if flatfield is None and darkframe is None:
+            return {}
+        corrections = {}
+        for (channel, illumination), views in layout.groupby(["channel", "illumination"]):
+            key = (int(channel), int(illumination))
+            if isinstance(flatfield, str) and flatfield == "estimate":
+                print(f"Estimating flat-field of channel {channel}, illumination {illumination}")
+                flat = estimate_flatfield(list(views["files"]), dark=darkframe)
+            elif isinstance(flatfield, dict):
+                flat = flatfield.get(key)
+            else:
+                flat = flatfield
+            if flat is not None or darkframe is not None:
+                corrections[key] = FlatFieldCorrection(flat, darkframe)
+        return corrections
+
+    def measure_compression(
+        self,
+        compressions: Sequence[str] = COMPRESSIONS,
+        compression_level: Optional[int] = None,
+        tile_nr: int = 0,
+        max_slices: int = 64,
+    ) -> "pd.DataFrame":
+        """Measures size and time for writing a sample tile with different compressions
+
+        The first max_slices slices of a tile are written as a volume view
+        (with the pyramid levels of generate_big_stitcher) into a temporary
+        file for each compression.
+
+        Parameters
+        ----------
+        compressions : Sequence[str], optional
+            compressions to compare, by default all of bdv_writer.COMPRESSIONS.
+            Compressions that are not available (missing hdf5plugin) are skipped.
+        compression_level : int, optional
+            compression level, by default None (the codec's default)
+        tile_nr : int, optional
+            index of the tile to use as a sample, by default 0
+        max_slices : int, optional
+            maximum number of slices to read from the tile, by default 64
+
+        Returns
+        -------
+        pd.DataFrame
+            one row per compression with the columns compression, bytes,
+            seconds, ratio (uncompressed/compressed size) and MB/s
+            (uncompressed MB written per second)
+        """
+        import pandas as pd
+
+        grouped_stacks = self.df.groupby("first_Z")
+        group = grouped_stacks.get_group(list(grouped_stacks.groups)[tile_nr])
+        files = group["pathname"].values[:max_slices]
+        stack_dtype, convert_func = bdv_dtype(TiffStack(files).dtype)
+        stack = readstack(files, convertto=stack_dtype, convert_func=convert_func)
+        results = []
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for compression in compressions:
+                h5name = str(pathlib.Path(tmpdir) / f"{compression}.h5")
+                start = time.perf_counter()
+                try:
+                    writer = BdvWriter(
+                        h5name,
+                        subsamp=VOLUME_SUBSAMP,
+                        blockdim=VOLUME_BLOCKDIM,
+                        compression=compression,
+                        compression_level=compression_level,
+                    )
+                except ImportError as e:
+                    print(f"Skipping {compression}: {e}")
+                    continue
+                writer.append_view(stack)
+                writer.close()
+                seconds = time.perf_counter() - start
+                nbytes = os.path.getsize(h5name)
+                results.append(
+                    {
+                        "compression": compression,
+                        "bytes": nbytes,
+                        "seconds": seconds,
+                        "ratio": stack.nbytes / nbytes,
+                        "MB/s": stack.nbytes / 1e6 / seconds,
+                    }
+                )
+        results = pd.DataFrame(results)
+        print(results)
+        return results
+
+    def generate_big_stitcher_sharded(
+        self,
+        outfolder_base: str,
+        nshards: int,
+        max_workers: Optional[int] = None,
+        link: bool = True,
+        **kwargs,
+    ):
+        """Generate a big stitcher project using several processes
+
+        The tiles are split into nshards shards that are converted in
+        parallel by a process pool and merged into a single project
+        afterwards (see generate_big_stitcher, merge_big_stitcher_shards).
+
+        Parameters
+        ----------
+        outfolder_base : str
+            base folder for the output
+        nshards : int
+            number of shards the tiles are split into
+        max_workers : int, optional
+            maximum number of processes, by default None (number of CPUs)
+        link : bool, optional
+            passed on to merge_big_stitcher_shards, by default True
+        **kwargs
+            further arguments for generate_big_stitcher. If tiles are
+            skipped or trimmed without a content_threshold, it is estimated
+            once from all views (see estimate_content_threshold).
+        """
+        kwargs = _shared_content_threshold(self, nshards, kwargs)
+        with ProcessPoolExecutor(max_workers=max_workers) as p:
+            futures = [
+                p.submit(
+                    self.generate_big_stitcher,
+                    outfolder_base,
+                    shard=(shard_index, nshards),
+                    **kwargs,
+                )
+                for shard_index in range(nshards)
+            ]
+            for future in futures:
+                future.result()
+        merge_big_stitcher_shards(
+            outfolder_base,
+            nshards,
+            projected=kwargs.get("projected", True),
+            volume=kwargs.get("volume", True),
+            link=link,
+            backend=kwargs.get("backend", "hdf5"),
+        )
+
+
+def _shared_content_threshold(mosaic: um_mosaic_folder, nshards: int, options: dict) -> dict:
+    """Returns options with the content_threshold shared by all shards, see generate_big_stitcher_sharded"""
+    crop = options.get("skip_empty_tiles") or options.get("trim_z")
+    if nshards <= 1 or not crop or options.get("content_threshold") is not None:
+        return options
+    pool = reader_pool(
+        options.get("io_threads"), options.get("decode_threads"), options.get("readahead")
+    )
+    threshold = mosaic.estimate_content_threshold(options.get("fuse_illuminations"), pool)
+    print(f"Content threshold of all shards: {threshold:.1f}")
+    return dict(options, content_threshold=threshold)
+
+
+def _read_index_cache(cachefile: pathlib.Path, key: list):
+    """Returns the cached (tiles, df) of a folder, None if there is none or it is stale"""
+    import pandas as pd
+    from um2bs.tiles_file import StagePositions
+
+    try:
+        with open(cachefile, "r") as f:
+            index = json.load(f)
+        if index["key"] != key:
+            return None
+        tiles = StagePositions(
+            pd.Index(index["tiles"]["filenames"], dtype=object),
+            np.array(index["tiles"]["xyz"], dtype=np.float64).reshape(-1, 3),
+        )
+        df = pd.DataFrame(index["df"]["columns"], index=index["df"]["index"])
+        df = df.astype(index["df"]["dtypes"])
+        return tiles, df
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Could not read cached folder index {cachefile}: {e}")
+        return None
+
+
+def _write_index_cache(cachefile: pathlib.Path, key: list, tiles, df: "pd.DataFrame"):
+    """Writes the index of a folder as JSON and removes the oldest cached indices"""
+    index = {
+        "key": key,
+        "tiles": {"filenames": list(tiles.filenames), "xyz": tiles.xyz.tolist()},
+        "df": {
+            "index": df.index.tolist(),
+            "columns": {column: df[column].tolist() for column in df.columns},
+            "dtypes": {column: str(dtype) for column, dtype in df.dtypes.items()},
+        },
+    }
+    try:
+        cachefile.parent.mkdir(parents=True, exist_ok=True)
+        tmpname = cachefile.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmpname, "w") as f:
+            json.dump(index, f)
+        os.replace(tmpname, cachefile)
+        cached = sorted(cachefile.parent.iterdir(), key=lambda p: p.stat().st_mtime_ns)
+        for old in cached[:-_INDEX_CACHE_MAX_FILES]:
+            old.unlink()
+    except OSError as e:
+        print(f"Could not write folder index cache {cachefile}: {e}")
+
+
+def _crop_to_content(
+    tiles: list,
+    selected: List[bool],
+    skip_empty_tiles: bool,
+    trim_z: bool,
+    threshold: Optional[float],
+    pool: ReaderPool,
+) -> Tuple[list, List[int]]:
+    """Drops empty tiles and/or trims the slices of tiles to their content
+
+    Only the selected tiles (e.g. those of a shard) are returned. BDV
+    stores one size per setup, so with trim_z all timepoints of a setup are
+    trimmed to the same Z range, the union of their content. The tiles of
+    other timepoints of the selected setups are therefore measured as well.
+
+    Returns
+    -------
+    Tuple[list, List[int]]
+        the remaining selected tiles, with their files trimmed, and the
+        index of the first remaining slice of each
+    """
+    start = time.perf_counter()
+    wanted = set(_setup_key(view_id) for (*_, view_id), s in zip(tiles, selected) if s)
+    measured = [
+        index
+        for index, (*_, view_id) in enumerate(tiles)
+        if selected[index] or (trim_z and _setup_key(view_id) in wanted)
+    ]
+    statistics = dict(zip(measured, _view_statistics([tiles[i][1] for i in measured], pool)))
+    if threshold is None:
+        threshold = estimate_threshold(list(statistics.values()))
+    ranges = {index: content_range(stats, threshold) for index, stats in statistics.items()}
+    setup_ranges = {}
+    for index, zrange in ranges.items():
+        if zrange is None:
+            continue
+        key = _setup_key(tiles[index][4])
+        start_z, stop_z = setup_ranges.get(key, zrange)
+        setup_ranges[key] = (min(start_z, zrange[0]), max(stop_z, zrange[1]))
+    cropped, z_offsets = [], []
+    nviews = nslices = nkept = 0
+    for index, (grname, files, xyz, affine, view_id) in enumerate(tiles):
+        if not selected[index]:
+            continue
+        nviews += 1
+        nslices += len(files)
+        if ranges[index] is None and skip_empty_tiles:
+            print(f"Skipping empty tile {grname}")
+            continue
+        zrange = (0, len(files))
+        if trim_z:
+            zrange = setup_ranges.get(_setup_key(view_id), zrange)
+        nkept += zrange[1] - zrange[0]
+        cropped.append((grname, files[zrange[0] : zrange[1]], xyz, affine, view_id))
+        z_offsets.append(zrange[0])
+    print(
+        f"Content threshold {threshold:.1f}: converting {len(cropped)} of {nviews} "
+        f"views, {nkept} of {nslices} slices ({time.perf_counter() - start:.1f} s)"
+    )
+    return cropped, z_offsets
+
+
+def _view_statistics(
+    view_files: Sequence[np.ndarray], pool: Optional[ReaderPool] = None
+) -> List[np.ndarray]:
+    """content.slice_statistics of views, fused views contain a slice if any of their illuminations does"""
+    stacks = [_illumination_files(files) for files in view_files]
+    flat = iter(slice_statistics([files for views in stacks for files in views], pool=pool))
+    return [np.max([next(flat) for _ in views], axis=0) for views in stacks]
+
+
+def _check_timepoint_depths(views: "pd.DataFrame"):
+    """Raises a ValueError if the stacks of a tile have different depths at different timepoints"""
+    for (tile, channel, illumination), setup_views in views.groupby(
+        ["tile", "channel", "illumination"]
+    ):
+        depths = {int(view.time): len(view.files) for view in setup_views.itertuples()}
+        if len(set(depths.values())) > 1:
+            raise ValueError(
+                f"the stacks of tile {tile}, channel {channel}, illumination {illumination} "
+                f"have different numbers of slices at different timepoints {depths}, "
+                "but a volume project requires the same size at every timepoint"
+            )
+
+
+def _setup_key(view_id: dict) -> Tuple[int, int, int]:
+    """Identifies the setup of a view, i.e. the view without its timepoint"""
+    return view_id["tile"], view_id["channel"], view_id["illumination"]
+
+
+def _illumination_files(files: np.ndarray) -> List[np.ndarray]:
+    """Splits the (z, illumination) files of a fused view into one stack per illumination"""
+    return [files] if files.ndim == 1 else list(files.T)
+
+
+def _image_param(image) -> str:
+    """Identifies an image, file name or constant in the checksum of a view"""
+    if isinstance(image, dict):
+        return repr({k: _image_param(v) for k, v in sorted(image.items())})
+    if isinstance(image, np.ndarray):
+        return hashlib.sha1(np.ascontiguousarray(image).tobytes()).hexdigest()
+    return repr(image)
+
+
+def _shift_z(affine: np.ndarray, dz: float) -> np.ndarray:
+    shifted = affine.copy()
+    shifted[2, 3] += dz
+    return shifted
+
+
+def _view_setup(writer: BdvWriter, view_id: dict) -> int:
+    return writer.setup_id(view_id["illumination"], view_id["channel"], view_id["tile"])
+
+
+def _resume_views(
+    writer: BdvWriter,
+    manifest: ConversionManifest,
+    tiles: list,
+    checksums: List[str],
+    metadata: List[dict],
+    resume: bool,
+) -> set:
+    """Re-uses completed views of a previous conversion
+
+    Views found in the manifest with an unchanged checksum are kept in the
+    file (moved to their current setup, in case the number of tiles or
+    channels changed) and registered with the writer, all other stored
+    views are discarded. The manifest is updated accordingly.
+
+    Returns
+    -------
+    set
+        indices into tiles of the views that still need to be converted
+    """
+    stored = writer.stored_views()
+    mapping = {}
+    entries = {}
+    if resume:
+        manifest.load()
+        for index, (grname, _, _, _, view_id) in enumerate(tiles):
+            entry = manifest.completed(grname, checksums[index])
+            if entry is None or (entry["time"], entry["setup"]) not in stored:
+                continue
+            mapping[(entry["time"], entry["setup"])] = (
+                view_id["time"],
+                _view_setup(writer, view_id),
+            )
+            entries[index] = entry
+    writer.retain_views(mapping)
+
+    manifest.views = {}
+    for index, entry in entries.items():
+        grname, _, xyz, _, view_id = tiles[index]
+        shape = stored[(entry["time"], entry["setup"])]
+        isetup = writer.new_view(shape, allocate=False, **view_id, **metadata[index])
+        manifest.add(grname, checksums[index], setup=isetup, stagexyz=xyz.tolist(), **view_id)
+    manifest.save()
+    if entries:
+        print(f"Resuming: {len(entries)} of {len(tiles)} views already converted")
+    return set(range(len(tiles))) - set(entries)
+
+
+def _shard_xmlname(shard_index: int) -> str:
+    return f"dataset-shard{shard_index:03d}.xml"
+
+
+def merge_big_stitcher_shards(
+    outfolder_base: str,
+    nshards: int,
+    projected: bool = True,
+    volume: bool = True,
+    link: bool = True,
+    backend: str = "hdf5",
+):
+    """Combines shards written by generate_big_stitcher(..., shard=...) into one project
+
+    Writes dataset.h5/.xml next to the shard files in the projected and/or
+    volume project folders. For the "n5" backend, the shards already share
+    dataset.n5 and only their XML files are merged into dataset.xml.
+
+    Parameters
+    ----------
+    outfolder_base : str
+        base folder for the output, as passed to generate_big_stitcher
+    nshards : int
+        number of shards
+    projected : bool, optional
+        if True, merge the projected project, by default True
+    volume : bool, optional
+        if True, merge the volume project, by default True
+    link : bool, optional
+        if True, dataset.h5 references the shard files through HDF5 external
+        links (the shard files must be kept). If False, the image data is
+        copied into dataset.h5 and the shard files can be deleted
+        afterwards. By default True
+    backend : str, optional
+        backend the shards were written with, by default "hdf5"
+    """
+    projtypes = [p for p, selected in (("projected", projected), ("volume", volume)) if selected]
+    for projtype in projtypes:
+        projectfolder = pathlib.Path(outfolder_base) / projtype
+        shard_files = [str(projectfolder / _shard_xmlname(i)) for i in range(nshards)]
+        print(f"Merging {nshards} shards in {projectfolder}")
+        if backend == "n5":
+            merge_bdv_xml(shard_files, str(projectfolder / "dataset.xml"))
+        else:
+            shard_files = [os.path.splitext(f)[0] + BACKENDS[backend][1] for f in shard_files]
+            merge_bdv_files(shard_files, str(projectfolder / "dataset.h5"), link=link)
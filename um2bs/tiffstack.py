@@ -0,0 +1,95 @@
+# Lazy access to stacks stored as one TIFF file per Z slice
+#
+# License BSD-3
+# Volker
+# .Hilsenstein @ monash
+# .edu
+
+import numpy as np
+from typing import Dict, Optional, Sequence, Tuple
+
+
+class TiffStack:
+    def __init__(self, files: Sequence[str]):
+        """Lazy (z,y,x) array view of a stack of single-image TIFF files
+
+        Nothing is read until the stack is indexed. Files whose image data is
+        stored uncompressed and contiguously (as written by the
+        Ultramicroscope) are memory-mapped, so that indexing only touches the
+        bytes that are needed, e.g. stack[::10, ::4, ::4] for a preview.
+        Other files are decoded with tifffile.
+
+        Parameters
+        ----------
+        files : Sequence[str]
+            one filename per Z slice, in Z order
+        """
+        import tifffile
+
+        self.files = list(files)
+        with tifffile.TiffFile(self.files[0]) as tif:
+            page = tif.pages[0]
+            self.dtype = page.dtype
+            self.shape: Tuple[int, int, int] = (len(self.files),) + tuple(page.shape)
+        self.ndim = 3
+        # (offset, dtype) of memory-mappable files, None for the others
+        self._layout: Dict[int, Optional[Tuple[int, np.dtype]]] = {}
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __repr__(self) -> str:
+        return f"TiffStack(shape={self.shape}, dtype={self.dtype})"
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def _slice(self, z: int) -> np.ndarray:
+        """Returns slice z, memory-mapped if possible"""
+        import tifffile
+
+        filename = self.files[z]
+        if z not in self._layout:
+            with tifffile.TiffFile(filename) as tif:
+                page = tif.pages[0]
+                if page.is_memmappable:
+                    dtype = page.dtype.newbyteorder(tif.byteorder)
+                    self._layout[z] = (page.dataoffsets[0], dtype)
+                else:
+                    self._layout[z] = None
+                    return page.asarray()
+        layout = self._layout[z]
+        if layout is None:
+            with tifffile.TiffFile(filename) as tif:
+                return tif.pages[0].asarray()
+        offset, dtype = layout
+        return np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=self.shape[1:])
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        zkey, yxkey = key[0], key[1:]
+        if isinstance(zkey, (int, np.integer)):
+            z = int(zkey)
+            if z < 0:
+                z += len(self)
+            if not 0 <= z < len(self):
+                raise IndexError(f"index {zkey} is out of bounds for a stack of {len(self)} slices")
+            return np.array(self._slice(z)[yxkey])
+        zs = np.arange(len(self))[zkey]
+        out = None
+        for i, z in enumerate(zs):
+            plane = self._slice(z)[yxkey]
+            if out is None:
+                out = np.empty((len(zs),) + plane.shape, dtype=self.dtype)
+            out[i] = plane
+        if out is None:
+            # empty Z selection
+            plane_shape = np.broadcast_to(np.empty((), np.bool_), self.shape[1:])[yxkey].shape
+            out = np.empty((0,) + plane_shape, dtype=self.dtype)
+        return out
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        stack = self[:]
+        return stack if dtype is None else stack.astype(dtype)
@@ -0,0 +1,74 @@
+# Reading the stage positions from the tiles.txt file of the
+# Ultramicroscope software
+#
+# License BSD-3
+# Volker
+# .Hilsenstein @ monash
+# .edu
+
+import io
+import numpy as np
+import pandas as pd
+from typing import NamedTuple, Sequence
+
+# removed from the position vectors, e.g. "(12.0, 13.0, 14.0)"
+_BRACKETS = str.maketrans("", "", "[]()")
+
+
+class StagePositions(NamedTuple):
+    """Stage positions of the files listed in tiles.txt
+
+    filenames
+        pd.Index of the file names (without folder)
+    xyz
+        (N,3) float64 array of the x, y, z stage positions, one row per
+        file name
+    """
+
+    filenames: pd.Index
+    xyz: np.ndarray
+
+    def lookup(self, filenames: Sequence[str]) -> np.ndarray:
+        """Returns the rows of xyz for filenames, -1 for files not listed"""
+        return self.filenames.get_indexer(filenames)
+
+
+def parse_positions(vectors: Sequence[str]) -> np.ndarray:
+    """Parses position vectors such as "(12.0, 13.0, 14.0)" into an (N,3) array
+
+    The vectors are joined into one CSV text that is parsed by the C
+    parser of pandas, rather than parsed line by line, which keeps this
+    fast for hundreds of thousands of lines.
+    """
+    if len(vectors) == 0:
+        return np.empty((0, 3), dtype=np.float64)
+    text = "\n".join(vectors).translate(_BRACKETS)
+    xyz = pd.read_csv(io.StringIO(text), header=None, dtype=np.float64).values
+    if xyz.shape != (len(vectors), 3):
+        raise ValueError("stage positions must have 3 coordinates (x, y, z)")
+    return xyz
+
+
+def read_tiles_file(filename: str) -> StagePositions:
+    """Reads tiles.txt
+
+    The file has a header line followed by one line per file of the form
+    filename;<unknown>;(x, y, z). Further columns are ignored. If a file
+    is listed more than once, the first position is used.
+    """
+    table = pd.read_csv(
+        filename,
+        sep=";",
+        skiprows=[0],
+        header=None,
+        names=["filename", "unknown", "stagexyz"],
+        usecols=["filename", "stagexyz"],
+        dtype=str,
+        keep_default_na=False,
+        # drop extra columns instead of using the leading ones as the index
+        index_col=False,
+    )
+    table = table[~table["filename"].duplicated()]
+    return StagePositions(
+        pd.Index(table["filename"].values), parse_positions(table["stagexyz"].values)
+    )
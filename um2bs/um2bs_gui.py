@@ -9,9 +9,14 @@
 # edu
 
 from PyQt5 import QtWidgets, QtCore, QtGui
-from um2bs.process_um_folder import um_mosaic_folder
+from um2bs.process_um_folder import um_mosaic_folder, BACKENDS
+from um2bs.bdv_writer import COMPRESSIONS
+from um2bs.preview import mosaic_overview
+from um2bs.fusion import FUSIONS
+import numpy as np
 from um2bs.background_worker import Worker, WorkerSignals
 import pathlib
+import threading
 
 # To add progress bar https://riptutorial.com/pyqt5/example/29500/basic-pyqt-progress-bar
 # to add a waiting spinner (while looking for wells) https://gist.github.com/eyllanesc/1a09157d17ba13d223c312b28a81c320
@@ -22,6 +27,11 @@ class UltraMicroscopeToBigStitcherGUI(QtWidgets.QDialog):
     def __init__(self, parent=None):
         super(UltraMicroscopeToBigStitcherGUI, self).__init__(parent)
         self.processor = None
+        self._processing = False
+        self._scan_generation = 0
+        self._preview_running = False
+        self._preview_pending = False
+        self._cancel = threading.Event()
         self.rootfolder = "C:/Users/Volker/Data/Ultra_Oct2019/ultra_microscope_minimal"
         self.outfolder = ""
         self.threadpool = QtCore.QThreadPool()
@@ -41,6 +51,23 @@ class UltraMicroscopeToBigStitcherGUI(QtWidgets.QDialog):
         self.checkbox_2D.setChecked(True)
         self.checkbox_3D = QtWidgets.QCheckBox("create 3D BDV file")
         self.checkbox_3D.setChecked(False)
+        self.checkbox_crop = QtWidgets.QCheckBox(
+            "crop to content (skip empty tiles, trim Z to the sample)"
+        )
+        self.checkbox_crop.setChecked(False)
+        self.checkbox_resume = QtWidgets.QCheckBox(
+            "resume (keep tiles converted by a previous, e.g. cancelled, run)"
+        )
+        self.checkbox_resume.setChecked(False)
+        # fusion of the illuminations of each tile (fuse_illuminations)
+        self.combobox_fusion = QtWidgets.QComboBox()
+        self.combobox_fusion.addItems(("none",) + FUSIONS)
+        self.combobox_fusion.setCurrentText("none")
+        # orientation of the stage axes (direction_x/direction_y)
+        self.checkbox_flip_x = QtWidgets.QCheckBox("flip stage X direction")
+        self.checkbox_flip_x.setChecked(False)
+        self.checkbox_flip_y = QtWidgets.QCheckBox("flip stage Y direction")
+        self.checkbox_flip_y.setChecked(True)
         # regular expressions for file selection and metadata extraction
         self.lineedit_re_filewhitelist = QtWidgets.QLineEdit()
         self.lineedit_re_filewhitelist.setText(".*tif")
@@ -52,6 +79,9 @@ class UltraMicroscopeToBigStitcherGUI(QtWidgets.QDialog):
         self.lineedit_re_illu.setText(
             "(?<=_Ill)[\da-zA-Z]+"
         )  # https://regex101.com/r/sk8w3u/1/
+        # optional, only for time-lapse acquisitions
+        self.lineedit_re_T = QtWidgets.QLineEdit()
+        self.lineedit_re_T.setPlaceholderText("e.g. (?<=_T)\d+ (leave empty for a single timepoint)")
 
         # voxel dimensions
         self.lineedit_zspacing = QtWidgets.QLineEdit()
@@ -60,17 +90,49 @@ class UltraMicroscopeToBigStitcherGUI(QtWidgets.QDialog):
         self.lineedit_xyspacing = QtWidgets.QLineEdit()
         self.lineedit_xyspacing.setText("1.00")
         self.lineedit_xyspacing.setValidator(QtGui.QDoubleValidator(0.0, 10000.0, 2))
+        # file format and compression
+        self.combobox_backend = QtWidgets.QComboBox()
+        self.combobox_backend.addItems(BACKENDS)
+        self.combobox_backend.setCurrentText("hdf5")
+        self.combobox_compression = QtWidgets.QComboBox()
+        self.combobox_compression.addItems(COMPRESSIONS)
+        self.combobox_compression.setCurrentText("gzip")
+        self.spinbox_compression_level = QtWidgets.QSpinBox()
+        self.spinbox_compression_level.setRange(-1, 22)
+        self.spinbox_compression_level.setSpecialValueText("default")
+        self.spinbox_compression_level.setValue(-1)
         # List of tiles
         self.listWidget = QtWidgets.QListWidget()
         self.listWidget.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
         self.listWidget.setGeometry(QtCore.QRect(10, 10, 211, 291))
+        # low resolution overview of the tile layout
+        self.previewButton = QtWidgets.QPushButton("Preview tile layout")
+        self.previewButton.setEnabled(False)
+        self.preview = QtWidgets.QLabel("")
+        self.preview.setAlignment(QtCore.Qt.AlignCenter)
         self.startProcessingButton = QtWidgets.QPushButton("Process selected folders")
         self.startProcessingButton.setEnabled(False)
+        self.cancelButton = QtWidgets.QPushButton("Cancel")
+        self.cancelButton.setEnabled(False)
+        # progress of the conversion
+        self.progressbar = QtWidgets.QProgressBar()
+        self.progressbar.setRange(0, 100)
+        self.progressbar.setValue(0)
+        self.progress_info = QtWidgets.QLabel("")
         # Make connections
         self.listWidget.itemSelectionChanged.connect(self._checkProcessingButton)
         self.inputFolderButton.clicked.connect(self.get_root_folder)
         self.outputFolderButton.clicked.connect(self.get_output_folder)
         self.startProcessingButton.clicked.connect(self.process)
+        self.previewButton.clicked.connect(self._trigger_preview)
+        self.cancelButton.clicked.connect(self.cancel)
+        # rescan the folder when the regexes change, debounced
+        self.rescan_timer = QtCore.QTimer(self)
+        self.rescan_timer.setSingleShot(True)
+        self.rescan_timer.setInterval(750)
+        self.rescan_timer.timeout.connect(self._trigger_update)
+        for re_name in ["filewhitelist", "Z", "ch", "illu", "T"]:
+            getattr(self, f"lineedit_re_{re_name}").textChanged.connect(self._schedule_rescan)
         # Assemble GUI elements into final layout
 
         self.layout.addWidget(self.inputFolderButton)
@@ -93,24 +155,45 @@ class UltraMicroscopeToBigStitcherGUI(QtWidgets.QDialog):
             QtWidgets.QLabel("Regular expression for illumination <illu>")
         )
         self.layout.addWidget(self.lineedit_re_illu)
+        self.layout.addWidget(
+            QtWidgets.QLabel("Regular expression for timepoints <T> (optional)")
+        )
+        self.layout.addWidget(self.lineedit_re_T)
         self.layout.addWidget(self.checkbox_2D)
         self.layout.addWidget(self.checkbox_3D)
+        self.layout.addWidget(self.checkbox_crop)
+        self.layout.addWidget(self.checkbox_resume)
+        self.layout.addWidget(QtWidgets.QLabel("Fuse illuminations of each tile:"))
+        self.layout.addWidget(self.combobox_fusion)
         self.layout.addWidget(QtWidgets.QLabel("Enter XY spacing in um/voxel:"))
         self.layout.addWidget(self.lineedit_xyspacing)
         self.layout.addWidget(QtWidgets.QLabel("Enter Z spacing in um/voxel:"))
         self.layout.addWidget(self.lineedit_zspacing)
+        self.layout.addWidget(self.checkbox_flip_x)
+        self.layout.addWidget(self.checkbox_flip_y)
+        self.layout.addWidget(QtWidgets.QLabel("File format (N5: only none/gzip compression):"))
+        self.layout.addWidget(self.combobox_backend)
+        self.layout.addWidget(QtWidgets.QLabel("Compression and compression level:"))
+        self.layout.addWidget(self.combobox_compression)
+        self.layout.addWidget(self.spinbox_compression_level)
 
         # self.layout.addWidget(QtWidgets.QLabel("Select the wells to process:"))
         # self.layout.addWidget(self.listWidget)
+        self.layout.addWidget(self.previewButton)
+        self.layout.addWidget(self.preview)
         self.layout.addWidget(self.startProcessingButton)
+        self.layout.addWidget(self.cancelButton)
+        self.layout.addWidget(self.progressbar)
+        self.layout.addWidget(self.progress_info)
 
         self.setLayout(self.layout)
 
     def get_root_folder(self):
-        self.rootfolder = str(
-            QtWidgets.QFileDialog.getExistingDirectory(self, "Select Directory")
-        )
-        self.update_files()
+        folder = str(QtWidgets.QFileDialog.getExistingDirectory(self, "Select Directory"))
+        if not folder:
+            return
+        self.rootfolder = folder
+        self.selectedroot.setText(self.rootfolder)
         self._trigger_update()
 
     def get_output_folder(self):
@@ -121,27 +204,152 @@ class UltraMicroscopeToBigStitcherGUI(QtWidgets.QDialog):
         self._checkProcessingButton()
 
     def process(self):
+        # widgets are only accessed in the GUI thread, the worker gets a copy of the settings
+        compression_level = self.spinbox_compression_level.value()
+        direction_x, direction_y = self._directions()
+        fusion = self.combobox_fusion.currentText()
+        settings = dict(
+            outfolder_base=self.outfolder,
+            projected=self.checkbox_2D.isChecked(),
+            volume=self.checkbox_3D.isChecked(),
+            xyspacing=float(self.lineedit_xyspacing.text()),
+            zspacing=float(self.lineedit_zspacing.text()),
+            compression=self.combobox_compression.currentText(),
+            compression_level=None if compression_level < 0 else compression_level,
+            backend=self.combobox_backend.currentText(),
+            direction_x=direction_x,
+            direction_y=direction_y,
+            resume=self.checkbox_resume.isChecked(),
+            skip_empty_tiles=self.checkbox_crop.isChecked(),
+            trim_z=self.checkbox_crop.isChecked(),
+            fuse_illuminations=None if fusion == "none" else fusion,
+        )
+        self._processing = True
+        self._cancel.clear()
         self.startProcessingButton.setEnabled(False)
+        self.cancelButton.setEnabled(True)
 
-        worker = Worker(self._process)
-        worker.signals.finished.connect(self._checkProcessingButton)
+        self.progressbar.setValue(0)
+        self.progress_info.setText("Starting ...")
+        worker = Worker(self._process, self.processor, settings)
+        worker.signals.error.connect(
+            lambda error: self.progress_info.setText(f"Conversion failed: {error[1]}")
+        )
+        worker.signals.finished.connect(self._processing_finished)
+        worker.signals.progress.connect(self._show_progress)
         self.threadpool.start(worker)
 
-    def _process(self, *args, **kwargs):
+    def cancel(self):
+        # the conversion checks the event before each tile
+        self._cancel.set()
+        self.cancelButton.setEnabled(False)
+        self.progress_info.setText("Cancelling after the current tile ...")
+
+    def _processing_finished(self):
+        self._processing = False
+        self.cancelButton.setEnabled(False)
+        self._checkProcessingButton()
+
+    def _show_progress(self, event: dict):
+        # runs in the GUI thread, the conversion emits the events from the worker thread
+        if event["event"] == "start":
+            self.progress_info.setText(f"Converting {event['nviews']} tiles ...")
+        elif event["event"] == "view":
+            self.progressbar.setValue(int(event["percent"]))
+            self.progress_info.setText(
+                f"{event['done']} of {event['nviews']} tiles, "
+                f"{event['mb_per_s']:.1f} MB/s, "
+                f"{event['eta'] / 60:.1f} min remaining"
+            )
+        elif event["event"] == "finished" and event.get("cancelled"):
+            self.progress_info.setText(
+                f"Cancelled after {event['nviews']} tiles, "
+                "process again with resume checked to convert the remaining tiles"
+            )
+        elif event["event"] == "finished":
+            self.progressbar.setValue(100)
+            self.progress_info.setText(
+                f"Finished {event['nviews']} tiles in {event['elapsed'] / 60:.1f} min "
+                f"({event['mb_per_s']:.1f} MB/s)"
+            )
 
+    def _process(self, processor: um_mosaic_folder, settings: dict, progress_callback=None):
+        # runs in a worker thread
         print(f"Input folder {self.rootfolder}")
-        print(f"Output folder {self.outfolder}")
-        print(f"2D projection {self.checkbox_2D.isChecked()}")
-        print(f"2D volume {self.checkbox_3D.isChecked()}")
-        print(f"xy scale um/pix {float(self.lineedit_xyspacing.text())}")
-        print(f"z scale um/pix {float(self.lineedit_zspacing.text())}")
+        for key, value in settings.items():
+            print(f"{key} {value}")
+        processor.generate_big_stitcher(
+            progress_callback=progress_callback.emit, cancel=self._cancel, **settings
+        )
 
-        self.processor.generate_big_stitcher(
-            outfolder_base=self.outfolder,
-            projected=self.checkbox_2D.isChecked(),
-            volume=self.checkbox_3D.isChecked(),
+    def _directions(self):
+        return (
+            -1 if self.checkbox_flip_x.isChecked() else 1,
+            -1 if self.checkbox_flip_y.isChecked() else 1,
+        )
+
+    def _trigger_preview(self):
+        if self.processor is None:
+            return
+        if self._preview_running:
+            # rendered again for the current folder once the running preview is done
+            self._preview_pending = True
+            return
+        self._preview_running = True
+        self._preview_pending = False
+        # previews of folders that have been rescanned since are ignored
+        generation = self._scan_generation
+        self.previewButton.setEnabled(False)
+        self.preview.setText("Rendering tile layout preview ...")
+        direction_x, direction_y = self._directions()
+        worker = Worker(
+            self._render_preview,
+            self.processor,
             xyspacing=float(self.lineedit_xyspacing.text()),
-            zspacing=float(self.lineedit_zspacing.text()),
+            direction_x=direction_x,
+            direction_y=direction_y,
+        )
+        worker.signals.result.connect(lambda result: self._show_preview(generation, result))
+        worker.signals.error.connect(lambda error: self._preview_failed(generation, error))
+        worker.signals.finished.connect(self._preview_finished)
+        self.threadpool.start(worker)
+
+    def _preview_finished(self):
+        self._preview_running = False
+        self.previewButton.setEnabled(self.processor is not None)
+        if self._preview_pending:
+            self._trigger_preview()
+
+    def _preview_failed(self, generation: int, error: tuple):
+        if generation != self._scan_generation:
+            return
+        self.preview.setText(f"Preview failed: {error[1]}")
+
+    def _render_preview(self, processor: um_mosaic_folder, progress_callback=None, **kwargs):
+        # runs in a worker thread
+        return mosaic_overview(processor, **kwargs)
+
+    def _show_preview(self, generation: int, result):
+        # runs in the GUI thread
+        if generation != self._scan_generation:
+            return
+        overview, boxes = result
+        # contrast stretch to 8 bit
+        low, high = np.percentile(overview, (1, 99.8))
+        scaled = np.clip((overview - low) / max(high - low, 1e-6) * 255, 0, 255)
+        image8 = np.ascontiguousarray(scaled.astype(np.uint8))
+        height, width = image8.shape
+        qimage = QtGui.QImage(image8.data, width, height, width, QtGui.QImage.Format_Grayscale8)
+        pixmap = QtGui.QPixmap.fromImage(qimage.copy())
+        # outline and number the tiles
+        painter = QtGui.QPainter(pixmap)
+        painter.setPen(QtGui.QColor("yellow"))
+        for box in boxes.itertuples():
+            painter.drawRect(box.ox, box.oy, box.onx - 1, box.ony - 1)
+            painter.drawText(box.ox + 3, box.oy + 12, str(box.tile))
+        painter.end()
+        self.preview.setPixmap(
+            pixmap.scaled(400, 400, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
         )
 
     def _checkProcessingButton(self):
@@ -150,33 +358,62 @@ class UltraMicroscopeToBigStitcherGUI(QtWidgets.QDialog):
         #    and self.outfolder != ""
         #    and len(self._get_selected_indices()) > 0
         # ):
-        if self.outfolder != "" and self.rootfolder != "":
+        if self.outfolder != "" and self.processor is not None and not self._processing:
             self.startProcessingButton.setEnabled(True)
         else:
             self.startProcessingButton.setEnabled(False)
 
+    def _regexes(self) -> dict:
+        res = {}
+        for re_name in ["filewhitelist", "Z", "ch", "illu"]:
+            widget = getattr(self, f"lineedit_re_{re_name}")
+            res[re_name] = widget.text()
+        if self.lineedit_re_T.text():
+            res["T"] = self.lineedit_re_T.text()
+        return res
+
+    def _schedule_rescan(self):
+        # restarted on every keystroke, so that the folder is only
+        # rescanned once the regexes stop changing
+        if pathlib.Path(self.rootfolder).is_dir():
+            self.rescan_timer.start()
+
     def _trigger_update(self):
-        worker = Worker(self.update_files)
-        # worker.signals.result.connect(self.print_output)
-        worker.signals.finished.connect(self._checkProcessingButton)
-        # worker.signals.progress.connect(self.progress_fn)
+        self.rescan_timer.stop()
+        # results of scans that were started before this one are ignored
+        self._scan_generation += 1
+        generation = self._scan_generation
+        self.processor = None
+        self._checkProcessingButton()
+        self.previewButton.setEnabled(False)
+        self.nr_files_found.setText("Looking for files ...")
+        worker = Worker(self.update_files, self.rootfolder, self._regexes())
+        worker.signals.result.connect(lambda processor: self._scan_finished(generation, processor))
+        worker.signals.error.connect(lambda error: self._scan_failed(generation, error))
         print("starting worker to find files")
         self.threadpool.start(worker)
 
-    def update_files(self, *args, **kwargs):
-        print("in update wells")
-        self.selectedroot.setText(self.rootfolder)
-        # self.listWidget.clear()
+    def update_files(self, rootfolder: str, regexes: dict, progress_callback=None):
+        # runs in a worker thread and must not access widgets
         print("initializing Matrix processor")
-        res = {}
-        for re_name in ["filewhitelist", "Z", "ch", "illu"]:
-            widget = eval(f"self.lineedit_re_{re_name}")
-            res[re_name] = widget.text()
-        self.nr_files_found.setText("Looking for files ...")
-        self.processor = um_mosaic_folder(self.rootfolder, res)
+        processor = um_mosaic_folder(rootfolder, regexes)
+        print(processor.df)
+        return processor
+
+    def _scan_finished(self, generation: int, processor: um_mosaic_folder):
+        if generation != self._scan_generation:
+            return
+        self.processor = processor
+        self.nr_files_found.setText(f"{len(processor.df)} files found")
+        self._checkProcessingButton()
+        # show the layout once the folder is scanned
+        self._trigger_preview()
+
+    def _scan_failed(self, generation: int, error: tuple):
+        if generation != self._scan_generation:
+            return
+        self.nr_files_found.setText(f"Scanning the folder failed: {error[1]}")
 
-        print(self.processor.df)
-        self.nr_files_found.setText(f"{len(self.processor.df)} files found")
 
 def run():
     import sys